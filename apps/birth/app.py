@@ -7,8 +7,10 @@ from rapidsms.parsers.keyworder import Keyworder
 from django.db import transaction
 from django.utils.translation import ugettext_lazy as _
 
-from mctc.models.logs import MessageLog, log
-from mctc.models.general import Provider, Case
+from mctc.models.logs import log
+from mctc.logwriter import messagelog
+from mctc.models.general import Case
+from mctc.caches import identities
 from birth.models import ReportBirth
 
 import re
@@ -31,19 +33,11 @@ class App (rapidsms.app.App):
     keyword = Keyworder()
     def start (self):
         """Configure your app in the start phase."""
-        pass
+        messagelog.attach(self.router)
 
     def parse (self, message):
-        # allow authentication to occur when http tester is used
-        if message.peer[:3] == '254':
-            mobile = "+" + message.peer
-        else:
-            mobile = message.peer 
-        provider = Provider.by_mobile(mobile)
-        if provider:
-            message.sender = provider.user
-        else:
-            message.sender = None
+        # shared with the other clinical apps, see mctc.caches
+        message.sender = identities.user(message.peer)
         message.was_handled = False
 
     def handle (self, message):
@@ -71,11 +65,7 @@ class App (rapidsms.app.App):
 
     def cleanup (self, message):
         if message.was_handled:
-            log = MessageLog(mobile=message.peer,
-                         sent_by=message.persistant_connection.reporter,
-                         text=message.text,
-                         was_handled=message.was_handled)
-            log.save()
+            messagelog.write(message)
 
     def outgoing (self, message):
         """Handle outgoing message notifications."""
@@ -83,7 +73,7 @@ class App (rapidsms.app.App):
 
     def stop (self):
         """Perform global app cleanup when the application is stopped."""
-        pass
+        messagelog.flush(force=True)
     
     @keyword("birth (\S+) (\S+) ([MF]) (\d+) ([0-9]*\.[0-9]+|[0-9]+) ([A-Z]) (\S+)?(.+)*")
     @registered
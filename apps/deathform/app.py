@@ -6,8 +6,9 @@ from rapidsms.parsers.keyworder import Keyworder
 
 from django.utils.translation import ugettext_lazy as _
 
-from mctc.models.logs import MessageLog
-from mctc.models.general import Provider, Case
+from mctc.logwriter import messagelog
+from mctc.models.general import Case
+from mctc.caches import identities, cases
 from deathform.models.general import ReportDeath
 
 import re
@@ -30,19 +31,11 @@ class App (rapidsms.app.App):
     keyword = Keyworder()
     def start (self):
         """Configure your app in the start phase."""
-        pass
+        messagelog.attach(self.router)
 
     def parse (self, message):
-        # allow authentication to occur when http tester is used
-        if message.peer[:3] == '254':
-            mobile = "+" + message.peer
-        else:
-            mobile = message.peer 
-        provider = Provider.by_mobile(mobile)
-        if provider:
-            message.sender = provider.user
-        else:
-            message.sender = None
+        # shared with the other clinical apps, see mctc.caches
+        message.sender = identities.user(message.peer)
         message.was_handled = False
 
     def handle (self, message):
@@ -70,11 +63,7 @@ class App (rapidsms.app.App):
 
     def cleanup (self, message):
         if message.was_handled:
-            log = MessageLog(mobile=message.peer,
-                         sent_by=message.persistant_connection.reporter,
-                         text=message.text,
-                         was_handled=message.was_handled)
-            log.save()
+            messagelog.write(message)
 
     def outgoing (self, message):
         """Handle outgoing message notifications."""
@@ -82,13 +71,13 @@ class App (rapidsms.app.App):
 
     def stop (self):
         """Perform global app cleanup when the application is stopped."""
-        pass
+        messagelog.flush(force=True)
     
     def find_case (self, ref_id):
-        try:
-            return Case.objects.get(ref_id=int(ref_id))
-        except Case.DoesNotExist:
+        case = cases.find(ref_id)
+        if case is None:
             raise HandlerFailed(_("Case +%s not found.") % ref_id)
+        return case
     
     @keyword("death (\S+) (\S+) ([MF]) (\d+[YM]) (\d+) ([A-Z]) ([A-Z])?(.+)*")
     @registered
@@ -4,14 +4,15 @@
 import rapidsms
 from rapidsms.parsers.keyworder import Keyworder
 
-from django.db import models
 from django.utils.translation import ugettext as _
 
-from mctc.models.logs import MessageLog, log
-from mctc.models.general import Case
-from models import ReportDiagnosis, Diagnosis, Lab, LabDiagnosis
+from mctc.models.logs import log
+from mctc.logwriter import messagelog
+from mctc.caches import diagnoses, labs as lab_codes, cases
+from mctc.reportwriter import file_report
+from models import ReportDiagnosis, LabDiagnosis
 
-import re, datetime
+import re
 
 find_diagnostic_re = re.compile('( -[\d\.]+)' ,re.I)
 find_lab_re =  re.compile('(/[A-Z]+)([\+-])(\d*:?)', re.I)
@@ -34,7 +35,7 @@ class App (rapidsms.app.App):
     keyword = Keyworder()
     def start (self):
         """Configure your app in the start phase."""
-        pass
+        messagelog.attach(self.router)
 
     def parse (self, message):        
         message.was_handled = False
@@ -64,11 +65,7 @@ class App (rapidsms.app.App):
 
     def cleanup (self, message):
         if message.was_handled:
-            log = MessageLog(mobile=message.peer,
-                         sent_by=message.persistant_connection.reporter,
-                         text=message.text,
-                         was_handled=message.was_handled)
-            log.save()
+            messagelog.write(message)
 
     def outgoing (self, message):
         """Handle outgoing message notifications."""
@@ -76,53 +73,48 @@ class App (rapidsms.app.App):
 
     def stop (self):
         """Perform global app cleanup when the application is stopped."""
-        pass
+        messagelog.flush(force=True)
 
     def find_case (self, ref_id):
-        try:
-            return Case.objects.get(ref_id=int(ref_id))
-        except Case.DoesNotExist:
+        case = cases.find(ref_id)
+        if case is None:
             raise HandlerFailed(_("Case +%s not found.") % ref_id)
+        return case
 
     @keyword(r'd \+(\d+ )(.*)')
     @registered
     def diagnosis(self, message, ref_id, text):
         case = self.find_case(ref_id)
         reporter = message.persistant_connection.reporter
-        diags = []
         labs = []
 
         hits = find_diagnostic_re.findall(message.text)
-        for hit in hits:
-            code = hit[2:]
-            try:
-                diags.append(Diagnosis.objects.get(code__iexact=code))
-            except Diagnosis.DoesNotExist:
-                raise HandlerFailed("Unknown diagnosis code: %s" % code)
+        diags, unknown = diagnoses.resolve([hit[2:] for hit in hits])
+        if unknown:
+            raise HandlerFailed("Unknown diagnosis code: %s" % unknown[0])
 
         hits = find_lab_re.findall(text)
         for hit in hits:
             code, sign, number = hit
-            try:
-                # the code starts with /
-                labs.append([Lab.objects.get(code__iexact=code[1:]), sign, number])
-            except Lab.DoesNotExist:
+            # the code starts with /
+            lab = lab_codes.get(code[1:])
+            if lab is None:
                 raise HandlerFailed("Unknown lab code: %s" % code)
+            labs.append([lab, sign, number])
 
-        self.delete_similar(case.reportdiagnosis_set)
-        report = ReportDiagnosis(case=case, reporter=reporter, text=message.text)
-        report.save()
-        for diag in diags:
-            report.diagnosis.add(diag)
+        results = []
         for lab, sign, number in labs:
             ld = LabDiagnosis()
             ld.lab = lab
             ld.result = int(sign == "+")
             if number:
                 ld.amount = number
-            ld.diagnosis = report
-            ld.save()
-        report.save()
+            results.append(ld)
+
+        report = ReportDiagnosis(case=case, reporter=reporter, text=message.text)
+        # replaces today's report for this case, if any
+        file_report(report, links={"diagnosis": diags},
+                    related=[(LabDiagnosis, "diagnosis", results)])
 
         info = case.get_dictionary()
         info.update(report.get_dictionary())
@@ -149,12 +141,3 @@ class App (rapidsms.app.App):
                 
         log(case, "diagnosis_taken")        
         return True            
-
-    def delete_similar(self, queryset):
-        try:
-            last_report = queryset.latest("entered_at")
-            if (datetime.datetime.now() - last_report.entered_at).days == 0:
-                # last report was today. so delete it before filing another.
-                last_report.delete()
-        except models.ObjectDoesNotExist:
-            pass
\ No newline at end of file
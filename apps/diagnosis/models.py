@@ -71,10 +71,17 @@ class ReportDiagnosis(models.Model):
         verbose_name = "Diagnosis Report"
         app_label = "diagnosis"
 
-    def save(self, *args):
+    def save(self, *args, **kwargs):
         if not self.id:
             self.entered_at = datetime.now()
-        super(ReportDiagnosis, self).save(*args)
+        super(ReportDiagnosis, self).save(*args, **kwargs)
+
+    def snapshot(self, status):
+        """ fill the diagnosis columns of the case's CaseStatus """
+        info = self.get_dictionary()
+        status.diagnosis    = u"diag:%(diag)s labs:%(lab)s on %(date)s" % {'diag': info['diagnosis'],
+                                'lab': info['labs_text'], 'date': self.entered_at.strftime("%Y-%m-%d")}
+        status.diagnosis_at = self.entered_at
 
     def get_dictionary(self):
         extra = []
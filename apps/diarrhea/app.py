@@ -4,14 +4,16 @@
 import rapidsms
 from rapidsms.parsers.keyworder import Keyworder
 
-from django.db import models
 from django.utils.translation import ugettext as _
 
-from mctc.models.logs import MessageLog, log
-from mctc.models.general import Case
+from mctc.models.logs import log
+from mctc.logwriter import messagelog
+from mctc.caches import diarrhea_observations, cases, alert_recipients
+from mctc.reportwriter import file_report
+from mctc.models.status import CaseStatus
 from models import ReportDiarrhea
 
-import re, datetime
+import re
 
 find_diagnostic_re = re.compile('( -[\d\.]+)' ,re.I)
 find_lab_re =  re.compile('(/[A-Z]+)([\+-])(\d*:?)', re.I)
@@ -34,7 +36,7 @@ class App (rapidsms.app.App):
     keyword = Keyworder()
     def start (self):
         """Configure your app in the start phase."""
-        pass
+        messagelog.attach(self.router)
 
     def parse (self, message):        
         message.was_handled = False
@@ -64,11 +66,7 @@ class App (rapidsms.app.App):
 
     def cleanup (self, message):
         if message.was_handled:
-            log = MessageLog(mobile=message.peer,
-                         sent_by=message.persistant_connection.reporter,
-                         text=message.text,
-                         was_handled=message.was_handled)
-            log.save()
+            messagelog.write(message)
 
     def outgoing (self, message):
         """Handle outgoing message notifications."""
@@ -76,13 +74,29 @@ class App (rapidsms.app.App):
 
     def stop (self):
         """Perform global app cleanup when the application is stopped."""
-        pass
+        messagelog.flush(force=True)
 
     def find_case (self, ref_id):
-        try:
-            return Case.objects.get(ref_id=int(ref_id))
-        except Case.DoesNotExist:
+        case = cases.find(ref_id)
+        if case is None:
             raise HandlerFailed(_("Case +%s not found.") % ref_id)
+        return case
+
+    def get_diarrheaobservations(self, text):
+        choices  = diarrhea_observations.codes()
+        observed = []
+        if text:
+            text = re.sub(r'\W+', ' ', text).lower()
+            for observation in text.split(' '):
+                if not observation:
+                    continue
+                obj = choices.get(observation, None)
+                if not obj:
+                    if observation != 'n':
+                        raise HandlerFailed("Unknown observation code: %s" % observation)
+                else:
+                    observed.append(obj)
+        return observed, choices
 
     # DIARRHEA
     # follow up on diarrhea
@@ -98,9 +112,11 @@ class App (rapidsms.app.App):
         if is_ok:
             report.status   = ReportDiarrhea.HEALTHY_STATUS
             report.save()
+            CaseStatus.record(report)
         else:
             report.status   = ReportDiarrhea.SEVERE_STATUS
             report.save()
+            CaseStatus.record(report)
 
             info = report.case.get_dictionary()
             info.update(report.get_dictionary())
@@ -111,19 +127,14 @@ class App (rapidsms.app.App):
             message.respond("DIARRHEA> " + msg)
             
         
-        """
         if report.status in (report.MODERATE_STATUS,
                            report.SEVERE_STATUS,
                            report.DANGER_STATUS):
             alert = _("@%(username)s reports %(msg)s") % {"username":reporter.alias, "msg":msg}
-            recipients = [reporter]
-            for query in (Provider.objects.filter(alerts=True),
-                          Provider.objects.filter(clinic=provider.clinic)):
-                for recipient in query:
-                    if recipient in recipients: continue
-                    recipients.append(recipient)
+            for recipient in alert_recipients.recipients(location_id=case.location_id,
+                                                         reporter_id=reporter.id):
+                if recipient.mobile != message.peer:
                     message.forward(recipient.mobile, alert)
-        """      
         log(case, "diarrhea_fu_taken")
         return True
 
@@ -136,15 +147,12 @@ class App (rapidsms.app.App):
         days    = int(days)
 
         observed, choices = self.get_diarrheaobservations(complications)
-        self.delete_similar(case.reportdiarrhea_set)
 
         reporter = message.persistant_connection.reporter
         report = ReportDiarrhea(case=case, reporter=reporter, ors=ors, days=days)
-        report.save()
-        for obs in observed:
-            report.observed.add(obs)
-        report.diagnose()
-        report.save()
+        report.diagnose(observed)
+        # replaces today's report for this case, if any
+        file_report(report, links={"observed": observed})
 
         choice_term = dict(choices)
 
@@ -157,27 +165,13 @@ class App (rapidsms.app.App):
 
         message.respond("DIARRHEA> " + msg)
         
-        """
         if report.status in (report.MODERATE_STATUS,
                            report.SEVERE_STATUS,
                            report.DANGER_STATUS):
-            alert = _("@%(username)s reports %(msg)s") % {"username":provider.user.username, "msg":msg}
-            recipients = [provider]
-            for query in (Provider.objects.filter(alerts=True),
-                          Provider.objects.filter(clinic=provider.clinic)):
-                for recipient in query:
-                    if recipient in recipients: continue
-                    recipients.append(recipient)
+            alert = _("@%(username)s reports %(msg)s") % {"username":reporter.alias, "msg":msg}
+            for recipient in alert_recipients.recipients(location_id=case.location_id,
+                                                         reporter_id=reporter.id):
+                if recipient.mobile != message.peer:
                     message.forward(recipient.mobile, alert)
-        """
         log(case, "diarrhea_taken")
         return True            
-
-    def delete_similar(self, queryset):
-        try:
-            last_report = queryset.latest("entered_at")
-            if (datetime.datetime.now() - last_report.entered_at).days == 0:
-                # last report was today. so delete it before filing another.
-                last_report.delete()
-        except models.ObjectDoesNotExist:
-            pass
\ No newline at end of file
@@ -62,8 +62,11 @@ class ReportDiarrhea(models.Model):
     def __unicode__ (self):
         return "#%d" % self.id
 
-    def diagnose (self):
-        if self.days >= 3 or self.observed.all().count() > 0:
+    def diagnose (self, observed=None):
+        # observed can be passed in before the report is saved
+        if observed is None:
+            observed = self.observed.all()
+        if self.days >= 3 or len(observed) > 0:
             self.status = ReportDiarrhea.DANGER_STATUS
         else:
             self.status = ReportDiarrhea.MODERATE_STATUS
@@ -80,8 +83,14 @@ class ReportDiarrhea(models.Model):
    
         return msg
 
-    def save(self, *args):
+    def save(self, *args, **kwargs):
         if not self.id:
             self.entered_at = datetime.now()
-        super(ReportDiarrhea, self).save(*args)
+        super(ReportDiarrhea, self).save(*args, **kwargs)
+
+    def snapshot(self, status):
+        """ fill the ors columns of the case's CaseStatus """
+        status.diarrhea     = u"%(diag)s on %(date)s" % {'diag': self.diagnosis_msg(),
+                                                         'date': self.entered_at.strftime("%Y-%m-%d")}
+        status.diarrhea_at  = self.entered_at
         
@@ -7,6 +7,7 @@ from models import Facility, Provider, Patient
 from apps.tinystock.models import StoreProvider, KindOfItem, Item, StockItem
 from django.utils.translation import ugettext as _
 from rapidsms.parsers.keyworder import Keyworder
+from libdispatch.index import KeywordIndex
 from utils import *
 from datetime import datetime
 from apps.reporters.models import Reporter, Role, ReporterGroup
@@ -46,6 +47,7 @@ class App (rapidsms.app.App):
 
     def start (self):
         self.backend    = self._router.backends[-1]
+        self.dispatch   = KeywordIndex(self.keyword)
 
     def parse (self, message):
         """Parse and annotate messages in the parse phase."""
@@ -53,7 +55,7 @@ class App (rapidsms.app.App):
 
     def handle (self, message):
         try:
-            func, captures = self.keyword.match(self, message.text)
+            func, captures = self.dispatch.match(self, message.text)
         except TypeError:
             # didn't find a matching function
             message.respond(_(u"Error. Your message could not be recognized by the system. Please check syntax and retry."))
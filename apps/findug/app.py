@@ -5,6 +5,9 @@ from datetime import date as pydate, datetime
 
 import rapidsms
 from rapidsms.parsers.keyworder import * 
+from libdispatch.index import KeywordIndex
+# not apps.libdispatch.pool, the pool must be the one libdispatch.app starts
+from libdispatch.pool import pool, inline
 from django.utils.translation import ugettext as _
 
 from apps.reporters.models import *
@@ -96,16 +99,22 @@ class App (rapidsms.app.App):
 
     keyword = Keyworder()
 
+    # handlers may run on the libdispatch worker pool
+    thread_safe = True
+
     def start (self):
-        pass
+        self.dispatch = KeywordIndex(self.keyword)
 
     def handle (self, message):
         try:
-            func, captures = self.keyword.match(self, message.text)
+            func, captures = self.dispatch.match(self, message.text)
         except TypeError:
             # didn't find a matching function
             message.respond(_(u"Error. Your message could not be recognized by the system. Please check syntax and retry."))
             return False
+        return pool.handle(self, message, func, captures)
+
+    def call_handler (self, message, func, captures):
         try:
             handled = func(self, message, *captures)
         except HandlerFailed, e:
@@ -181,6 +190,7 @@ class App (rapidsms.app.App):
     # JOIN (ADMIN)
     keyword.prefix = ["join"]
     @keyword(r'\@(slug) (letters)\s?(\w*)')
+    @inline
     @registered
     @admin
     def join_one(self, message, reporter_alias, clinic_code):
@@ -261,6 +271,7 @@ class App (rapidsms.app.App):
     # STOP (ADMIN)
     keyword.prefix = ["stop", "pause"]
     @keyword(r'\@(slug)')
+    @inline
     @registered
     @admin
     def stop_one(self, message, reporter_alias):
@@ -312,6 +323,7 @@ class App (rapidsms.app.App):
     # BACK (ADMIN)
     keyword.prefix = ["back", "resume"]
     @keyword(r'\@(slug)')
+    @inline
     @registered
     @admin
     def back_one(self, message, reporter_alias):
@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 coding=utf-8
+
+import rapidsms
+
+from libdispatch.pool import pool
+from libdispatch.profile import stats
+
+class App(rapidsms.app.App):
+
+    def configure (self, workers=None, profile="true", profile_interval=None):
+        # size of the handle worker pool, see libdispatch.pool
+        pool.configure(workers)
+        # handler timings, see libdispatch.profile
+        self.profile = str(profile).lower() in ("true", "yes", "1")
+        stats.configure(interval=profile_interval)
+
+    def start (self):
+        pool.start()
+        if pool.running():
+            pool.attach(self.router)
+        if getattr(self, "profile", True):
+            stats.attach(self.router)
+
+    def stop (self):
+        pool.stop()
+        if getattr(self, "profile", True):
+            stats.dump()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 coding=utf-8
+
+''' KeywordIndex is a drop-in replacement for Keyworder.match
+
+    Keyworder.match tries every registered regex in turn, so an app with
+    20 keywords runs up to 20 regexen per message (and an unknown command
+    always runs all of them). KeywordIndex reads each pattern once and
+    files it under its leading keyword (join, muac, test, @, ...). At
+    match time only the patterns whose keyword starts the message are
+    tried, plus the few patterns without a usable keyword, in their
+    original order, so the first match is the one Keyworder would return.
+
+    usage:
+            def start (self):
+                self.dispatch = KeywordIndex(self.keyword)
+
+            def handle (self, message):
+                try:
+                    func, captures = self.dispatch.match(self, message.text)
+                except TypeError:
+                    # nothing matched
+'''
+
+import re
+
+from libdispatch.profile import matched
+
+# leading token of a message: a run of letters, or else its first char
+token_re    = re.compile(r'[a-z]+', re.I)
+
+# a keyword made of one escaped punctuation char, e.g. \@ or \+
+escaped_re  = re.compile(r'^\\([^a-zA-Z0-9\s])')
+
+def message_token(text):
+    ''' the token a message is looked up with '''
+    found = token_re.match(text)
+    if found:
+        return found.group(0).lower()
+    return text[:1]
+
+def toplevel_alternation(pattern):
+    ''' True if pattern has a | outside of any group or class '''
+    depth   = 0
+    inclass = False
+    escaped = False
+    for char in pattern:
+        if escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif inclass:
+            inclass = char != "]"
+        elif char == "[":
+            inclass = True
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "|" and depth == 0:
+            return True
+    return False
+
+def pattern_token(pattern):
+    ''' the keyword every text matched by pattern starts with,
+        or None if it can't be worked out safely '''
+    pattern = pattern.lstrip("^")
+    if toplevel_alternation(pattern):
+        return None
+
+    escaped = escaped_re.match(pattern)
+    if escaped:
+        return escaped.group(1)
+
+    found = token_re.match(pattern)
+    if not found:
+        return None
+    token = found.group(0)
+
+    # last letter is optional (notes?, colou?r, ...)
+    if pattern[len(token):][:1] in ("?", "*", "{"):
+        token = token[:-1]
+    return token.lower() or None
+
+class KeywordIndex(object):
+
+    def __init__(self, keyworder):
+        self.keyworder  = keyworder
+        self.build()
+
+    def build(self):
+        ''' (re)build the index from the keyworder's regexen '''
+        self.tokens     = {}
+        self.wildcards  = []
+        for position, (regex, func) in enumerate(self.keyworder.regexen):
+            token = pattern_token(regex.pattern)
+            if token is None:
+                self.wildcards.append((position, regex, func))
+            else:
+                self.tokens.setdefault(token, []).append((position, regex, func))
+
+        self.longest    = max([len(t) for t in self.tokens] or [0])
+        self.size       = len(self.keyworder.regexen)
+        # candidate lists, by the set of keywords a message starts with
+        self.merged     = {}
+
+    def lookup(self, text):
+        ''' the patterns worth trying on text, in registration order '''
+        # keywords registered after start()
+        if self.size != len(self.keyworder.regexen):
+            self.build()
+
+        token   = message_token(text)
+        found   = tuple([token[:i] for i in range(1, min(len(token), self.longest) + 1)
+                         if self.tokens.has_key(token[:i])])
+        try:
+            return self.merged[found]
+        except KeyError:
+            patterns = list(self.wildcards)
+            for keyword in found:
+                patterns.extend(self.tokens[keyword])
+            patterns.sort()
+            self.merged[found] = [(regex, func) for position, regex, func in patterns]
+            return self.merged[found]
+
+    def match(self, sself, text):
+        ''' same contract as Keyworder.match: (func, captures) or None '''
+        for regex, func in self.lookup(text):
+            match = regex.match(text)
+            if match:
+                # strip captures, like Keyworder does
+                groups = map(lambda x: x.strip() if x else x, match.groups())
+                matched(func)
+                return (func, groups)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 coding=utf-8
+
+''' Compare Keyworder.match with KeywordIndex.match
+
+    ./rapidsms bench_dispatch [--messages=10000]
+
+    Builds a mixed stream of messages (valid commands of the clinical,
+    FIND and drug tracking apps, typos and free text) and runs it through
+    each app's keyworder both ways. Both must return the same handler
+    for every message; the time and the number of regexen tried per
+    message are printed for each.
+'''
+
+import random
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from libdispatch.index import KeywordIndex
+
+APPS = (
+    ("mctc", "mctc.app"),
+    ("findug", "findug.app"),
+    ("drugtrack", "drugtrack.app"),
+)
+
+MESSAGES = (
+    # mctc
+    "join apple smith ken",
+    "confirm smithk",
+    "new madison molly f 150607 sally 230123",
+    "cancel +26",
+    "inactive +26 moved away",
+    "transfer +26 to jdoe",
+    "show +26",
+    "s +26",
+    "note +26 child seems to be recovering",
+    "@jdoe please call me",
+    # clinical apps that share the stream
+    "muac +26 105 d v f",
+    "mts +26 y n f",
+    "mtk 12",
+    "ors +26 y 2 v",
+    "d +91 -002 /hb+",
+    "measles +26 +34 +42",
+    "msummary",
+    # findug
+    "subscribe kis7 john doe",
+    "join kis7",
+    "stop",
+    "pause @jdoe",
+    "back",
+    "lookup kis doe",
+    "diseases ab12 ma3+1",
+    "test 12 3 4 5 6 7 8 9",
+    "treat 1 2 3 4 5 6",
+    "act 1 2 3 4 5 6 7 8 9 10",
+    "remarks all good",
+    "report",
+    # drugtrack
+    "dist @jdoe para 20",
+    "add para 100 paracetamol",
+    "cdist @jdoe para 10",
+    "disp doe jane f 3y kis7 2",
+    "stock @jdoe",
+    "stock",
+    # noise
+    "hello",
+    "*yawn*",
+    "jion apple smith ken",
+    "new patient",
+    "transfer 26",
+    "muac",
+    "what is the balance",
+    "",
+)
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("--messages", dest="messages", type="int", default=10000,
+                    help="number of messages to dispatch (default 10000)"),
+        make_option("--seed", dest="seed", type="int", default=0,
+                    help="random seed for the message mix"),
+    )
+    help = "Benchmark keyword dispatch with and without the first-token index."
+
+    def handle(self, *args, **options):
+        random.seed(options["seed"])
+        messages = [random.choice(MESSAGES) for i in range(options["messages"])]
+
+        print "%-10s %8s %12s %12s %12s %12s" % ("app", "patterns", "linear (s)", "indexed (s)", "linear/msg", "indexed/msg")
+        for name, module in APPS:
+            try:
+                app = __import__(module, fromlist=["App"]).App
+            except ImportError, e:
+                print "%-10s skipped (%s)" % (name, e)
+                continue
+            keyworder   = app.keyword
+            index       = KeywordIndex(keyworder)
+
+            # both must pick the same handler
+            for text in MESSAGES:
+                linear  = keyworder.match(None, text)
+                indexed = index.match(None, text)
+                if (linear and linear[0]) != (indexed and indexed[0]):
+                    raise CommandError("%s: %r dispatched differently" % (name, text))
+
+            linear_time     = self.timeit(keyworder.match, messages)
+            indexed_time    = self.timeit(index.match, messages)
+            linear_tries    = self.tries(keyworder.regexen, messages)
+            indexed_tries   = self.tries(index.lookup, messages)
+
+            print "%-10s %8d %12.4f %12.4f %12.2f %12.2f" % (name, len(keyworder.regexen),
+                linear_time, indexed_time, linear_tries, indexed_tries)
+
+    def timeit(self, match, messages):
+        start = time.time()
+        for text in messages:
+            match(None, text)
+        return time.time() - start
+
+    def tries(self, patterns, messages):
+        ''' average number of regexen tried before a match (or giving up) '''
+        total = 0
+        for text in messages:
+            if callable(patterns):
+                candidates = patterns(text)
+            else:
+                candidates = patterns
+            for regex, func in candidates:
+                total += 1
+                if regex.match(text):
+                    break
+        return float(total) / max(len(messages), 1)
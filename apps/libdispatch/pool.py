@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 coding=utf-8
+
+''' Worker pool for the handle phase of thread-safe apps
+
+    The router runs parse, handle and cleanup for every app one message
+    at a time, so a slow handler (a PDF report, a USSD call) holds up
+    every message behind it. Apps that declare `thread_safe = True` can
+    hand the matched handler to this pool instead of running it inline:
+    handle() then returns True at once and the handler runs on a worker
+    thread, which sends the responses itself.
+
+    A deferred handler has claimed the message: the apps after it never
+    see it, even if the handler returns False or raises (it is logged).
+    Handlers that may refuse a message (e.g. findug's admin commands)
+    are marked @inline and keep running in the router's thread.
+
+    Messages from the same peer are still handled one at a time and in
+    the order they came in (a peer's jobs all go to one queue, which one
+    worker at a time drains), so "new" is always done before the "muac"
+    that follows it. The router is attached too: a message whose peer
+    still has jobs waiting is queued behind them and dispatched by the
+    worker once they are done, so the apps that run inline (diarrhea,
+    measles, ...) see it after them as well. The router's thread goes on
+    with the other peers' messages meanwhile.
+
+    Once the handler ran, its result becomes the message's was_handled
+    and the app's cleanup() runs again for the message. The message log
+    (see mctc.logwriter) keeps the message's row until its jobs are done,
+    and records what the handler did rather than what the router saw
+    when the job was queued, whether cleanup() writes it again or not.
+
+    The pool is off unless the libdispatch app is configured with some
+    workers; it then runs the handlers of the apps that opted in.
+
+    rapidsms.ini:
+            [libdispatch]
+            workers=4
+
+    usage:
+            class App (rapidsms.app.App):
+                thread_safe = True
+
+                def handle (self, message):
+                    ...
+                    return pool.handle(self, message, func, captures)
+
+                def call_handler (self, message, func, captures):
+                    # what handle() used to do once func was found
+
+                @keyword(r'\@(slug)')
+                @inline
+                def stop_one (self, message, reporter_alias):
+                    # may return False, never deferred
+'''
+
+import copy
+import threading
+import traceback
+import Queue
+from collections import deque
+
+from django.db import connection
+
+def inline(func):
+    ''' mark a handler that may refuse the message, it is never deferred
+        to the pool '''
+    func.inline = True
+    return func
+
+class WorkerPool(object):
+
+    def __init__(self, workers=0):
+        self.workers    = workers
+        self.lock       = threading.Lock()
+        # notified when a peer has no job left
+        self.idle       = threading.Condition(self.lock)
+        # peer -> jobs waiting, as (function, args); a peer is here
+        # while a worker owns it
+        self.queues     = {}
+        # peers with jobs waiting, each at most once
+        self.ready      = Queue.Queue()
+        self.threads    = []
+        # the peer whose held message a worker is dispatching
+        self.current    = threading.local()
+
+    def configure(self, workers=None):
+        if workers is not None:
+            self.workers = int(workers)
+
+    def running(self):
+        return bool(self.threads)
+
+    def start(self):
+        if self.threads or self.workers < 1:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.work, name="handle-%d" % i)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def attach(self, router):
+        ''' queue each incoming message behind the jobs of its peer, if
+            any, whichever apps are going to handle it '''
+        incoming = router.incoming
+        if getattr(incoming, "ordered", False):
+            return
+        def ordered(message, *args, **kwargs):
+            if self.hold(message.peer, (self.dispatch, (router, incoming, message, args, kwargs))):
+                return
+            return incoming(message, *args, **kwargs)
+        ordered.ordered = True
+        router.incoming = ordered
+
+    def hold(self, peer, job):
+        ''' queue job if peer has jobs waiting or running. returns
+            whether it did '''
+        self.lock.acquire()
+        try:
+            if not self.queues.has_key(peer):
+                return False
+            self.queues[peer].append(job)
+            return True
+        finally:
+            self.lock.release()
+
+    def dispatch(self, router, incoming, message, args, kwargs):
+        ''' run the router over a held message, on the worker owning
+            its peer '''
+        self.current.peer = message.peer
+        try:
+            incoming(message, *args, **kwargs)
+        except Exception:
+            router.log("error", "could not dispatch '%s'\n%s" % (
+                message.text, traceback.format_exc()))
+        self.current.peer = None
+
+    def wait(self, peer):
+        ''' block until peer has no job waiting or running '''
+        self.lock.acquire()
+        try:
+            while self.queues.has_key(peer):
+                self.idle.wait()
+        finally:
+            self.lock.release()
+
+    def stop(self):
+        ''' finish the queued jobs, then stop the workers '''
+        threads, self.threads = self.threads, []
+        for thread in threads:
+            self.ready.put(None)
+        for thread in threads:
+            thread.join()
+
+    def handle(self, app, message, func, captures):
+        ''' run func for app, on a worker if both the pool and the app
+            allow it. returns what handle() should return '''
+        if not self.running() or not getattr(app, "thread_safe", False) or \
+                getattr(func, "inline", False):
+            return app.call_handler(message, func, captures)
+        if getattr(self.current, "peer", None) == message.peer:
+            # already on the worker owning the peer, in order
+            return app.call_handler(message, func, captures)
+
+        # the router sends the responses of the original message once
+        # all the apps are done with it, the copy sends its own
+        job = copy.copy(message)
+        job.responses = []
+        job.original = message
+        self.lock.acquire()
+        try:
+            # jobs still to run for the message, see mctc.logwriter
+            message.jobs = getattr(message, "jobs", 0) + 1
+        finally:
+            self.lock.release()
+        self.submit(message.peer, (self.run, (app, job, func, captures)))
+        return True
+
+    def submit(self, peer, job):
+        self.lock.acquire()
+        try:
+            if self.queues.has_key(peer):
+                self.queues[peer].append(job)
+            else:
+                self.queues[peer] = deque([job])
+                self.ready.put(peer)
+        finally:
+            self.lock.release()
+
+    def next_job(self, peer):
+        self.lock.acquire()
+        try:
+            jobs = self.queues[peer]
+            if jobs:
+                return jobs.popleft()
+            # done with this peer, the next message makes it ready again
+            del self.queues[peer]
+            self.idle.notifyAll()
+            return None
+        finally:
+            self.lock.release()
+
+    def work(self):
+        try:
+            while True:
+                peer = self.ready.get()
+                if peer is None:
+                    break
+                job = self.next_job(peer)
+                while job is not None:
+                    func, args = job
+                    func(*args)
+                    job = self.next_job(peer)
+        finally:
+            # django keeps one connection per thread
+            connection.close()
+
+    def run(self, app, message, func, captures):
+        handled = False
+        try:
+            handled = app.call_handler(message, func, captures)
+        except Exception:
+            app.log("error", "%s failed on '%s'\n%s" % (
+                func.__name__, message.text, traceback.format_exc()))
+        original = message.original
+        self.lock.acquire()
+        try:
+            original.jobs -= 1
+            if handled:
+                original.was_handled = True
+        finally:
+            self.lock.release()
+        if hasattr(app, "cleanup"):
+            try:
+                app.cleanup(original)
+            except Exception:
+                app.log("error", "cleanup failed on '%s'\n%s" % (
+                    message.text, traceback.format_exc()))
+        try:
+            message.flush_responses()
+        except Exception:
+            app.log("error", "could not send the responses to '%s'\n%s" % (
+                message.text, traceback.format_exc()))
+
+pool = WorkerPool()
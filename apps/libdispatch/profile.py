@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 coding=utf-8
+
+''' Time and SQL query count of every app's handle() and cleanup()
+
+    instrument() wraps the handle, call_handler (see libdispatch.pool)
+    and cleanup methods of a running app. Each call is filed under the
+    app, the phase and the keyword function the message matched (e.g.
+    mctc / handle / new_case), in a histogram of durations plus the
+    number of queries the call ran. The keyword function is noted by the
+    app's Keyworder (wrapped by instrument) or KeywordIndex as it
+    matches.
+
+    The router and the web server are different processes, so the router
+    writes the stats to a CSV file every `interval` seconds; the
+    /libdispatch/stats page (staff only) shows that file and serves it
+    for download.
+
+    rapidsms.ini:
+            [libdispatch]
+            profile=true
+            profile_interval=60
+
+    usage:
+            for app in router.apps:
+                instrument(app)
+            stats.dump()
+'''
+
+import csv
+import os
+import tempfile
+import threading
+import time
+
+from django.db import connection
+
+DUMP_FILE   = os.path.join(tempfile.gettempdir(), "rapidsms-handler-stats.csv")
+
+# upper bounds of the duration buckets, in seconds
+BUCKETS     = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+BUCKET_NAMES = ["<%gs" % b for b in BUCKETS] + [">=%gs" % BUCKETS[-1]]
+
+COLUMNS     = ["app", "phase", "keyword", "calls", "total_s", "mean_ms", "max_ms",
+               "queries", "queries_per_call", "max_queries"] + BUCKET_NAMES
+
+# queries run by the current thread, see CountingCursor
+counter     = threading.local()
+
+# keyword function the handle() running on this thread dispatched to
+current     = threading.local()
+
+def queries():
+    return getattr(counter, "queries", 0)
+
+class CountingCursor(object):
+    ''' counts the statements run, whatever settings.DEBUG says '''
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, *args, **kwargs):
+        counter.queries = queries() + 1
+        return self.cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        counter.queries = queries() + 1
+        return self.cursor.executemany(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+def count_queries():
+    ''' make every database cursor a CountingCursor, only once '''
+    wrapper = connection.__class__
+    if getattr(wrapper.cursor, "counting", False):
+        return
+    original = wrapper.cursor
+    def cursor(self):
+        return CountingCursor(original(self))
+    cursor.counting = True
+    wrapper.cursor = cursor
+
+class Entry(object):
+
+    def __init__(self):
+        self.calls          = 0
+        self.total          = 0.0
+        self.max            = 0.0
+        self.queries        = 0
+        self.max_queries    = 0
+        self.histogram      = [0] * (len(BUCKETS) + 1)
+
+    def add(self, seconds, queries):
+        self.calls          += 1
+        self.total          += seconds
+        self.max            = max(self.max, seconds)
+        self.queries        += queries
+        self.max_queries    = max(self.max_queries, queries)
+        for i, bound in enumerate(BUCKETS):
+            if seconds < bound:
+                break
+        else:
+            i = len(BUCKETS)
+        self.histogram[i] += 1
+
+    def row(self):
+        return [self.calls, "%.3f" % self.total,
+                "%.1f" % (self.total * 1000 / self.calls), "%.1f" % (self.max * 1000),
+                self.queries, "%.1f" % (float(self.queries) / self.calls),
+                self.max_queries] + self.histogram
+
+class HandlerStats(object):
+
+    def __init__(self, path=DUMP_FILE, interval=60):
+        self.lock       = threading.Lock()
+        self.path       = path
+        self.interval   = interval
+        self.entries    = {}
+        self.router     = None
+
+    def configure(self, path=None, interval=None):
+        if path:
+            self.path = path
+        if interval:
+            self.interval = int(interval)
+
+    def attach(self, router):
+        ''' instrument the router's apps and dump the stats regularly '''
+        if self.router is not None:
+            return
+        self.router = router
+        count_queries()
+        for app in router.apps:
+            instrument(app)
+        router.call_at(self.interval, self.periodic_dump)
+
+    def record(self, app, phase, keyword, seconds, queries):
+        key = (app, phase, keyword)
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key, None)
+            if entry is None:
+                entry = self.entries[key] = Entry()
+            entry.add(seconds, queries)
+        finally:
+            self.lock.release()
+
+    def rows(self):
+        ''' one row per app, phase and keyword, the slowest first '''
+        self.lock.acquire()
+        try:
+            items = self.entries.items()
+            rows = [list(key) + entry.row() for key, entry in items]
+        finally:
+            self.lock.release()
+        rows.sort(key=lambda row: -float(row[4]))
+        return rows
+
+    def write_csv(self, out):
+        writer = csv.writer(out)
+        writer.writerow(COLUMNS)
+        writer.writerows(self.rows())
+
+    def dump(self):
+        # written aside then renamed, the web server never reads half a file
+        temp = self.path + ".tmp"
+        out = open(temp, "wb")
+        try:
+            self.write_csv(out)
+        finally:
+            out.close()
+        os.rename(temp, self.path)
+
+    def periodic_dump(self):
+        self.dump()
+        return self.interval
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+        finally:
+            self.lock.release()
+
+stats = HandlerStats()
+
+def read_dump(path=DUMP_FILE):
+    ''' (columns, rows) of the last dump, for the web views '''
+    if not os.path.exists(path):
+        return COLUMNS, []
+    dump = open(path, "rb")
+    try:
+        rows = list(csv.reader(dump))
+    finally:
+        dump.close()
+    if not rows:
+        return COLUMNS, []
+    return rows[0], rows[1:]
+
+def matched(func):
+    ''' note that the running handle() dispatches to func, called by
+        the Keyworder or KeywordIndex that matched it '''
+    current.keyword = func.__name__
+
+def noting(match):
+    ''' Keyworder.match, noting the function it matched '''
+    def wrapper(*args):
+        found = match(*args)
+        if found:
+            matched(found[0])
+        return found
+    wrapper.noting = True
+    return wrapper
+
+def keyword_of(app):
+    ''' name of the keyword function the handle() that just returned
+        dispatched to. apps without keywords do not say '''
+    keyword = getattr(current, "keyword", None)
+    current.keyword = None
+    if keyword is not None:
+        return keyword
+    if hasattr(app, "call_handler") or hasattr(getattr(app, "keyword", None), "match"):
+        return "(unmatched)"
+    return "-"
+
+def app_name(app):
+    # findug.app or apps.findug.app -> findug
+    parts = app.__class__.__module__.split(".")
+    if len(parts) > 1:
+        return parts[-2]
+    return parts[0]
+
+def timed(app, phase, method, keyword):
+    name = app_name(app)
+    def wrapper(*args):
+        before  = queries()
+        start   = time.time()
+        try:
+            return method(*args)
+        finally:
+            stats.record(name, phase, keyword(args), time.time() - start,
+                         queries() - before)
+    wrapper.instrumented = True
+    return wrapper
+
+def instrument(app):
+    ''' wrap the handle/call_handler/cleanup methods of one app '''
+    handle = getattr(app, "handle", None)
+    if handle is None or getattr(handle, "instrumented", False):
+        return
+    # shared by the instances of the app's class, wrapped once
+    keyword = getattr(app, "keyword", None)
+    if hasattr(keyword, "match") and not getattr(keyword.match, "noting", False):
+        keyword.match = noting(keyword.match)
+    app.handle = timed(app, "handle", handle,
+                       lambda args: keyword_of(app))
+    if hasattr(app, "call_handler"):
+        # args are message, func, captures
+        app.call_handler = timed(app, "call_handler", app.call_handler,
+                                 lambda args: args[1].__name__)
+    if hasattr(app, "cleanup"):
+        app.cleanup = timed(app, "cleanup", app.cleanup,
+                            lambda args: "-")
@@ -0,0 +1,345 @@
+import threading
+import time
+import unittest
+
+from rapidsms.parsers.keyworder import Keyworder
+
+from libdispatch.index import KeywordIndex, pattern_token, message_token
+from libdispatch.pool import WorkerPool, inline
+from libdispatch.profile import CountingCursor, HandlerStats, queries, instrument, stats
+
+class TestPatternToken(unittest.TestCase):
+
+    def testKeyword(self):
+        self.assertEqual(pattern_token(r"^join\s+(\w+)$"), "join")
+        self.assertEqual(pattern_token(r"^MUAC\s+\+(\d+)$"), "muac")
+        # optional last letter
+        self.assertEqual(pattern_token(r"^notes?\s+(.+)$"), "note")
+        self.assertEqual(pattern_token(r"^\@(\w+)\s+(.+)$"), "@")
+
+    def testWildcards(self):
+        # no keyword every match starts with
+        self.assertEqual(pattern_token(r"^(.+)$"), None)
+        self.assertEqual(pattern_token(r"^(\d+)\s+(.+)$"), None)
+        self.assertEqual(pattern_token(r"^join|leave$"), None)
+        self.assertEqual(pattern_token(r"^x?$"), None)
+        # an alternation inside a group is fine
+        self.assertEqual(pattern_token(r"^cancel\s+(a|b)$"), "cancel")
+
+    def testMessageToken(self):
+        self.assertEqual(message_token("MUAC +26 105"), "muac")
+        self.assertEqual(message_token("@jdoe hi"), "@")
+        self.assertEqual(message_token(""), "")
+
+class TestKeywordIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.keyword = keyword = Keyworder()
+        def join(*args): pass
+        def note(*args): pass
+        def anything(*args): pass
+        def direct(*args): pass
+        keyword("join (letters)")(join)
+        keyword("notes? (whatever)")(note)
+        keyword("(numbers) (whatever)")(anything)
+        keyword("\@(slug) (whatever)")(direct)
+        self.index = KeywordIndex(keyword)
+
+    def same(self, text):
+        expected = self.keyword.match(None, text)
+        found = self.index.match(None, text)
+        self.assertEqual(found, expected)
+        return found and found[0].__name__
+
+    def testSameAsKeyworder(self):
+        self.assertEqual(self.same("join smith"), "join")
+        self.assertEqual(self.same("NOTE +26 better"), "note")
+        self.assertEqual(self.same("notes +26 better"), "note")
+        self.assertEqual(self.same("26 what"), "anything")
+        self.assertEqual(self.same("@jdoe call me"), "direct")
+        self.assertEqual(self.same("*yawn*"), None)
+
+    def testWildcardsKeepOrder(self):
+        # a wildcard registered before a keyword still wins
+        keyword = Keyworder()
+        def first(*args): pass
+        def second(*args): pass
+        keyword("(whatever)")(first)
+        keyword("join (letters)")(second)
+        index = KeywordIndex(keyword)
+        self.assertEqual(index.match(None, "join smith")[0], first)
+
+    def testRebuild(self):
+        def later(*args): pass
+        self.assertEqual(self.same("later on"), None)
+        # registered after the index was built
+        self.keyword("later (whatever)")(later)
+        self.assertEqual(self.same("later on"), "later")
+        self.assertEqual(self.index.size, len(self.keyword.regexen))
+
+class FakeMessage:
+    def __init__(self, peer, text):
+        self.peer           = peer
+        self.text           = text
+        self.responses      = []
+        self.was_handled    = False
+        self.sent           = []
+
+    def respond(self, text):
+        self.responses.append(text)
+
+    def flush_responses(self):
+        self.sent.extend(self.responses)
+        self.responses = []
+
+class FakeApp:
+    thread_safe = True
+
+    def __init__(self):
+        self.done       = []
+        self.cleaned    = []
+        self.errors     = []
+
+    def call_handler(self, message, func, captures):
+        return func(self, message, *captures)
+
+    def cleanup(self, message):
+        self.cleaned.append((message.text, message.was_handled))
+
+    def log(self, level, text):
+        self.errors.append(text)
+
+def slow(app, message):
+    time.sleep(0.2)
+    app.done.append(message.text)
+    message.respond("slow done")
+    return True
+
+def fast(app, message):
+    app.done.append(message.text)
+    return True
+
+def failing(app, message):
+    raise ValueError("broken")
+
+def refusing(app, message):
+    return False
+
+class FakeRouter:
+    def __init__(self, app):
+        self.app = app
+
+    def incoming(self, message):
+        # an app handling inline
+        self.app.done.append("inline " + message.text)
+
+class TestWorkerPool(unittest.TestCase):
+
+    def setUp(self):
+        self.app = FakeApp()
+        self.pool = WorkerPool(workers=3)
+        self.pool.start()
+
+    def tearDown(self):
+        self.pool.stop()
+
+    def testPeerOrder(self):
+        first = FakeMessage("123", "new")
+        self.assertEqual(self.pool.handle(self.app, first, slow, ()), True)
+        self.pool.handle(self.app, FakeMessage("123", "muac"), fast, ())
+        # another peer does not wait
+        self.pool.handle(self.app, FakeMessage("456", "other"), fast, ())
+        self.pool.wait("123")
+        self.assertEqual(self.app.done, ["other", "new", "muac"])
+        # the job sent its own responses, not the router's message
+        self.assertEqual(first.responses, [])
+
+    def testRouterHolds(self):
+        router = FakeRouter(self.app)
+        self.pool.attach(router)
+        self.pool.attach(router)
+        self.pool.handle(self.app, FakeMessage("123", "new"), slow, ())
+        # queued behind the peer's job, the router goes on at once
+        router.incoming(FakeMessage("123", "ors"))
+        router.incoming(FakeMessage("456", "other"))
+        self.assertEqual(self.app.done, ["inline other"])
+        self.pool.wait("123")
+        self.assertEqual(self.app.done, ["inline other", "new", "inline ors"])
+
+    def testHeldOrder(self):
+        app = self.app
+        class Router(FakeRouter):
+            def incoming(self, message):
+                # a thread-safe app, then one handling inline
+                app.pool.handle(app, message, fast, ())
+                app.done.append("inline " + message.text)
+        app.pool = self.pool
+        router = Router(app)
+        self.pool.attach(router)
+        self.pool.handle(app, FakeMessage("123", "new"), slow, ())
+        router.incoming(FakeMessage("123", "muac"))
+        router.incoming(FakeMessage("123", "ors"))
+        self.pool.wait("123")
+        self.assertEqual(app.done, ["new", "muac", "inline muac", "ors", "inline ors"])
+
+    def testInlineHandler(self):
+        @inline
+        def admin(app, message):
+            return False
+        message = FakeMessage("123", "stop")
+        # may refuse, the next apps get their turn
+        self.assertEqual(self.pool.handle(self.app, message, admin, ()), False)
+        self.assertEqual(getattr(message, "jobs", 0), 0)
+
+    def testWasHandled(self):
+        message = FakeMessage("123", "muac")
+        self.pool.handle(self.app, message, refusing, ())
+        # not decided until the handler ran
+        self.assertEqual(message.was_handled, False)
+        self.pool.wait("123")
+        self.assertEqual(message.was_handled, False)
+        self.assertEqual(message.jobs, 0)
+        self.assertEqual(self.app.cleaned, [("muac", False)])
+
+        message = FakeMessage("123", "muac")
+        self.pool.handle(self.app, message, fast, ())
+        self.pool.wait("123")
+        self.assertEqual(message.was_handled, True)
+        self.assertEqual(self.app.cleaned[-1], ("muac", True))
+
+    def testFailingHandler(self):
+        broken = FakeMessage("123", "new")
+        self.pool.handle(self.app, broken, failing, ())
+        self.pool.handle(self.app, FakeMessage("123", "muac"), fast, ())
+        self.pool.wait("123")
+        # logged, the peer's next message still handled
+        self.assertEqual(len(self.app.errors), 1)
+        self.assert_("failing failed on 'new'" in self.app.errors[0])
+        self.assertEqual(self.app.done, ["muac"])
+        self.assertEqual(broken.was_handled, False)
+        self.assertEqual(broken.jobs, 0)
+
+    def testInline(self):
+        pool = WorkerPool()
+        message = FakeMessage("123", "new")
+        self.assertEqual(pool.handle(self.app, message, fast, ()), True)
+        self.assertEqual(self.app.done, ["new"])
+        self.assertEqual(self.app.cleaned, [])
+
+class FakeCursor:
+    def __init__(self):
+        self.rows = [(1,), (2,)]
+
+    def execute(self, sql, params=()):
+        pass
+
+    def executemany(self, sql, rows):
+        pass
+
+    def fetchall(self):
+        return self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+class TestCountingCursor(unittest.TestCase):
+
+    def testCount(self):
+        cursor = CountingCursor(FakeCursor())
+        before = queries()
+        cursor.execute("SELECT 1")
+        # one statement, whatever the number of rows
+        cursor.executemany("INSERT", [(1,), (2,), (3,)])
+        self.assertEqual(queries() - before, 2)
+        # the rest goes to the real cursor
+        self.assertEqual(cursor.fetchall(), [(1,), (2,)])
+        self.assertEqual(list(cursor), [(1,), (2,)])
+
+    def testPerThread(self):
+        cursor = CountingCursor(FakeCursor())
+        before = queries()
+        thread = threading.Thread(target=cursor.execute, args=("SELECT 1",))
+        thread.start()
+        thread.join()
+        self.assertEqual(queries(), before)
+
+class TestHandlerStats(unittest.TestCase):
+
+    def testAggregate(self):
+        handler_stats = HandlerStats(interval=60)
+        handler_stats.record("mctc", "handle", "new_case", 0.02, 3)
+        handler_stats.record("mctc", "handle", "new_case", 0.3, 5)
+        handler_stats.record("mctc", "handle", "join", 0.001, 1)
+        rows = handler_stats.rows()
+        # the slowest first
+        self.assertEqual([row[:3] for row in rows],
+                         [["mctc", "handle", "new_case"], ["mctc", "handle", "join"]])
+        new_case = rows[0]
+        self.assertEqual(new_case[3], 2)
+        self.assertEqual(new_case[4], "0.320")
+        self.assertEqual(new_case[7:10], [8, "4.0", 5])
+        # one call under 0.05s, one under 0.5s
+        self.assertEqual(new_case[10:], [0, 1, 0, 0, 1, 0, 0, 0, 0])
+
+class KeywordApp(FakeApp):
+    thread_safe = False
+    keyword = Keyworder()
+
+    def __init__(self, pool):
+        FakeApp.__init__(self)
+        self.pool = pool
+
+    def handle(self, message):
+        try:
+            func, captures = self.keyword.match(self, message.text)
+        except TypeError:
+            return False
+        return self.pool.handle(self, message, func, captures)
+
+    @keyword("new")
+    def new_case(self, message):
+        return fast(self, message)
+
+class BoardApp:
+    # handles inline, without call_handler (e.g. billboard)
+    keyword = Keyworder()
+
+    def handle(self, message):
+        try:
+            func, captures = self.keyword.match(self, message.text)
+        except TypeError:
+            return False
+        return func(self, message, *captures)
+
+    @keyword("board (\w+)")
+    def board(self, message, name):
+        return True
+
+class TestInstrument(unittest.TestCase):
+
+    def setUp(self):
+        stats.reset()
+
+    def keywords(self):
+        return sorted([tuple(row[1:4]) for row in stats.rows()])
+
+    def testKeywords(self):
+        app = KeywordApp(WorkerPool())
+        instrument(app)
+        instrument(app)
+        app.handle(FakeMessage("123", "new"))
+        app.handle(FakeMessage("123", "*yawn*"))
+        app.handle(FakeMessage("123", "new"))
+        # the keyword comes from the function the Keyworder matched
+        self.assertEqual(self.keywords(), [("call_handler", "new_case", 2),
+                                           ("handle", "(unmatched)", 1),
+                                           ("handle", "new_case", 2)])
+
+    def testInlineKeywords(self):
+        app = BoardApp()
+        instrument(app)
+        instrument(BoardApp())
+        app.handle(FakeMessage("123", "board members"))
+        app.handle(FakeMessage("123", "*yawn*"))
+        self.assertEqual(self.keywords(), [("handle", "(unmatched)", 1),
+                                           ("handle", "board", 1)])
@@ -0,0 +1,10 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+from django.conf.urls.defaults import *
+import libdispatch.views as views
+
+urlpatterns = patterns('',
+    url(r'^libdispatch/stats/?$', views.handler_stats),
+    url(r'^libdispatch/stats\.csv$', views.handler_stats_csv),
+)
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+import os
+from datetime import datetime
+
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import HttpResponse
+from django.shortcuts import render_to_response
+from django.template import RequestContext
+
+from libdispatch.profile import stats, read_dump
+
+@staff_member_required
+def handler_stats(req):
+    ''' handler timings, as last written by the router '''
+    columns, rows = read_dump(stats.path)
+    updated = None
+    if os.path.exists(stats.path):
+        updated = datetime.fromtimestamp(os.stat(stats.path).st_mtime)
+    return render_to_response("libdispatch/stats.html", {
+            "title": "Handler statistics",
+            "columns": columns,
+            "rows": rows,
+            "updated": updated,
+        }, context_instance=RequestContext(req))
+
+@staff_member_required
+def handler_stats_csv(req):
+    response = HttpResponse(mimetype='text/csv')
+    response['Content-Disposition'] = "attachment; filename=handler-stats.csv"
+    if os.path.exists(stats.path):
+        dump = open(stats.path, "rb")
+        try:
+            response.write(dump.read())
+        finally:
+            dump.close()
+    return response
@@ -1,11 +1,11 @@
 import os
 from datetime import datetime
-from django.template import Template, Context
 from django.http import HttpResponse, HttpResponseRedirect
 
 import os
 import csv
-import StringIO
+
+from libreport.columns import compile_fields
 
 ''' CSVReport Is a class that create raw CSV reports
  
@@ -15,8 +15,75 @@ import StringIO
             csvrpt.setTableData(queryset, fields, "Table Title")
             csvrpt.setFilename("filename")
             csvrpt.render()
+
+    render() streams the rows to the client as the querysets are read,
+    see csv_response.
 '''
 
+# bytes of csv sent to the client at once
+CHUNK_SIZE  = 16 * 1024
+
+class RowBuffer(object):
+    ''' the file csv.writer writes to, emptied by take() '''
+
+    def __init__(self):
+        self.lines = []
+        self.size  = 0
+
+    def write(self, line):
+        self.lines.append(line)
+        self.size += len(line)
+
+    def take(self):
+        data = "".join(self.lines)
+        self.lines = []
+        self.size  = 0
+        return data
+
+def encode(value):
+    # the csv module does not write unicode
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+def csv_rows(rows):
+    ''' the csv text of rows (lists of values), a chunk at a time '''
+    buffer = RowBuffer()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([encode(value) for value in row])
+        if buffer.size >= CHUNK_SIZE:
+            yield buffer.take()
+    yield buffer.take()
+
+def server_side(queryset):
+    ''' the rows of queryset, without the queryset caching all of them '''
+    if hasattr(queryset, "iterator"):
+        return queryset.iterator()
+    return queryset
+
+def table_rows(queryset, fields):
+    ''' the heading and the rendered rows of a table, nothing if there
+        are no rows '''
+    render = compile_fields(fields)
+    header = False
+    for row in server_side(queryset):
+        if not header:
+            yield [f["name"] for f in fields]
+            header = True
+        yield render(row)
+
+def csv_response(rows, filename):
+    ''' a csv attachment sending rows as they are produced, in bounded
+        memory. the response is marked streaming, see
+        mctc.reportcache.cached_report '''
+    response = HttpResponse(csv_rows(rows), mimetype='text/csv')
+    response['Cache-Control'] = ""
+    response['Content-Disposition'] = "attachment; filename=%s" % filename
+    response.streaming = True
+    return response
+
+
 class CSVReport():
     title = "Report"
     filename = "report"
@@ -31,8 +98,7 @@ class CSVReport():
     fontSize = None
 
     def __init__(self):
-        self.output = StringIO.StringIO()
-        self.csvio  = csv.writer(self.output)
+        # tables as (queryset, fields), and page breaks
         self.data   = []
     
     # compatibility with PDFReport
@@ -56,36 +122,23 @@ class CSVReport():
             
     # force a page break 
     def setPageBreak(self):
-        self.data.append("")
+        self.data.append(None)
          
-    # set table data
+    # set table data, read when rendering
     # @var queryset: data
     # @var fields: table column headings
     # @var title: Table Heading
     def setTableData(self, queryset, fields, title):        
+        self.data.append((queryset, fields))
 
-        header = False
-        
-        for row in queryset:
-            if not header:
-                self.data.append([f["name"] for f in fields])
-                header = True
-            ctx = Context({"object": row })
-            values = [ Template(h["bit"]).render(ctx) for h in fields ]
-            self.data.append(values)
-
+    def rows(self):
+        for table in self.data:
+            if table is None:
+                yield []
+            else:
+                for row in table_rows(*table):
+                    yield row
         
     def render(self):
-            
         filename = self.filename + datetime.now().strftime("%Y%m%d%H%M%S") + ".csv"
-                
-        for data in self.data:
-            self.csvio.writerow(data)
-        
-        response = HttpResponse(mimetype='text/csv')
-        response['Cache-Control'] = ""
-        response['Content-Disposition'] = "attachment; filename=%s" % filename
-        response.write(self.output.getvalue())
-        return response
-        
-  
+        return csv_response(self.rows(), filename)
@@ -1,13 +1,18 @@
 #!/usr/bin/env python
 # vim: ai ts=4 sts=4 et sw=4
 
-import os
+import sys
+import threading
+import StringIO
 from datetime import datetime
+from tempfile import SpooledTemporaryFile
 import copy
 
-from django.template import Template, Context
+from django.conf import settings
 from django.http import HttpResponse, HttpResponseRedirect
 
+from libreport.columns import compile_fields
+
 try:
     from reportlab.lib.styles import getSampleStyleSheet
     from reportlab.platypus import BaseDocTemplate, PageTemplate, SimpleDocTemplate, Paragraph, Spacer, PageBreak, CondPageBreak, Frame, FrameBreak, NextPageTemplate
@@ -22,6 +27,104 @@ try:
 except ImportError:
     pass
 
+# the sections of a report are laid out in parallel only when the
+# pages can be put together again
+try:
+    import multiprocessing
+    from pyPdf import PdfFileReader, PdfFileWriter
+except ImportError:
+    multiprocessing = None
+
+# a document bigger than this is spooled to a temporary file, smaller
+# ones stay in memory
+SPOOL_SIZE  = 4 * 1024 * 1024
+# bytes sent to the client at once
+CHUNK_SIZE  = 64 * 1024
+
+# called as hook(report, bytes held), see PDFReport.held
+memory_hooks = []
+
+# in PDFReport.data, between the tables
+PAGE_BREAK  = "pagebreak"
+
+# worker processes laying out the sections of the reports, see
+# section_pool
+pool        = None
+pool_lock   = threading.Lock()
+
+def section_workers():
+    """ the number of worker processes, from settings.PDF_WORKERS
+        (default: one per core). 1 or less builds every report in the
+        web process """
+    if multiprocessing is None:
+        return 1
+    workers = getattr(settings, "PDF_WORKERS", None)
+    if workers is None:
+        return multiprocessing.cpu_count()
+    return int(workers)
+
+def section_pool():
+    """ the pool of worker processes, started on first use """
+    global pool
+    pool_lock.acquire()
+    try:
+        if pool is None:
+            pool = multiprocessing.Pool(section_workers())
+        return pool
+    finally:
+        pool_lock.release()
+
+def render_section(state):
+    """ the pdf of a part of a report, from PDFReport.state(). runs in a
+        worker process """
+    report = PDFReport()
+    report.__dict__.update(state)
+    output = StringIO.StringIO()
+    report.build(output)
+    return output.getvalue()
+
+def make_table(data, hasfooter, fontSize):
+    """ the flowable of a table of PDFReport.data """
+    table = PDFTable(data,None,None,None,1)
+    #table rows n cols formatting
+    ts = [
+        ('ALIGNMENT', (0,0), (-1,-1), 'LEFT'),
+        ('LINEBELOW', (0,0), (-1,-0), 2, colors.black),            
+        ('LINEBELOW', (0,1), (-1,-1), 0.8, colors.lightgrey),
+        ('FONT', (0,0), (-1, -1), "Times-Roman", fontSize),
+        ('ROWBACKGROUNDS', (0,0), (-1, -1), [colors.whitesmoke, colors.white]),    
+        ('LEFTPADDING', (0,0), (-1, -1), 1),
+        ('RIGHTPADDING', (0,0), (-1, -1), 1),
+        ('TOPPADDING', (0,0), (-1, -1), 1),
+        ('BOTTOMPADDING', (0,0), (-1, -1), 1),        
+    ]
+    
+    #last row formatting when required
+    if hasfooter is True:
+        ts.append(('LINEABOVE', (0,-1), (-1,-1), 1, colors.black))
+        ts.append(('LINEBELOW', (0,-1), (-1,-1), 2, colors.black))
+        ts.append(('LINEBELOW', (0,3), (-0,-0), 2, colors.green))             
+        ts.append(('LINEBELOW', (0,-1), (-1,-1), 0.8, colors.lightgrey))
+        ts.append(('FONT', (0,-1), (-1, -1), "Times-Roman", 7))
+        
+    table.setStyle(TableStyle(ts))
+
+    table.hAlign = "LEFT"
+    return table
+
+def file_chunks(data):
+    """ the content of data from the start, a chunk at a time, then
+        closes it """
+    try:
+        data.seek(0)
+        while True:
+            chunk = data.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        data.close()
+
 class PDFReport():
     ''' 
     PDFReport Is a class that create table format reports
@@ -34,21 +137,43 @@ class PDFReport():
             pdfrpt.setFilename("filename")
             pdfrpt.setNumOfColumns(2) # for two column setup
             pdfrpt.render()
+
+    When the tables are separated by page breaks (e.g. one clinic per
+    page) and there are several cores, each part is laid out in a worker
+    process and the pages are put together in order, see section_pool.
+
+    Every report keeps its own tables, headers and styles. held() is an
+    estimate of the bytes of table data it holds; the functions in
+    memory_hooks (e.g. of a benchmark) are called as hook(report, bytes)
+    after every table and once the document is built.
     '''
     title = u"Report"
     pageinfo = ""
     filename = "report"
-    styles = getSampleStyleSheet()
-    data = []
     landscape = False
     hasfooter = False
-    headers = []
     cols = 1
     PAGESIZE = A4
     fontSize = 8
+    titlepage = True
     
     def __init__(self):
-        self.headers.append("")
+        # per report, a web process builds many of them
+        self.styles = getSampleStyleSheet()
+        self.data = []
+        self.headers = [""]
+        # the page headings of each table of data, see split
+        self.table_headers = []
+        self.bytes = 0
+
+    def held(self):
+        """ the bytes of the rendered cells this report holds, about """
+        return self.bytes
+
+    def account(self, bytes):
+        self.bytes += bytes
+        for hook in memory_hooks:
+            hook(self, self.bytes)
     
     def setLandscape(self, state):
         """ enable or disable landscape display
@@ -92,53 +217,36 @@ class PDFReport():
      
     def setPageBreak(self):
         """ force/add a page break """
-        self.data.append(PageBreak())
+        self.data.append(PAGE_BREAK)
         
     def setTableData(self, queryset, fields, title):        
         """
         set table data
-        @var queryset: data
+        @var queryset: data, any iterable (e.g. a generator)
         @var fields: table column headings
         @var title: Table Heading
     """
         data = []
         header = False
-        c = 0;
+        rows = 0
+        # the bits are compiled once for the whole table
+        render = compile_fields(fields)
+        held = 0
         #prepare the data
         for row in queryset:
             if not header:
                 data.append([f["name"] for f in fields])
                 header = True
-            ctx = Context({"object": row })
-            values = [ Template(h["bit"]).render(ctx) for h in fields ]
+            values = render(row)
+            held += sys.getsizeof(values) + sum([sys.getsizeof(v) for v in values])
             data.append(values)
+            rows += 1
+        if not rows:
+            return
+        self.account(held)
         
-        table = PDFTable(data,None,None,None,1)
-        #table rows n cols formatting
-        ts = [
-            ('ALIGNMENT', (0,0), (-1,-1), 'LEFT'),
-            ('LINEBELOW', (0,0), (-1,-0), 2, colors.black),            
-            ('LINEBELOW', (0,1), (-1,-1), 0.8, colors.lightgrey),
-            ('FONT', (0,0), (-1, -1), "Times-Roman", self.fontSize),
-            ('ROWBACKGROUNDS', (0,0), (-1, -1), [colors.whitesmoke, colors.white]),    
-            ('LEFTPADDING', (0,0), (-1, -1), 1),
-            ('RIGHTPADDING', (0,0), (-1, -1), 1),
-            ('TOPPADDING', (0,0), (-1, -1), 1),
-            ('BOTTOMPADDING', (0,0), (-1, -1), 1),        
-        ]
-        
-        #last row formatting when required
-        if self.hasfooter is True:
-            ts.append(('LINEABOVE', (0,-1), (-1,-1), 1, colors.black))
-            ts.append(('LINEBELOW', (0,-1), (-1,-1), 2, colors.black))
-            ts.append(('LINEBELOW', (0,3), (-0,-0), 2, colors.green))             
-            ts.append(('LINEBELOW', (0,-1), (-1,-1), 0.8, colors.lightgrey))
-            ts.append(('FONT', (0,-1), (-1, -1), "Times-Roman", 7))
-            
-        table.setStyle(TableStyle(ts))
-
-        table.hAlign = "LEFT"
-        self.data.append(table)
+        # the table is made when the document is built, see make_table
+        self.data.append((data, self.hasfooter, self.fontSize))
         
         """
             The number of rows per page for two columns is about 90.
@@ -146,15 +254,35 @@ class PDFReport():
             table is going to overlap hence you place a header/subtitle
             in that position for it to be printed appropriately
         """
-        c = len(queryset)/90
-            
-        if int(c)< c:
-           c = int(c) + 1
-               
-           for i in range(c):
-               self.headers.append(title)
+        headings = [title] * ((rows + 89) // 90)
+        self.headers.extend(headings)
+        self.table_headers.append(headings)
+
+    def split(self):
+        """ the tables between the page breaks, with the headings of
+            their pages: [(tables, headings)] """
+        parts = [([], [])]
+        headings = iter(self.table_headers)
+        for item in self.data:
+            if item == PAGE_BREAK:
+                parts.append(([], []))
+            else:
+                parts[-1][0].append(item)
+                parts[-1][1].extend(headings.next())
+        return [part for part in parts if part[0]]
+
+    def sections(self):
+        """ the tables between the page breaks """
+        return [tables for tables, headings in self.split()]
+
+    def state(self):
+        """ what render_section needs to build a part of this report,
+            but its tables and page headings """
+        return {"title": self.title, "pageinfo": self.pageinfo, "landscape": self.landscape,
+                "cols": self.cols, "fontSize": self.fontSize}
         
-    def render(self):
+    def build(self, output):
+        """ lay the report out as pdf into output, a file """
         elements = []
         
         self.styles['Title'].alignment = TA_LEFT
@@ -163,32 +291,69 @@ class PDFReport():
         self.styles["Normal"].fontSize = 7
         #self.styles["Normal"].fontWeight = "BOLD"
             
-        filename = self.filename + datetime.now().strftime("%Y%m%d%H%M%S") + ".pdf"
-        #doc = SimpleDocTemplate(filename)
-                     
         #now create the title page
-        elements.append(Paragraph(self.title, self.styles['Title']))
-        
-        #done with the title info, move to the next frame and queue up the later page template
-        elements.append(FrameBreak())        
-        elements.append(NextPageTemplate("laterPages"))
-        elements.append(PageBreak())
+        if self.titlepage:
+            elements.append(Paragraph(self.title, self.styles['Title']))
+            
+            #done with the title info, move to the next frame and queue up the later page template
+            elements.append(FrameBreak())        
+            elements.append(NextPageTemplate("laterPages"))
+            elements.append(PageBreak())
         
         for data in self.data:
-            elements.append(data)        
+            if data == PAGE_BREAK:
+                elements.append(PageBreak())
+            else:
+                elements.append(make_table(*data))
         
         if self.landscape is True:
             self.PAGESIZE = landscape(A4)
-        doc = MultiColDocTemplate(filename, self.cols, pagesize=self.PAGESIZE, allowSplitting=1)
+        doc = MultiColDocTemplate(output, self.cols, titlePage=self.titlepage,
+                                  pagesize=self.PAGESIZE, allowSplitting=1)
         doc.setTitle(self.title)
         doc.setHeaders(self.headers)        
         doc.build(elements)
+
+    def build_sections(self, output, parts):
+        """ lay each part of split() out in a worker process, and put
+            their pages together in order into output """
+        states = []
+        for i, (tables, headings) in enumerate(parts):
+            state = self.state()
+            state["data"] = tables
+            # the title page comes with the first section; the pages
+            # of each section are numbered from 1
+            state["titlepage"] = i == 0
+            state["headers"] = i == 0 and [""] + headings or headings
+            states.append(state)
+        writer = PdfFileWriter()
+        # the readers must live until the pages are written
+        readers = []
+        for pdf in section_pool().map(render_section, states):
+            reader = PdfFileReader(StringIO.StringIO(pdf))
+            readers.append(reader)
+            for page in range(reader.getNumPages()):
+                writer.addPage(reader.getPage(page))
+        writer.write(output)
+        
+    def render(self):
+        filename = self.filename + datetime.now().strftime("%Y%m%d%H%M%S") + ".pdf"
+        # built in memory (or an anonymous temporary file when big),
+        # the filename is only what the browser saves it as
+        output = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        parts = self.split()
+        if len(parts) > 1 and section_workers() > 1:
+            # e.g. one clinic per page (per_page=1)
+            self.build_sections(output, parts)
+        else:
+            self.build(output)
         
-        response = HttpResponse(mimetype='application/pdf')
+        response = HttpResponse(file_chunks(output), mimetype='application/pdf')
         response['Cache-Control'] = ""
         response['Content-Disposition'] = "attachment; filename=%s" % filename
-        response.write(open(filename).read())
-        os.remove(filename)
+        # see mctc.reportcache.cached_report
+        response.streaming = True
+        self.account(0)
         return response
           
     # what should appear on the first page 
@@ -225,17 +390,20 @@ class PDFReport():
         
 class MultiColDocTemplate(BaseDocTemplate):
     "A multi column document template"
-    headers = []
     title = u"Report Title Here"
     
-    def __init__(self, filename, frameCount=1, **kw):
+    def __init__(self, filename, frameCount=1, titlePage=True, **kw):
         """
             @FIXME: need to remove frameCount to maintain consistency with BaseDocTemplate constructor
                    and hence find a way to pass frameCount
+            @var titlePage: False for the later sections of a report
+                   (see PDFReport.build_sections), all pages are then laterPages
         """
+        self.headers = []
         apply(BaseDocTemplate.__init__,(self, filename), kw)
         
-        self.addPageTemplates(self.firstPage())
+        if titlePage:
+            self.addPageTemplates(self.firstPage())
         
         frameWidth = self.width/frameCount
         frameHeight = self.height-.5*inch
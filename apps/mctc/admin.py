@@ -3,6 +3,8 @@ from django.contrib.auth.admin import UserAdmin
 from models.general import Zone, Facility, Case, Provider, User 
 from models.logs import MessageLog, EventLog, SystemErrorLog
 from models.reports import Observation
+from models.broadcasts import Broadcast
+from models.jobs import ReportJob
 from django.utils.translation import ugettext_lazy as _
 
  
@@ -65,5 +67,17 @@ class SystemErrorLogAdmin(admin.ModelAdmin):
     
 admin.site.register(SystemErrorLog, SystemErrorLogAdmin)
 
+class BroadcastAdmin(admin.ModelAdmin):
+    list_display = ("name", "requested_by", "status", "sent", "failed", "total", "created_at", "finished_at")
+    list_filter = ("status", "name")
+
+admin.site.register(Broadcast, BroadcastAdmin)
+
+class ReportJobAdmin(admin.ModelAdmin):
+    list_display = ("path", "requested_by", "status", "done", "total", "created_at", "finished_at")
+    list_filter = ("status", "view")
+
+admin.site.register(ReportJob, ReportJobAdmin)
+
 
 admin.site.register(Observation)
\ No newline at end of file
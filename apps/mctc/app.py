@@ -13,13 +13,18 @@ from django.contrib.auth.models import User, Group
 
 import rapidsms
 from rapidsms.parsers.keyworder import Keyworder
+from libdispatch.index import KeywordIndex
+from libdispatch.pool import pool, inline
 from rapidsms.message import Message
 from rapidsms.connection import Connection
 
-from models.logs import MessageLog, log, elog
+from models.logs import log, elog
 
 from models.general import Provider, User
 from models.general import Facility, Case, CaseNote, Zone
+from mctc.caches import identities, cases
+from mctc.logwriter import messagelog
+from mctc.broadcaster import broadcaster
 
 
 import re, time, datetime
@@ -51,36 +56,39 @@ class App (rapidsms.app.App):
     MAX_MSG_LEN = 140
     keyword = Keyworder()
 
+    # handlers may run on the libdispatch worker pool
+    thread_safe = True
+
+    def configure (self, messagelog_spool=None, messagelog_batch=None, messagelog_interval=None,
+                   broadcast_rate=None, broadcast_interval=None):
+        """ configured from [mctc] in rapidsms.ini """
+        messagelog.configure(spool=messagelog_spool, batch=messagelog_batch,
+                             interval=messagelog_interval)
+        broadcaster.configure(rate=broadcast_rate, interval=broadcast_interval)
+
     def start (self):
         """Configure your app in the start phase."""
-        pass
+        self.dispatch = KeywordIndex(self.keyword)
+        messagelog.attach(self.router)
+
+    def stop (self):
+        """Perform global app cleanup when the application is stopped."""
+        messagelog.flush(force=True)
 
     def parse (self, message):
         """parser """
-        # allow authentication to occur when http tester is used
-        if message.peer[:3] == '233':
-            mobile = "+" + message.peer
-        else:
-            mobile = message.peer 
-        provider = Provider.by_mobile(mobile)
-        if provider:
-            message.sender = provider.user
-        else:
-            message.sender = None
+        # shared with the other clinical apps, see mctc.caches
+        message.sender = identities.user(message.peer)
         message.was_handled = False
 
     def cleanup (self, message):
         """cleanup """
-        log = MessageLog(mobile=message.peer,
-                         sent_by=message.persistant_connection.reporter,
-                         text=message.text,
-                         was_handled=message.was_handled)
-        log.save()
+        messagelog.write(message)
 
     def handle (self, message):
         """Handles things. """
         try:
-            func, captures = self.keyword.match(self, message.text)
+            func, captures = self.dispatch.match(self, message.text)
         except TypeError:
             #message.respond(dir(self))
             
@@ -104,6 +112,9 @@ class App (rapidsms.app.App):
             message.respond(_("Sorry Unknown command: '%(msg)s...' Please try again") % {"msg":message.text[:20]})
             
             return False
+        return pool.handle(self, message, func, captures)
+
+    def call_handler (self, message, func, captures):
         try:
             handled = func(self, message, *captures)
         except HandlerFailed, e:
@@ -251,6 +262,7 @@ class App (rapidsms.app.App):
             self.respond_not_registered(message, target)
 
     @keyword(r'\@(\w+) (.+)')
+    @inline
     @registered
 
     def direct_message (self, message, target, text):
@@ -335,10 +347,10 @@ class App (rapidsms.app.App):
 
     def find_case (self, ref_id):
         """look up a patient id """
-        try:
-            return Case.objects.get(ref_id=int(ref_id))
-        except Case.DoesNotExist:
+        case = cases.find(ref_id)
+        if case is None:
             raise HandlerFailed(_("Case +%s not found.") % ref_id)
+        return case
 
     @keyword(r'cancel \+?(\d+)')
     @authenticated
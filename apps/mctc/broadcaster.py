@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+''' Background sender for broadcasts (msummary and friends)
+
+    Sending the same text to every reporter used to be done in the
+    handler, with a sleep between messages so as not to flood the modem,
+    which kept the router from handling anything else for the whole
+    broadcast. queue() now only writes the messages to the database and
+    returns; a router timer sends them a few at a time, at most `rate`
+    messages a minute on each backend.
+
+    Progress is kept on the Broadcast row (and visible in the admin), so
+    a broadcast carries on where it stopped when the router restarts. The
+    requester gets an SMS with the totals once it is done.
+
+    usage:
+            def start (self):
+                broadcaster.attach(self.router)
+
+            broadcast = broadcaster.queue("msummary", texts, recipients,
+                                          notify=message)
+'''
+
+from datetime import datetime
+
+from django.db import connection, transaction
+from django.db.models import F
+
+from mctc.models.broadcasts import Broadcast, BroadcastMessage
+from mctc.reportwriter import insert_rows
+
+class Broadcaster(object):
+
+    def __init__(self, rate=6, interval=10):
+        self.rate       = rate
+        self.interval   = interval
+        self.router     = None
+        # messages each backend may send now, fractions carry over
+        self.credit     = {}
+
+    def configure(self, rate=None, interval=None):
+        ''' settings from the [mctc] section of rapidsms.ini '''
+        if rate:
+            self.rate = float(rate)
+        if interval:
+            self.interval = int(interval)
+
+    def attach(self, router):
+        ''' register the sending timer, only runs once '''
+        if self.router is None:
+            self.router = router
+            router.call_at(self.interval, self.tick)
+
+    @transaction.commit_on_success
+    def queue(self, name, texts, recipients, requested_by=None, notify=None):
+        ''' queue each of texts for each (backend slug, identity) of
+            recipients, in that order. notify is the message whose
+            sender gets the progress report '''
+        broadcast = Broadcast(name=name, requested_by=requested_by,
+                              total=len(texts) * len(recipients))
+        if notify is not None:
+            broadcast.notify            = notify.connection.identity
+            broadcast.notify_backend    = notify.connection.backend.slug
+        broadcast.save()
+
+        fields = [BroadcastMessage._meta.get_field(f) for f in
+                  ("broadcast", "backend", "identity", "text", "status")]
+        insert_rows(connection.cursor(), BroadcastMessage._meta.db_table,
+                    [f.column for f in fields],
+                    [(broadcast.id, backend, identity, text, BroadcastMessage.STATUS_PENDING)
+                     for text in texts for backend, identity in recipients])
+        return broadcast
+
+    def backend(self, slug):
+        for backend in self.router.backends:
+            if backend.slug == slug:
+                return backend
+        return None
+
+    def tick(self):
+        ''' send what each backend is allowed to send now '''
+        pending = BroadcastMessage.objects.filter(status=BroadcastMessage.STATUS_PENDING)
+        slugs   = set(pending.values_list("backend", flat=True))
+        for slug in self.credit.keys():
+            if slug not in slugs:
+                # no bursts after an idle time
+                del self.credit[slug]
+
+        for slug in sorted(slugs):
+            credit = self.credit.get(slug, 0.0) + self.rate * self.interval / 60.0
+            count = int(credit)
+            self.credit[slug] = credit - count
+            if count:
+                self.send(slug, list(pending.filter(backend=slug)[:count]))
+
+        self.finish()
+        return self.interval
+
+    def send(self, slug, messages):
+        backend = self.backend(slug)
+        sent    = []
+        failed  = []
+        for message in messages:
+            try:
+                self.router.outgoing(backend.message(message.identity, message.text))
+                sent.append(message)
+            except Exception, e:
+                # includes a backend that is not configured anymore
+                self.router.log("error", "broadcast to %s failed: %s" % (message.identity, e))
+                failed.append(message)
+
+        now = datetime.now()
+        for status, messages, counter in ((BroadcastMessage.STATUS_SENT, sent, "sent"),
+                                          (BroadcastMessage.STATUS_ERROR, failed, "failed")):
+            if not messages:
+                continue
+            BroadcastMessage.objects.filter(id__in=[m.id for m in messages])\
+                .update(status=status, sent_at=now)
+            counts = {}
+            for message in messages:
+                counts[message.broadcast_id] = counts.get(message.broadcast_id, 0) + 1
+            for broadcast_id, count in counts.items():
+                Broadcast.objects.filter(id=broadcast_id)\
+                    .update(status=Broadcast.STATUS_SENDING, **{counter: F(counter) + count})
+
+    def finish(self):
+        ''' close the broadcasts with nothing left to send '''
+        for broadcast in Broadcast.objects.exclude(status=Broadcast.STATUS_DONE)\
+                .exclude(messages__status=BroadcastMessage.STATUS_PENDING):
+            broadcast.status        = Broadcast.STATUS_DONE
+            broadcast.finished_at   = datetime.now()
+            broadcast.save()
+            if broadcast.notify:
+                backend = self.backend(broadcast.notify_backend)
+                if backend is not None:
+                    self.router.outgoing(backend.message(broadcast.notify, broadcast.progress()))
+
+broadcaster = Broadcaster()
@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+''' In-process caches shared by the clinical apps (mctc, muac, mrdt, ...)
+
+    The router runs every app in the same process, so lookups that each
+    app used to do on its own (who is sending this SMS? which observation
+    is 'cg'?) are done once here and kept until the underlying rows change.
+'''
+
+import copy
+import os
+import tempfile
+import thread
+import threading
+import time
+from collections import deque
+
+from django.contrib.auth.models import User
+from django.db.models.signals import post_save, post_delete, m2m_changed
+
+from mctc.models.general import Provider, Case
+from mctc.models.reports import Observation
+from diarrhea.models import DiarrheaObservation
+from diagnosis.models import Lab, Diagnosis
+
+# country prefixes the httptester sends without the leading '+'
+MOBILE_PREFIXES = ('233', '254')
+
+def normalize_mobile(peer):
+    ''' return the mobile number as stored on Provider.mobile '''
+    if peer is None:
+        return None
+    mobile = peer.strip()
+    if mobile[:3] in MOBILE_PREFIXES:
+        mobile = "+" + mobile
+    return mobile
+
+class IdentityCache(object):
+    ''' mobile number -> active Provider, shared by all the apps
+
+        Unknown numbers are cached too (as None) so that unregistered
+        phones do not cost a query per message either; only the last
+        `max_unknown` of them are kept. Entries are dropped by the
+        Provider/User save and delete signals below.
+
+        usage:
+            provider = identities.provider(message.peer)
+            identities.stats()
+    '''
+
+    # unknown numbers kept, the oldest are forgotten first
+    max_unknown = 1000
+
+    def __init__(self):
+        self.lock       = threading.Lock()
+        self.providers  = {}
+        # the unknown numbers, oldest first
+        self.unknown    = deque()
+        self.hits       = 0
+        self.misses     = 0
+
+    def provider(self, peer):
+        mobile = normalize_mobile(peer)
+        self.lock.acquire()
+        try:
+            if self.providers.has_key(mobile):
+                self.hits += 1
+                return self.providers[mobile]
+            self.misses += 1
+        finally:
+            self.lock.release()
+
+        try:
+            provider = Provider.objects.select_related("user").get(mobile=mobile, active=True)
+        except Provider.DoesNotExist:
+            provider = None
+
+        self.lock.acquire()
+        try:
+            self.providers[mobile] = provider
+            if provider is None:
+                self.unknown.append(mobile)
+                while len(self.unknown) > self.max_unknown:
+                    oldest = self.unknown.popleft()
+                    # unless a provider took the number meanwhile
+                    if self.providers.get(oldest, 0) is None:
+                        del self.providers[oldest]
+        finally:
+            self.lock.release()
+        return provider
+
+    def user(self, peer):
+        ''' the django User behind peer, or None '''
+        provider = self.provider(peer)
+        if provider:
+            return provider.user
+        return None
+
+    def invalidate(self, mobile=None, provider_id=None, user_id=None):
+        ''' forget the entries for a mobile number and/or a provider '''
+        self.lock.acquire()
+        try:
+            if mobile is not None:
+                self.providers.pop(normalize_mobile(mobile), None)
+            for key, provider in self.providers.items():
+                if provider is None:
+                    continue
+                if provider.id == provider_id or provider.user_id == user_id:
+                    del self.providers[key]
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.providers.clear()
+            self.unknown.clear()
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        ''' hit/miss counters, e.g. for the logs or a debug view '''
+        self.lock.acquire()
+        try:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.providers),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': lookups and float(self.hits) / lookups or 0.0,
+            }
+        finally:
+            self.lock.release()
+
+identities = IdentityCache()
+
+def Provider_changed_handler(sender, **kwargs):
+
+    instance    = kwargs['instance']
+
+    identities.invalidate(mobile=instance.mobile, provider_id=instance.id)
+
+post_save.connect(Provider_changed_handler, sender=Provider)
+post_delete.connect(Provider_changed_handler, sender=Provider)
+
+def User_changed_handler(sender, **kwargs):
+
+    instance    = kwargs['instance']
+
+    identities.invalidate(user_id=instance.id)
+
+post_save.connect(User_changed_handler, sender=User)
+post_delete.connect(User_changed_handler, sender=User)
+
+# where the caches keep their version stamps, see VersionStamp
+VERSION_DIR = tempfile.gettempdir()
+
+class VersionStamp(object):
+    ''' a version number seen by all the processes of a deployment
+
+        The web server (admin, reports) and the router are different
+        processes, so a save signal in one is not seen by the other.
+        bump() also rewrites a small stamp file; the other processes
+        notice the new mtime with a stat() instead of a query. The file
+        holds a token no other bump writes (pid, counter and time), so
+        two processes bumping within the same mtime still leave
+        different contents.
+    '''
+
+    def __init__(self, name):
+        self.path   = os.path.join(VERSION_DIR, "rapidsms-%s.version" % name)
+        self.lock   = threading.Lock()
+        self.local  = 0
+
+    def current(self):
+        try:
+            return (self.local, os.stat(self.path).st_mtime)
+        except OSError:
+            return (self.local, None)
+
+    def shared(self):
+        ''' the version as every process sees it: the stamp file's mtime
+            and content (the token of the last bump) '''
+        try:
+            stamp = open(self.path)
+            try:
+                return (os.fstat(stamp.fileno()).st_mtime, stamp.read().strip())
+            finally:
+                stamp.close()
+        except (IOError, OSError):
+            return None
+
+    def bump(self):
+        self.lock.acquire()
+        try:
+            self.local += 1
+            token = "%d-%d-%.6f" % (os.getpid(), self.local, time.time())
+        finally:
+            self.lock.release()
+        # written aside then renamed, shared() never reads half a token
+        temp = "%s.%d.%d.tmp" % (self.path, os.getpid(), thread.get_ident())
+        try:
+            stamp = open(temp, "w")
+            try:
+                stamp.write("%s\n" % token)
+            finally:
+                stamp.close()
+            os.rename(temp, self.path)
+        except (IOError, OSError):
+            # other processes will pick the change up on restart
+            pass
+        return self.current()
+
+class CodeTable(object):
+    ''' code -> object for a small reference table (observation letters,
+        lab and diagnosis codes), loaded once and shared by the apps
+
+        The table is reloaded when its version changes. Saving or
+        deleting a row bumps the version, in this process and (through
+        the stamp file) in the others, so an edit in the admin is seen
+        by the router without a query per lookup.
+
+        usage:
+            obs = observations.get("cg")
+            found, unknown = diagnoses.resolve(["001", "084.9"])
+    '''
+
+    def __init__(self, model, field):
+        self.model      = model
+        self.field      = field
+        self.lock       = threading.Lock()
+        self.version    = VersionStamp("codes-%s-%s" % (model._meta.app_label,
+                                                        model._meta.object_name.lower()))
+        self.loaded     = None
+        self.table      = {}
+        self.reloads    = 0
+
+        post_save.connect(self.changed_handler, sender=model)
+        post_delete.connect(self.changed_handler, sender=model)
+
+    def codes(self):
+        ''' the whole table, as a dict of lowercased code -> object '''
+        version = self.version.current()
+        self.lock.acquire()
+        try:
+            if version != self.loaded:
+                self.table = dict([(getattr(o, self.field).lower(), o)
+                                   for o in self.model.objects.all()])
+                self.loaded = version
+                self.reloads += 1
+            return self.table
+        finally:
+            self.lock.release()
+
+    def get(self, code):
+        return self.codes().get(code.lower(), None)
+
+    def resolve(self, codes):
+        ''' objects for a list of codes, and the codes that are not known '''
+        table   = self.codes()
+        found   = []
+        unknown = []
+        for code in codes:
+            obj = table.get(code.lower(), None)
+            if obj is None:
+                unknown.append(code)
+            else:
+                found.append(obj)
+        return found, unknown
+
+    def changed_handler(self, sender, **kwargs):
+        self.lock.acquire()
+        try:
+            self.version.bump()
+        finally:
+            self.lock.release()
+
+observations            = CodeTable(Observation, "letter")
+diarrhea_observations   = CodeTable(DiarrheaObservation, "letter")
+labs                    = CodeTable(Lab, "code")
+diagnoses               = CodeTable(Diagnosis, "code")
+
+class CaseResolver(object):
+    ''' ref_id -> Case, for all the apps reporting on cases
+
+        Keeps the `size` most recently used cases. A case saved or
+        deleted in this process is dropped from the cache; a change made
+        by another process (e.g. the admin) empties it.
+
+        Each call returns its own copy of the case, so a handler that
+        changes a case without saving it does not affect the others.
+
+        usage:
+            case = cases.find("+26")
+    '''
+
+    def __init__(self, size=1000):
+        self.size       = size
+        self.lock       = threading.Lock()
+        self.version    = VersionStamp("cases")
+        self.loaded     = self.version.current()
+        self.cases      = {}
+        self.tick       = 0
+        self.hits       = 0
+        self.misses     = 0
+
+        post_save.connect(self.changed_handler, sender=Case)
+        post_delete.connect(self.changed_handler, sender=Case)
+
+    def find(self, ref_id):
+        ''' the case with this ref_id, or None '''
+        try:
+            ref_id = int(str(ref_id).strip().lstrip("+"))
+        except ValueError:
+            return None
+
+        self.lock.acquire()
+        try:
+            self.expire()
+            self.tick += 1
+            entry = self.cases.get(ref_id, None)
+            if entry is not None:
+                self.hits += 1
+                entry[1] = self.tick
+                return copy.copy(entry[0])
+            self.misses += 1
+        finally:
+            self.lock.release()
+
+        try:
+            case = Case.objects.select_related("reporter", "location").get(ref_id=ref_id)
+        except Case.DoesNotExist:
+            return None
+
+        self.lock.acquire()
+        try:
+            self.cases[ref_id] = [case, self.tick]
+            if len(self.cases) > self.size:
+                self.evict()
+        finally:
+            self.lock.release()
+        return copy.copy(case)
+
+    def expire(self):
+        # another process changed a case
+        version = self.version.current()
+        if version != self.loaded:
+            self.cases.clear()
+            self.loaded = version
+
+    def evict(self):
+        # drop the least recently used half in one go
+        entries = sorted(self.cases.items(), key=lambda item: item[1][1])
+        for ref_id, entry in entries[:len(entries) / 2]:
+            del self.cases[ref_id]
+
+    def changed_handler(self, sender, **kwargs):
+
+        instance    = kwargs['instance']
+
+        self.lock.acquire()
+        try:
+            self.expire()
+            self.cases.pop(instance.ref_id, None)
+            self.loaded = self.version.bump()
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            return {'size': len(self.cases), 'hits': self.hits, 'misses': self.misses}
+        finally:
+            self.lock.release()
+
+cases = CaseResolver()
+
+class AlertIndex(object):
+    ''' who gets the alerts about a report
+
+        A provider with alerts switched on is alerted about the reports
+        of the locations (clinics) and of the reporters (CHWs) they follow.
+        Both follow lists are kept here as id -> set of provider ids, so
+        the recipients of a report are a couple of set unions instead of
+        a walk over the follow tables.
+
+        The index is updated from the m2m and Provider signals of this
+        process, and reloaded when another process changed a follow list.
+
+        usage:
+            for provider in alert_recipients.recipients(location_id=case.location_id,
+                                                        reporter_id=reporter.id):
+                message.forward(provider.mobile, alert)
+    '''
+
+    def __init__(self):
+        self.lock       = threading.Lock()
+        self.version    = VersionStamp("alerts")
+        self.loaded     = None
+        self.clinics    = {}
+        self.users      = {}
+        self.alerting   = {}
+
+        self.clinics_through    = Provider.following_clinics.through
+        self.users_through      = Provider.following_users.through
+        m2m_changed.connect(self.clinics_changed_handler, sender=self.clinics_through)
+        m2m_changed.connect(self.users_changed_handler, sender=self.users_through)
+        post_save.connect(self.provider_changed_handler, sender=Provider)
+        post_delete.connect(self.provider_changed_handler, sender=Provider)
+
+    def load(self):
+        version = self.version.current()
+        if version == self.loaded:
+            return
+        self.clinics    = self.followers(self.clinics_through, "location")
+        self.users      = self.followers(self.users_through, "reporter")
+        self.alerting   = dict([(p.id, p) for p in
+                                Provider.objects.select_related("user").filter(alerts=True)])
+        self.loaded     = version
+
+    def followers(self, through, target):
+        index = {}
+        for provider_id, target_id in through.objects.values_list("provider", target):
+            index.setdefault(target_id, set()).add(provider_id)
+        return index
+
+    def recipients(self, location_id=None, reporter_id=None):
+        ''' the providers to alert, each once, ordered by id '''
+        self.lock.acquire()
+        try:
+            self.load()
+            ids = self.clinics.get(location_id, set()) | self.users.get(reporter_id, set())
+            return [self.alerting[id] for id in sorted(ids) if self.alerting.has_key(id)]
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        ''' reload on next use, e.g. after loading fixtures '''
+        self.lock.acquire()
+        try:
+            self.loaded = None
+        finally:
+            self.lock.release()
+
+    def changed(self, name, kwargs):
+        action = kwargs["action"]
+        if action not in ("post_add", "post_remove", "post_clear"):
+            return
+        self.lock.acquire()
+        try:
+            self.load()
+            if action == "post_clear":
+                # the cleared ids are not sent along, reload it all
+                self.version.bump()
+                self.loaded = None
+                return
+            index       = getattr(self, name)
+            instance    = kwargs["instance"]
+            for pk in kwargs["pk_set"]:
+                if kwargs["reverse"]:
+                    # instance is the location or reporter, pk a provider
+                    target_id, provider_id = instance.pk, pk
+                else:
+                    target_id, provider_id = pk, instance.pk
+                if action == "post_add":
+                    index.setdefault(target_id, set()).add(provider_id)
+                else:
+                    index.get(target_id, set()).discard(provider_id)
+            self.loaded = self.version.bump()
+        finally:
+            self.lock.release()
+
+    def clinics_changed_handler(self, sender, **kwargs):
+        self.changed("clinics", kwargs)
+
+    def users_changed_handler(self, sender, **kwargs):
+        self.changed("users", kwargs)
+
+    def provider_changed_handler(self, sender, **kwargs):
+
+        instance    = kwargs['instance']
+
+        self.lock.acquire()
+        try:
+            self.load()
+            if instance.alerts and kwargs['signal'] is post_save:
+                self.alerting[instance.id] = instance
+            else:
+                self.alerting.pop(instance.id, None)
+            self.loaded = self.version.bump()
+        finally:
+            self.lock.release()
+
+alert_recipients = AlertIndex()
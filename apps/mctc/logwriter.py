@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+''' Buffered MessageLog writer shared by the clinical apps
+
+    Every clinical app used to save its own MessageLog row in cleanup(),
+    so one SMS ended up as several identical rows and as many INSERTs.
+    The apps now hand the message to `messagelog`, which keeps one row
+    per inbound message (was_handled is True if any app handled it) and
+    writes the rows with a single executemany once `batch` rows are
+    waiting or `interval` seconds went by.
+
+    A message whose handler still runs on the libdispatch pool (see
+    libdispatch.pool) is not flushed until the pool is done with it; the
+    handler's result is then read from the message, whether an app wrote
+    it again or not.
+
+    Each row is also appended to a spool file before it is buffered; the
+    spool is replayed into the database when the router starts again, so
+    a crash between two flushes does not lose the log.
+
+    usage:
+            def start (self):
+                messagelog.attach(self.router)
+
+            def cleanup (self, message):
+                messagelog.write(message)
+
+            def stop (self):
+                messagelog.flush(force=True)
+'''
+
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from django.db import connection, transaction
+from django.utils import simplejson
+
+from mctc.models.logs import MessageLog
+from mctc.models.stats import DailyStat, message_stats
+from mctc.models.activity import count_messages
+from mctc.reportcache import report_cache
+
+SPOOL_FILE  = os.path.join(tempfile.gettempdir(), "rapidsms-messagelog.spool")
+COLUMNS     = ("mobile", "sent_by", "text", "was_handled", "created_at")
+
+class MessageLogWriter(object):
+
+    # seconds a row is left alone after its last write before it can be
+    # flushed, so that the apps still running cleanup() can merge into it
+    settle = 1
+
+    def __init__(self, spool=SPOOL_FILE, batch=50, interval=30):
+        self.lock       = threading.RLock()
+        self.spool      = spool
+        self.batch      = batch
+        self.interval   = interval
+        self.pending    = {}
+        self.counter    = 0
+        self.last_flush = time.time()
+        self.router     = None
+        self.recovered  = False
+
+    def configure(self, spool=None, batch=None, interval=None):
+        ''' settings from the [mctc] section of rapidsms.ini '''
+        if spool:
+            self.spool = spool
+        if batch:
+            self.batch = int(batch)
+        if interval:
+            self.interval = int(interval)
+
+    def attach(self, router):
+        ''' replay the spool and register the periodic flush.
+            called by every app using the writer, only runs once '''
+        self.lock.acquire()
+        try:
+            self.recover()
+            if self.router is None:
+                self.router = router
+                router.call_at(self.interval, self.periodic_flush)
+        finally:
+            self.lock.release()
+
+    def periodic_flush(self):
+        self.flush()
+        return self.interval
+
+    def write(self, message):
+        ''' log message, merging with what other apps wrote for it '''
+        key = id(message)
+        self.lock.acquire()
+        try:
+            self.recover()
+            row = self.pending.get(key, None)
+            if row is None:
+                self.counter += 1
+                reporter = message.persistant_connection.reporter
+                row = {
+                    "token": "%d-%d-%d" % (os.getpid(), self.last_flush, self.counter),
+                    "mobile": message.peer,
+                    "sent_by": reporter and reporter.id or None,
+                    "text": message.text,
+                    "was_handled": bool(message.was_handled),
+                    "created_at": datetime.now(),
+                    # keeps id(message) from being reused until flushed
+                    "message": message,
+                }
+                self.pending[key] = row
+                self.spool_rows([row])
+            elif message.was_handled and not row["was_handled"]:
+                row["was_handled"] = True
+                self.spool_rows([row])
+            row["touched"] = time.time()
+
+            if len(self.pending) >= self.batch or \
+                    time.time() - self.last_flush >= self.interval:
+                self.flush()
+        finally:
+            self.lock.release()
+
+    def flush(self, force=False):
+        ''' insert the settled rows (all of them if force) '''
+        self.lock.acquire()
+        try:
+            now     = time.time()
+            ready   = [key for key, row in self.pending.items()
+                       if force or (not self.held(row) and now - row["touched"] >= self.settle)]
+            if ready:
+                rows = [self.pending[key] for key in ready]
+                for row in rows:
+                    # set by the pool's jobs, see libdispatch.pool
+                    row["was_handled"] = row["was_handled"] or bool(row["message"].was_handled)
+                rows.sort(key=lambda row: row["created_at"])
+                self.insert(rows)
+                for key in ready:
+                    del self.pending[key]
+                # the spool only holds what is still pending
+                self.rewrite_spool(self.pending.values())
+            self.last_flush = now
+            return len(ready)
+        finally:
+            self.lock.release()
+
+    def held(self, row):
+        ''' whether the pool still has jobs for the row's message '''
+        return bool(getattr(row["message"], "jobs", 0))
+
+    def insert(self, rows):
+        qn      = connection.ops.quote_name
+        fields  = [MessageLog._meta.get_field(name) for name in COLUMNS]
+        sql     = "INSERT INTO %s (%s) VALUES (%s)" % (
+            qn(MessageLog._meta.db_table),
+            ", ".join([qn(f.column) for f in fields]),
+            ", ".join(["%s"] * len(fields)))
+        cursor  = connection.cursor()
+        cursor.executemany(sql, [[row[name] for name in COLUMNS] for row in rows])
+        # raw inserts send no post_save, the daily stats and the
+        # reporters' activity are counted here
+        DailyStat.add(message_stats(rows))
+        count_messages(rows)
+        transaction.commit_unless_managed()
+        report_cache.bump()
+
+    def spool_rows(self, rows, path=None, mode="a"):
+        spool = open(path or self.spool, mode)
+        try:
+            for row in rows:
+                line = dict([(name, row[name]) for name in COLUMNS])
+                line["token"]       = row["token"]
+                line["created_at"]  = row["created_at"].strftime("%Y-%m-%d %H:%M:%S")
+                spool.write(simplejson.dumps(line) + "\n")
+            spool.flush()
+            if mode == "w":
+                os.fsync(spool.fileno())
+        finally:
+            spool.close()
+
+    def rewrite_spool(self, rows):
+        # written aside then renamed, a crash or a full disk leaves the
+        # old spool, and its rows, in place
+        temp = self.spool + ".tmp"
+        self.spool_rows(rows, temp, "w")
+        os.rename(temp, self.spool)
+
+    def recover(self):
+        ''' insert what a previous run spooled but did not flush '''
+        if self.recovered:
+            return
+        self.recovered = True
+        if not os.path.exists(self.spool):
+            return
+
+        rows    = {}
+        spool   = open(self.spool)
+        try:
+            for line in spool:
+                try:
+                    row = simplejson.loads(line)
+                except ValueError:
+                    # half written line, the router died mid-write
+                    continue
+                if rows.has_key(row["token"]):
+                    rows[row["token"]]["was_handled"] |= row["was_handled"]
+                else:
+                    row["created_at"] = datetime.strptime(row["created_at"], "%Y-%m-%d %H:%M:%S")
+                    rows[row["token"]] = row
+        finally:
+            spool.close()
+
+        if rows:
+            rows = rows.values()
+            rows.sort(key=lambda row: row["created_at"])
+            self.insert(rows)
+        self.rewrite_spool([])
+
+messagelog = MessageLogWriter()
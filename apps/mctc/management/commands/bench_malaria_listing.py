@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+''' Time the malaria listing (ReportAllPatients.malaria_by_provider)
+
+    ./rapidsms bench_malaria_listing [--reports=10000,100000] [--per-case=4]
+
+    For each size, fills the database with that many synthetic mrdt
+    reports (about --per-case of them per case), builds the listing and
+    prints the time and the number of queries it took. Everything is
+    written in one transaction which is rolled back at the end, so the
+    database is left as it was. Needs at least one Reporter and one
+    Location to attach the synthetic cases to.
+'''
+
+import random
+import time
+from datetime import datetime, date, timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from reporters.models import Reporter
+from locations.models import Location
+
+from mctc.models.general import Case
+from mctc.models.reports import ReportAllPatients
+from mctc.reportwriter import insert_rows
+from mrdt.models import ReportMalaria
+from libdispatch.profile import count_queries, queries
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("--reports", dest="reports", default="10000,100000",
+                    help="comma separated numbers of reports (default 10000,100000)"),
+        make_option("--per-case", dest="per_case", type="int", default=4,
+                    help="average number of reports per case (default 4)"),
+        make_option("--seed", dest="seed", type="int", default=0,
+                    help="random seed for the synthetic data"),
+    )
+    help = "Benchmark the malaria listing on synthetic reports."
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(n) for n in options["reports"].split(",")]
+        except ValueError:
+            raise CommandError("--reports must be numbers, e.g. 10000,100000")
+        try:
+            reporter    = Reporter.objects.all()[0]
+            location    = Location.objects.all()[0]
+        except IndexError:
+            raise CommandError("needs at least one reporter and one location")
+        random.seed(options["seed"])
+        count_queries()
+
+        print "%10s %8s %8s %10s %8s %12s" % ("reports", "cases", "rows", "time (s)", "queries", "reports/s")
+        for size in sizes:
+            transaction.enter_transaction_management()
+            transaction.managed(True)
+            try:
+                cases = self.fill(size, max(1, size / options["per_case"]), reporter, location)
+                before  = queries()
+                start   = time.time()
+                rows, fields = ReportAllPatients.malaria_by_provider()
+                count   = 0
+                for row in rows:
+                    count += 1
+                elapsed = time.time() - start
+                print "%10d %8d %8d %10.3f %8d %12.0f" % (size, cases, count, elapsed,
+                        queries() - before, size / max(elapsed, 0.001))
+            finally:
+                transaction.rollback()
+                transaction.leave_transaction_management()
+
+    def fill(self, reports, cases, reporter, location):
+        ''' insert the synthetic cases and reports, returns the number
+            of cases '''
+        cursor  = connection.cursor()
+        now     = datetime.now()
+        fields  = [Case._meta.get_field(name) for name in
+                   ("ref_id", "first_name", "last_name", "gender", "dob",
+                    "reporter", "location", "created_at", "updated_at", "status")]
+        insert_rows(cursor, Case._meta.db_table, [f.column for f in fields],
+                    [(None, "bench", "bench%07d" % i, random.choice("MF"),
+                      date.today() - timedelta(days=random.randint(30, 1800)),
+                      reporter.id, location.id, now, now, Case.STATUS_ACTIVE)
+                     for i in range(cases)])
+        ids = list(Case.objects.filter(first_name="bench", last_name__startswith="bench")\
+                        .values_list("id", flat=True))
+
+        fields  = [ReportMalaria._meta.get_field(name) for name in
+                   ("case", "reporter", "entered_at", "bednet", "result")]
+        insert_rows(cursor, ReportMalaria._meta.db_table, [f.column for f in fields],
+                    [(random.choice(ids), reporter.id,
+                      now - timedelta(minutes=random.randint(0, 60 * 24 * 365)),
+                      random.random() < 0.5, random.random() < 0.3)
+                     for i in range(reports)])
+        return len(ids)
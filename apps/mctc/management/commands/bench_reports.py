@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+''' Time every report of mctc.views on synthetic data of growing size
+
+    ./rapidsms bench_reports [--cases=1000,10000,100000] [--only=malaria,trend]
+                             [--save=bench.json] [--baseline=bench.json]
+
+    For each size, fills the database with that many synthetic cases
+    spread over the existing CHWs, each with a history of MUAC, MRDT,
+    diarrhea and measles reports and of the messages that filed them.
+    The tables kept up to date on write (CaseStatus, DailyStat and the
+    reporters' activity) are rebuilt, then every report is built, PDF
+    and CSV, for everything and for one clinic or provider. The wall
+    time, the peak memory, the table data held by the PDF builder (see
+    PDFReport.held) and the number of queries of each are printed.
+
+    Everything is written in one transaction which is rolled back at the
+    end, so the database is left as it was. The report cache is off
+    while running, and the reports usually built in the background are
+    built in the foreground.
+
+    --save writes the results as json, --baseline compares them with
+    such a file (e.g. saved before changing the report code). Needs at
+    least one CHW with a clinic and one Location.
+'''
+
+import os
+import random
+import threading
+import time
+from datetime import datetime, date, timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import simplejson
+
+from locations.models import Location
+
+from mctc import views
+from mctc.models.general import Case, Provider
+from mctc.models.logs import MessageLog
+from mctc.reportcache import report_cache
+from mctc.reportjobs import report_jobs, JobRequest
+from mctc.reportwriter import insert_rows
+from mctc.management.commands import rebuild_case_status, rebuild_daily_stats, rebuild_activity
+from diarrhea.models import ReportDiarrhea
+from measles.models import ReportMeasles
+from mrdt.models import ReportMalaria
+from muac.models import ReportMalnutrition
+from libdispatch.profile import count_queries, queries
+from libreport.pdfreport import memory_hooks
+
+# view, what it is built for (None: everything, or one "clinic" or
+# "provider") and format
+REPORTS = (
+    ("last_30_days",    None,       "pdf"),
+    ("last_30_days",    "clinic",   "pdf"),
+    ("last_30_days",    "clinic",   "csv"),
+    ("measles_summary", None,       "pdf"),
+    ("measles_summary", "clinic",   "pdf"),
+    ("measles_summary", "clinic",   "csv"),
+    ("patients_by_chw", None,       "pdf"),
+    ("patients_by_chw", "provider", "pdf"),
+    ("patients_by_chw", "provider", "csv"),
+    ("measles",         None,       "pdf"),
+    ("measles",         "provider", "pdf"),
+    ("measles",         "provider", "csv"),
+    ("malnut",          None,       "pdf"),
+    ("malnut",          "provider", "pdf"),
+    ("malnut",          "provider", "csv"),
+    ("malaria",         None,       "pdf"),
+    ("malaria",         "provider", "pdf"),
+    ("malaria",         "provider", "csv"),
+    ("trend",           None,       "pdf"),
+    ("trend",           "provider", "pdf"),
+    ("trend",           "provider", "csv"),
+    # through report_view
+    ("monitoring",      None,       "csv"),
+    ("measlessummary",  None,       "csv"),
+)
+
+# rows inserted per statement
+CHUNK       = 5000
+PAGE_SIZE   = os.sysconf("SC_PAGE_SIZE")
+
+def rss():
+    ''' resident memory of this process in bytes, None if unknown '''
+    try:
+        statm = open("/proc/self/statm")
+        try:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+        finally:
+            statm.close()
+    except (IOError, ValueError, IndexError):
+        return None
+
+class MemoryPeak(object):
+    ''' the highest resident memory between start() and stop(), above
+        the memory at start(), sampled by a thread '''
+
+    def __init__(self, interval=0.005):
+        self.interval   = interval
+        self.running    = False
+
+    def start(self):
+        self.base = self.peak = rss()
+        self.running = self.base is not None
+        if self.running:
+            self.thread = threading.Thread(target=self.sample)
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def sample(self):
+        while self.running:
+            self.peak = max(self.peak, rss())
+            time.sleep(self.interval)
+
+    def stop(self):
+        ''' bytes, None where /proc is not available '''
+        if not self.running:
+            return None
+        self.running = False
+        self.thread.join()
+        self.peak = max(self.peak, rss())
+        return self.peak - self.base
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("--cases", dest="cases", default="1000,10000,100000",
+                    help="comma separated numbers of cases (default 1000,10000,100000)"),
+        make_option("--only", dest="only", default=None,
+                    help="comma separated views to run (default: all)"),
+        make_option("--seed", dest="seed", type="int", default=0,
+                    help="random seed for the synthetic data"),
+        make_option("--save", dest="save", default=None,
+                    help="write the results to this json file"),
+        make_option("--baseline", dest="baseline", default=None,
+                    help="compare with the results saved in this json file"),
+    )
+    help = "Benchmark the mctc reports on synthetic data."
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(n) for n in options["cases"].split(",")]
+        except ValueError:
+            raise CommandError("--cases must be numbers, e.g. 1000,10000")
+        reports = REPORTS
+        if options["only"]:
+            only = options["only"].split(",")
+            reports = [r for r in REPORTS if r[0] in only]
+        baseline = {}
+        if options["baseline"]:
+            try:
+                baseline = simplejson.loads(open(options["baseline"]).read())
+            except (IOError, ValueError), e:
+                raise CommandError("cannot read %s: %s" % (options["baseline"], e))
+
+        self.providers = list(Provider.objects.filter(role=Provider.CHW_ROLE, clinic__isnull=False))
+        try:
+            self.location = Location.objects.all()[0]
+        except IndexError:
+            raise CommandError("needs at least one location")
+        if not self.providers:
+            raise CommandError("needs at least one CHW with a clinic")
+        random.seed(options["seed"])
+        count_queries()
+
+        size = report_cache.size
+        report_cache.size = 0
+        results = {}
+        print "%8s %-30s %10s %10s %10s %8s %10s" % ("cases", "report", "time (s)", "peak (MB)",
+                                                     "held (MB)", "queries", "baseline")
+        try:
+            for cases in sizes:
+                transaction.enter_transaction_management()
+                transaction.managed(True)
+                try:
+                    self.fill(cases)
+                    for report in reports:
+                        key = "%d %s" % (cases, self.label(report))
+                        results[key] = result = self.run(*report)
+                        print "%8d %-30s %s %10s" % (cases, self.label(report),
+                                self.format(result), self.compare(result, baseline.get(key)))
+                finally:
+                    transaction.rollback()
+                    transaction.leave_transaction_management()
+        finally:
+            report_cache.size = size
+
+        if options["save"]:
+            out = open(options["save"], "w")
+            try:
+                out.write(simplejson.dumps(results, indent=1, sort_keys=True))
+            finally:
+                out.close()
+
+    def label(self, report):
+        view, target, rformat = report
+        return "%s/%s.%s" % (view, target or "all", rformat)
+
+    def format(self, result):
+        if "error" in result:
+            return "%-41s" % ("failed: %s" % result["error"])[:41]
+        memory = result["memory"] is None and "-" or "%.1f" % (result["memory"] / 1048576.0)
+        return "%10.3f %10s %10.1f %8d" % (result["time"], memory, result["held"] / 1048576.0,
+                                           result["queries"])
+
+    def compare(self, result, base):
+        ''' the time relative to the baseline, e.g. x0.50 when twice as
+            fast '''
+        if not base or "error" in result or "error" in base or not base["time"]:
+            return "-"
+        return "x%.2f" % (result["time"] / base["time"])
+
+    def run(self, view, target, rformat):
+        ''' build one report, returns its time, peak memory, table data
+            held by the PDF builder, queries and size, or the error '''
+        user = User(username="bench", is_staff=True, is_superuser=True)
+        post = {}
+        kwargs = {}
+        if target == "clinic":
+            post = {"clinic": [str(self.providers[0].clinic_id)], "format": [rformat]}
+        elif target == "provider":
+            post = {"provider": [str(self.providers[0].id)], "format": [rformat]}
+        if target:
+            kwargs = {"object_id": post[target][0], "rformat": rformat}
+        request = JobRequest("/%s/" % view, {}, post, user)
+
+        if view == "monitoring":
+            call = lambda: views.report_view(request, "monitoring_csv", date.today().strftime("%m%Y"))
+        elif view == "measlessummary":
+            call = lambda: views.report_view(request, "measlessummary_csv", "")
+        else:
+            # the reports usually built in the background, without
+            # their redirection to the job's page
+            func = report_jobs.views.get("%s.%s" % (views.__name__, view), getattr(views, view))
+            call = lambda: func(request, **kwargs)
+
+        # the most table data a PDFReport held
+        held = [0]
+        def hook(report, bytes):
+            held[0] = max(held[0], bytes)
+
+        memory  = MemoryPeak()
+        before  = queries()
+        memory_hooks.append(hook)
+        memory.start()
+        start   = time.time()
+        try:
+            try:
+                # streamed responses are built while they are read
+                size = len(call().content)
+            except Exception, e:
+                memory.stop()
+                return {"error": "%s: %s" % (e.__class__.__name__, e)}
+        finally:
+            memory_hooks.remove(hook)
+        elapsed = time.time() - start
+        return {"time": elapsed, "memory": memory.stop(), "held": held[0],
+                "queries": queries() - before, "bytes": size}
+
+    def fill(self, cases):
+        ''' insert the synthetic cases, reports and messages, and rebuild
+            what is kept up to date on write '''
+        cursor  = connection.cursor()
+        now     = datetime.now()
+        first   = (Case.objects.aggregate(last=Max("ref_id"))["last"] or 0) + 1
+        # a provider reports as the Reporter with the id of its user
+        reporters = [p.user_id for p in self.providers]
+
+        def columns(model, names):
+            return [model._meta.get_field(name).column for name in names]
+
+        def insert(model, names, rows):
+            chunk = []
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) == CHUNK:
+                    insert_rows(cursor, model._meta.db_table, columns(model, names), chunk)
+                    chunk = []
+            insert_rows(cursor, model._meta.db_table, columns(model, names), chunk)
+
+        insert(Case, ("ref_id", "first_name", "last_name", "gender", "dob",
+                      "reporter", "location", "created_at", "updated_at", "status"),
+               ((first + i, "bench", "bench%07d" % i, random.choice("MF"),
+                 # mostly under five
+                 now.date() - timedelta(days=random.randint(30, 2000)),
+                 random.choice(reporters), self.location.id,
+                 now - timedelta(days=random.randint(0, 365)), now, Case.STATUS_ACTIVE)
+                for i in xrange(cases)))
+
+        # (case id, reporter, created_at, dob) of the synthetic cases
+        synthetic = list(Case.objects.filter(ref_id__gte=first, first_name="bench")\
+                            .order_by().values_list("id", "reporter", "created_at", "dob"))
+
+        def history(most, every):
+            ''' up to most report dates of each case, about every days
+                apart from its creation '''
+            for id, reporter, created_at, dob in synthetic:
+                at = created_at
+                for n in range(random.randint(0, most)):
+                    at += timedelta(days=random.randint(1, every), minutes=random.randint(0, 600))
+                    if at > now:
+                        break
+                    yield id, reporter, at, dob
+
+        muac = []
+        for id, reporter, at, dob in history(4, 30):
+            mm = random.randint(95, 150)
+            status = mm < 110 and ReportMalnutrition.SEVERE_STATUS \
+                or mm < 125 and ReportMalnutrition.MODERATE_STATUS \
+                or ReportMalnutrition.HEALTHY_STATUS
+            muac.append((id, reporter, at, mm, status))
+        insert(ReportMalnutrition, ("case", "reporter", "entered_at", "muac", "status"), muac)
+
+        mrdt = [(id, reporter, at, random.random() < 0.5, random.random() < 0.3)
+                for id, reporter, at, dob in history(3, 60)]
+        insert(ReportMalaria, ("case", "reporter", "entered_at", "bednet", "result"), mrdt)
+
+        diarrhea = [(id, reporter, at, random.random() < 0.7, random.randint(1, 7),
+                     random.choice([s for s, name in ReportDiarrhea.STATUS_CHOICES]))
+                    for id, reporter, at, dob in history(2, 90)]
+        insert(ReportDiarrhea, ("case", "reporter", "entered_at", "ors", "days", "status"), diarrhea)
+
+        # the cases 9 to 60 months old, most of them vaccinated
+        sixtym, ninem = Case.measles_window()
+        measles = [(id, reporter, at, True) for id, reporter, at, dob in history(1, 120)
+                   if sixtym <= dob <= ninem and random.random() < 0.6]
+        insert(ReportMeasles, ("case", "reporter", "entered_at", "taken"), measles)
+
+        # the messages which filed them, and some refused ones
+        def messages():
+            for id, reporter, created_at, dob in synthetic:
+                yield ("bench", reporter, "new bench %d" % id, True, created_at)
+            for rows, text in ((muac, "muac +%d"), (mrdt, "mrdt +%d"),
+                               (diarrhea, "diarrhea +%d"), (measles, "measles +%d")):
+                for row in rows:
+                    yield ("bench", row[1], text % row[0], True, row[2])
+                    if random.random() < 0.1:
+                        yield ("bench", row[1], "%s *typo*" % (text % row[0]), False, row[2])
+        insert(MessageLog, ("mobile", "sent_by", "text", "was_handled", "created_at"), messages())
+
+        rebuild_case_status.Command().rebuild()
+        rebuild_daily_stats.Command().rebuild()
+        rebuild_activity.Command().rebuild()
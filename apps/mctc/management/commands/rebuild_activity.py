@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+''' Rebuild the reporters' activity counters from the cases and logs
+
+    ./rapidsms rebuild_activity
+
+    ReporterActivity and ReporterDay are kept up to date as cases and
+    messages are written; run this once after installing them to count
+    the history, or whenever they are suspected to have drifted.
+'''
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from mctc.models.general import Case
+from mctc.models.logs import MessageLog
+from mctc.models.activity import ReporterActivity, ReporterDay, COUNTERS
+
+class Command(BaseCommand):
+    help = "Count the cases and messages of every reporter again."
+
+    @transaction.commit_on_success
+    def handle(self, *args, **options):
+        print "%d reporters, %d days counted" % self.rebuild()
+
+    def rebuild(self):
+        ''' (reporters, days) counted, in the current transaction (see
+            bench_reports) '''
+        ReporterDay.objects.all().delete()
+        ReporterActivity.objects.all().delete()
+
+        days = {}
+        def count(reporter, day, counter):
+            counts = days.setdefault((reporter, day), dict([(c, 0) for c in COUNTERS]))
+            counts[counter] += 1
+
+        totals = {}
+        for reporter, created_at in Case.objects.order_by()\
+                .values_list("reporter", "created_at").iterator():
+            count(reporter, created_at.date(), "cases")
+            totals[reporter] = totals.get(reporter, 0) + 1
+
+        last = {}
+        for reporter, was_handled, created_at in MessageLog.objects.filter(sent_by__isnull=False)\
+                .order_by().values_list("sent_by", "was_handled", "created_at").iterator():
+            count(reporter, created_at.date(), "sms_sent")
+            count(reporter, created_at.date(), was_handled and "sms_processed" or "sms_refused")
+            last[reporter] = max(last.get(reporter, created_at), created_at)
+
+        for (reporter, day), counts in days.items():
+            ReporterDay(reporter_id=reporter, day=day, **counts).save(force_insert=True)
+        for reporter in set(totals.keys()) | set(last.keys()):
+            ReporterActivity(reporter_id=reporter, cases=totals.get(reporter, 0),
+                             last_activity=last.get(reporter, None)).save(force_insert=True)
+
+        return len(set(totals.keys()) | set(last.keys())), len(days)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+''' Rebuild the CaseStatus table from the reports
+
+    ./rapidsms rebuild_case_status
+
+    The table is kept up to date as reports are filed; run this once
+    after installing it, or if it was changed by hand.
+'''
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from mctc.models.status import CaseStatus
+
+REPORTS = (
+    ("muac.models", "ReportMalnutrition"),
+    ("mrdt.models", "ReportMalaria"),
+    ("diarrhea.models", "ReportDiarrhea"),
+    ("diagnosis.models", "ReportDiagnosis"),
+    ("measles.models", "ReportMeasles"),
+)
+
+class Command(BaseCommand):
+    help = "Rebuild the latest report of each case from the report tables."
+
+    @transaction.commit_on_success
+    def handle(self, *args, **options):
+        for name, count in self.rebuild():
+            print "%-20s %d cases" % (name, count)
+
+    def rebuild(self):
+        ''' [(report model name, number of cases)], in the current
+            transaction (see bench_reports) '''
+        counts = []
+        CaseStatus.objects.all().delete()
+        for module, name in REPORTS:
+            model = getattr(__import__(module, fromlist=[name]), name)
+            # the last report of each case wins
+            latest = {}
+            for report in model.objects.order_by("entered_at"):
+                latest[report.case_id] = report
+            for report in latest.values():
+                CaseStatus.record(report)
+            counts.append((name, len(latest)))
+        return counts
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+''' Rebuild the DailyStat table (the monitoring report) from the logs
+
+    ./rapidsms rebuild_daily_stats [--since=2009-06-01]
+
+    The table is kept up to date as messages, events and reports are
+    written; run this once after installing it to count the history.
+    Days from --since (default: the beginning) are counted again.
+'''
+
+from datetime import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from mctc.models.general import Provider, Case
+from mctc.models.logs import MessageLog, EventLog
+from mctc.models import stats
+from mctc.models.stats import DailyStat, message_stats, recount_reports
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option("--since", dest="since", default=None,
+                    help="first day to count, YYYY-MM-DD (default: everything)"),
+    )
+    help = "Count the daily statistics of the monitoring report from the logs."
+
+    @transaction.commit_on_success
+    def handle(self, *args, **options):
+        since = None
+        if options["since"]:
+            try:
+                since = datetime.strptime(options["since"], "%Y-%m-%d")
+            except ValueError:
+                raise CommandError("--since must be YYYY-MM-DD")
+        print "%d days counted" % self.rebuild(since)
+
+    def rebuild(self, since=None):
+        ''' the number of days counted from since, in the current
+            transaction (see bench_reports) '''
+
+        def after(queryset, field):
+            if since is None:
+                return queryset
+            return queryset.filter(**{"%s__gte" % field: since})
+
+        olds = DailyStat.objects.all()
+        if since is not None:
+            olds = olds.filter(day__gte=since.date())
+        olds.delete()
+
+        counts = {}
+        def count(day, metric, n=1):
+            counts[(day, metric)] = counts.get((day, metric), 0) + n
+
+        # messages, in rows of the shape the log writer inserts
+        for text, was_handled, created_at in after(MessageLog.objects.order_by(), "created_at")\
+                .values_list("text", "was_handled", "created_at").iterator():
+            for key, n in message_stats([{"text": text, "was_handled": was_handled,
+                                          "created_at": created_at}]).items():
+                count(key[0], key[1], n)
+
+        for message, created_at in after(EventLog.objects.order_by(), "created_at")\
+                .values_list("message", "created_at").iterator():
+            count(created_at.date(), stats.EVENT % message)
+
+        for date_joined in after(Provider.objects.filter(role=Provider.CHW_ROLE), "user__date_joined")\
+                .values_list("user__date_joined", flat=True).iterator():
+            count(date_joined.date(), stats.CHW_REGISTERED)
+
+        active = set()
+        for reporter, created_at in after(Case.objects.order_by(), "created_at")\
+                .values_list("reporter", "created_at").iterator():
+            active.add((reporter, created_at.date()))
+        for reporter, day in active:
+            count(day, stats.CHW_ACTIVE)
+
+        DailyStat.add(counts)
+
+        # reports, counted by day like file_report() does
+        from muac.models import ReportMalnutrition
+        from mrdt.models import ReportMalaria
+        for model in (ReportMalaria, ReportMalnutrition):
+            days = set([entered_at.date() for entered_at in
+                        after(model.objects.order_by(), "entered_at")\
+                            .values_list("entered_at", flat=True).iterator()])
+            for day in days:
+                recount_reports(model, day)
+
+        return len(set([day for day, metric in counts.keys()]))
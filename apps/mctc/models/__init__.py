@@ -1,3 +1,8 @@
 import general
 import reports
 import logs
+import broadcasts
+import status
+import stats
+import jobs
+import activity
@@ -0,0 +1,165 @@
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Q, Sum
+from django.db.models.signals import post_init, post_save, post_delete
+
+from datetime import datetime, date
+import threading
+
+from reporters.models import Reporter
+
+from mctc.models.general import Case
+
+# counted per reporter and per day
+COUNTERS    = ("cases", "sms_sent", "sms_processed", "sms_refused")
+
+# the router's worker threads can bump the same rows
+lock        = threading.Lock()
+
+def bump(model, keys, counts, condition=None, **values):
+    """ add counts ({field: n}) to the row of model matching keys, and
+    set values; the row is created if there is none. a row that does
+    not match condition (a Q), if given, is left as it is """
+    changes = dict([(field, F(field) + n) for field, n in counts.items()])
+    changes.update(values)
+    rows = model.objects.filter(**keys)
+    if condition is not None:
+        rows = rows.filter(condition)
+    lock.acquire()
+    try:
+        if rows.update(**changes):
+            return
+        if condition is not None and model.objects.filter(**keys)[:1]:
+            return
+        # the keys are ids, the constructor takes them by attname
+        # (reporter_id) only
+        fields = {}
+        for name, value in keys.items() + counts.items() + values.items():
+            fields[model._meta.get_field(name).attname] = value
+        # the lock only covers this process, the web server may insert
+        # the same row between the UPDATE and the INSERT
+        sid = transaction.savepoint()
+        try:
+            model(**fields).save(force_insert=True)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            rows.update(**changes)
+    finally:
+        lock.release()
+
+class ReporterActivity(models.Model):
+    """ What a reporter (the Reporter of a Provider, whose id is the
+        provider's user_id) did so far, kept up to date on write so the
+        scorecards and CHW listings do not count the cases and messages
+        again. Rebuild with ./rapidsms rebuild_activity """
+
+    reporter    = models.OneToOneField(Reporter, primary_key=True, related_name="activity")
+    cases       = models.IntegerField(default=0)
+    last_activity = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        app_label = "mctc"
+        verbose_name_plural = "Reporter Activity"
+
+    def __unicode__(self):
+        return u"%s: %s cases" % (self.reporter_id, self.cases)
+
+    @classmethod
+    def of(cls, reporter_id):
+        """ the activity of the reporter, an empty one if none yet """
+        try:
+            return cls.objects.get(reporter=reporter_id)
+        except cls.DoesNotExist:
+            return cls(reporter_id=reporter_id)
+
+    @classmethod
+    def for_reporters(cls, reporter_ids):
+        """ {reporter id: ReporterActivity}, in one query """
+        found = cls.objects.in_bulk(reporter_ids)
+        return dict([(id, found.get(id) or cls(reporter_id=id)) for id in reporter_ids])
+
+    def days_since_last_activity(self):
+        if self.last_activity is None:
+            return ""
+        return (date.today() - self.last_activity.date()).days
+
+class ReporterDay(models.Model):
+    """ the counters of one reporter for one day """
+
+    reporter    = models.ForeignKey(Reporter, related_name="days")
+    day         = models.DateField(db_index=True)
+    cases       = models.IntegerField(default=0)
+    sms_sent    = models.IntegerField(default=0)
+    sms_processed = models.IntegerField(default=0)
+    sms_refused = models.IntegerField(default=0)
+
+    class Meta:
+        app_label = "mctc"
+        unique_together = (("reporter", "day"),)
+
+    def __unicode__(self):
+        return u"%s %s" % (self.reporter_id, self.day)
+
+    @classmethod
+    def totals(cls, reporter_ids, first, last):
+        """ {reporter id: {counter: sum}} from day first to day last, in
+        one query. reporters with nothing are left out """
+        if isinstance(first, datetime):
+            first = first.date()
+        if isinstance(last, datetime):
+            last = last.date()
+        rows = cls.objects.filter(reporter__in=reporter_ids, day__gte=first, day__lte=last)\
+                .order_by().values("reporter")\
+                .annotate(**dict([(c, Sum(c)) for c in COUNTERS]))
+        return dict([(row["reporter"], dict([(c, row[c] or 0) for c in COUNTERS]))
+                     for row in rows])
+
+    @classmethod
+    def total(cls, reporter_id, first, last, counter):
+        return cls.totals([reporter_id], first, last).get(reporter_id, {}).get(counter, 0)
+
+def count_messages(rows):
+    """ count MessageLog rows (dicts) of known reporters, see
+    mctc.logwriter whose raw inserts send no signal """
+    days = {}
+    last = {}
+    for row in rows:
+        if not row["sent_by"]:
+            continue
+        key = (row["sent_by"], row["created_at"].date())
+        counts = days.setdefault(key, {"sms_sent": 0, "sms_processed": 0, "sms_refused": 0})
+        counts["sms_sent"] += 1
+        counts[row["was_handled"] and "sms_processed" or "sms_refused"] += 1
+        last[row["sent_by"]] = max(last.get(row["sent_by"], row["created_at"]), row["created_at"])
+    for (reporter, day), counts in days.items():
+        bump(ReporterDay, {"reporter": reporter, "day": day}, counts)
+    for reporter, created_at in last.items():
+        # checked in the UPDATE, a later activity written meanwhile stays
+        bump(ReporterActivity, {"reporter": reporter}, {},
+             Q(last_activity__lt=created_at) | Q(last_activity__isnull=True),
+             last_activity=created_at)
+
+def count_case(reporter_id, created_at, n):
+    bump(ReporterActivity, {"reporter": reporter_id}, {"cases": n})
+    bump(ReporterDay, {"reporter": reporter_id, "day": created_at.date()}, {"cases": n})
+
+def Case_loaded_handler(sender, **kwargs):
+    instance = kwargs['instance']
+    # to notice a transfer to another reporter on save
+    instance._counted_reporter = instance.reporter_id
+
+def Case_changed_handler(sender, **kwargs):
+    instance = kwargs['instance']
+    if kwargs['signal'] is post_delete:
+        count_case(instance.reporter_id, instance.created_at, -1)
+    elif kwargs.get('created', False):
+        count_case(instance.reporter_id, instance.created_at, 1)
+    elif getattr(instance, "_counted_reporter", instance.reporter_id) != instance.reporter_id:
+        count_case(instance._counted_reporter, instance.created_at, -1)
+        count_case(instance.reporter_id, instance.created_at, 1)
+    instance._counted_reporter = instance.reporter_id
+
+# this module is imported as mctc.models and apps.mctc.models, count once
+post_init.connect(Case_loaded_handler, sender=Case, dispatch_uid="activity.case.init")
+post_save.connect(Case_changed_handler, sender=Case, dispatch_uid="activity.case.save")
+post_delete.connect(Case_changed_handler, sender=Case, dispatch_uid="activity.case.delete")
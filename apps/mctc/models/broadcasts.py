@@ -0,0 +1,71 @@
+from django.db import models
+from django.utils.translation import ugettext_lazy as _
+
+from datetime import datetime
+
+from reporters.models import Reporter
+
+class Broadcast(models.Model):
+    """ A text sent to many phones (e.g. the measles summary), queued and
+        sent a few messages at a time by mctc.broadcaster """
+    STATUS_QUEUED   = "Q"
+    STATUS_SENDING  = "S"
+    STATUS_DONE     = "D"
+    STATUS_CHOICES = (
+        (STATUS_QUEUED, _("Queued")),
+        (STATUS_SENDING, _("Sending")),
+        (STATUS_DONE, _("Done")),
+    )
+
+    name        = models.CharField(max_length=50)
+    requested_by = models.ForeignKey(Reporter, null=True, blank=True)
+    # where to send the progress report, usually the requester's phone
+    notify      = models.CharField(max_length=255, blank=True)
+    notify_backend = models.CharField(max_length=30, blank=True)
+    status      = models.CharField(max_length=1, choices=STATUS_CHOICES, default=STATUS_QUEUED, db_index=True)
+    total       = models.PositiveIntegerField(default=0)
+    sent        = models.PositiveIntegerField(default=0)
+    failed      = models.PositiveIntegerField(default=0)
+    created_at  = models.DateTimeField()
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        app_label = "mctc"
+        ordering = ("-created_at",)
+
+    def __unicode__(self):
+        return u"%s %s/%s" % (self.name, self.sent, self.total)
+
+    def save(self, *args, **kwargs):
+        if not self.id:
+            self.created_at = datetime.now()
+        super(Broadcast, self).save(*args, **kwargs)
+
+    def progress(self):
+        return _("%(name)s: %(sent)s of %(total)s messages sent, %(failed)s failed.") % {
+            "name": self.name, "sent": self.sent, "total": self.total, "failed": self.failed}
+
+class BroadcastMessage(models.Model):
+    """ one message of a broadcast, to one phone """
+    STATUS_PENDING  = "P"
+    STATUS_SENT     = "S"
+    STATUS_ERROR    = "E"
+    STATUS_CHOICES = (
+        (STATUS_PENDING, _("Pending")),
+        (STATUS_SENT, _("Sent")),
+        (STATUS_ERROR, _("Error")),
+    )
+
+    broadcast   = models.ForeignKey(Broadcast, related_name="messages")
+    backend     = models.CharField(max_length=30, db_index=True)
+    identity    = models.CharField(max_length=255)
+    text        = models.CharField(max_length=160)
+    status      = models.CharField(max_length=1, choices=STATUS_CHOICES, default=STATUS_PENDING, db_index=True)
+    sent_at     = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        app_label = "mctc"
+        ordering = ("id",)
+
+    def __unicode__(self):
+        return u"%s > %s: %s" % (self.broadcast.name, self.identity, self.text[:20])
@@ -1,8 +1,10 @@
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Max
 from django.contrib.auth.models import User
 from django.utils.translation import ugettext_lazy as _
 
 from datetime import datetime, timedelta, date
+import threading
 
 from reporters.models import Reporter
 from locations.models import Location
@@ -135,6 +137,82 @@ class Provider(models.Model):
         except models.ObjectDoesNotExist:
             return None
 
+class Sequence(models.Model):
+    """ next free id of a table whose ids are handed out in blocks,
+        see IdAllocator """
+    name    = models.CharField(max_length=50, unique=True)
+    next_id = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        app_label = "mctc"
+
+    def __unicode__ (self):
+        return u"%s: %s" % (self.name, self.next_id)
+
+class IdAllocator(object):
+    """ hands out primary keys before the row is inserted
+
+        Blocks of `block` ids are reserved from the Sequence row of the
+        table (one UPDATE per block, safe between the web server and the
+        router), so that values derived from the id (Case.ref_id) can be
+        computed before the INSERT. Ids of a block left unused when the
+        process stops are skipped. The Sequence row is created with the
+        first block, past the highest id already in the table.
+
+        Inside a managed transaction the id is taken one at a time, in
+        that transaction: committing the block there would commit the
+        caller's work, and ids kept for later would be handed out again
+        by the other process once the caller rolls back. """
+
+    def __init__(self, model, block=20):
+        self.model  = model
+        self.name   = model._meta.db_table
+        self.block  = block
+        self.lock   = threading.Lock()
+        self.ids    = iter([])
+
+    def next(self):
+        self.lock.acquire()
+        try:
+            try:
+                return self.ids.next()
+            except StopIteration:
+                start, size = self.reserve()
+                self.ids = iter(xrange(start, start + size))
+                return self.ids.next()
+        finally:
+            self.lock.release()
+
+    def reserve(self):
+        """ reserve the next block, return its first id and its size """
+        if transaction.is_managed():
+            # undone with the caller's transaction if it rolls back
+            return self.take_block(1), 1
+        start = self.take_block(self.block)
+        transaction.commit_unless_managed()
+        return start, self.block
+
+    def take_block(self, size):
+        # the UPDATE locks the row until the commit, so the block read
+        # back is ours
+        if not Sequence.objects.filter(name=self.name).update(next_id=F("next_id") + size):
+            # the first block of the table
+            self.create_sequence()
+            Sequence.objects.filter(name=self.name).update(next_id=F("next_id") + size)
+        return Sequence.objects.get(name=self.name).next_id - size
+
+    def create_sequence(self):
+        # rows loaded from fixtures or created before the sequence
+        # existed did not go through the allocator
+        highest = self.model.objects.aggregate(highest=Max("pk"))["highest"] or 0
+        sid = transaction.savepoint()
+        try:
+            Sequence.objects.create(name=self.name, next_id=highest + 1)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # created by the other process in the meantime
+            transaction.savepoint_rollback(sid)
+
 class Case(models.Model):    
     class Meta:
         app_label = "mctc"
@@ -183,15 +261,18 @@ class Case(models.Model):
             sum += n
         return x * 10 + 10 - sum % 10
 
-    def save (self, *args):
+    def save (self, *args, **kwargs):
         if not self.id:
             self.created_at = self.updated_at = datetime.now()
+            # the id comes from a reserved block, so the ref_id is known
+            # before the row is written and the case is one INSERT
+            self.id = Case.ids.next()
+            kwargs["force_insert"] = True
         else:
             self.updated_at = datetime.now()
-        super(Case, self).save(*args)
         if not self.ref_id:
             self.ref_id = self._luhn(self.id)
-            super(Case, self).save(*args)
+        super(Case, self).save(*args, **kwargs)
     
     def get_dictionary(self):
         return {
@@ -242,31 +323,34 @@ class Case(models.Model):
         return False
     
     @classmethod
-    def list_e_4_measles(cls,provider):
+    def measles_window(cls):
+        """ (earliest, latest) dob of the children due a measles shot,
+        9 to 60 months old """
         ninem = date.today() - timedelta(int(30.4375*9))
         sixtym = date.today() - timedelta(int(30.4375*60))
+        return sixtym, ninem
+
+    @classmethod
+    def list_e_4_measles(cls,provider):
+        sixtym, ninem = cls.measles_window()
         
         try:
-            return cls.objects.filter(provider=provider, dob__lte=ninem, dob__gte=sixtym)
+            return cls.objects.filter(reporter=provider.user_id, dob__lte=ninem, dob__gte=sixtym)
         except models.ObjectDoesNotExist:
             return None
         
     @classmethod
     def count_by_provider(cls, provider):
-        try:
-            return cls.objects.filter(provider=provider).count()
-        except models.ObjectDoesNotExist:
-            return None
+        # imported here, mctc.models.activity imports this module
+        from mctc.models.activity import ReporterActivity
+        return ReporterActivity.of(provider.user_id).cases
     
     @classmethod
     def count_for_last_30_days(cls, provider):
-        thirty_days = timedelta(days=30)
+        from mctc.models.activity import ReporterDay
         end_date = date.today()
-        start_date = end_date - thirty_days
-        try:
-            return cls.objects.filter(provider=provider, created_at__lte=end_date, created_at__gte=start_date).count()
-        except models.ObjectDoesNotExist:
-            return None
+        start_date = end_date - timedelta(days=30)
+        return ReporterDay.total(provider.user_id, start_date, end_date, "cases")
 
     def set_status(self, state):
         states = dict([ (k, v) for (k,v) in self.STATUS_CHOICES])
@@ -276,6 +360,8 @@ class Case(models.Model):
         self.status = state
         return state
 
+Case.ids = IdAllocator(Case)
+
 class CaseNote(models.Model):
     case        = models.ForeignKey(Case, related_name="notes", db_index=True)
     created_by  = models.ForeignKey(Reporter, db_index=True)
@@ -0,0 +1,62 @@
+from django.db import models
+from django.contrib.auth.models import User
+from django.utils.translation import ugettext_lazy as _
+
+from datetime import datetime
+
+class ReportJob(models.Model):
+    """ A report (e.g. last_30_days for every clinic) built in the
+        background by mctc.reportjobs, and the file it produced """
+    STATUS_QUEUED   = "Q"
+    STATUS_RUNNING  = "R"
+    STATUS_DONE     = "D"
+    STATUS_ERROR    = "E"
+    STATUS_CHOICES = (
+        (STATUS_QUEUED, _("Queued")),
+        (STATUS_RUNNING, _("Running")),
+        (STATUS_DONE, _("Done")),
+        (STATUS_ERROR, _("Failed")),
+    )
+
+    # same request, same data: same key, see ReportCache.key
+    key         = models.CharField(max_length=40, db_index=True)
+    view        = models.CharField(max_length=100)
+    path        = models.CharField(max_length=255)
+    # the view's arguments and the request's POST, as json
+    params      = models.TextField(blank=True)
+    requested_by = models.ForeignKey(User, null=True, blank=True)
+    # host:pid of the web server process building it, see ReportJobs.recover
+    owner       = models.CharField(max_length=100, blank=True)
+    status      = models.CharField(max_length=1, choices=STATUS_CHOICES, default=STATUS_QUEUED, db_index=True)
+    done        = models.PositiveIntegerField(default=0)
+    total       = models.PositiveIntegerField(default=0)
+    content_type = models.CharField(max_length=100, blank=True)
+    filename    = models.CharField(max_length=255, blank=True)
+    error       = models.TextField(blank=True)
+    created_at  = models.DateTimeField()
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        app_label = "mctc"
+        ordering = ("-created_at",)
+
+    def __unicode__(self):
+        return u"%s %s" % (self.path, self.get_status_display())
+
+    def save(self, *args, **kwargs):
+        if not self.id:
+            self.created_at = datetime.now()
+        super(ReportJob, self).save(*args, **kwargs)
+
+    def get_absolute_url(self):
+        return "/reports/jobs/%s/" % self.id
+
+    def percent(self):
+        if self.status == self.STATUS_DONE:
+            return 100
+        if not self.total:
+            return 0
+        return int(100 * self.done / self.total)
+
+    def finished(self):
+        return self.status in (self.STATUS_DONE, self.STATUS_ERROR)
@@ -105,42 +105,30 @@ class MessageLog(models.Model):
     
     @classmethod
     def count_by_provider(cls,provider, duration_end=None,duration_start=None):
-        if provider is None:
-            return None
-        try:
-            if duration_start is None or duration_end is None:
-                return cls.objects.filter(provider=provider).count()
-            return cls.objects.filter(created_at__lte=duration_end, created_at__gte=duration_start).filter(sent_by=provider.user_id).count()
-        except models.ObjectDoesNotExist:
-            return None
+        return cls.count_for_provider(provider, "sms_sent", duration_end, duration_start)
         
     @classmethod
     def count_processed_by_provider(cls,provider, duration_end=None,duration_start=None):
-        if provider is None:
-            return None
-        try:
-            if duration_start is None or duration_end is None:
-                return cls.objects.filter(provider=provider.user_id).count()
-            return cls.objects.filter(created_at__lte=duration_end, created_at__gte=duration_start).filter(sent_by=provider.user_id, was_handled=True).count()
-        except models.ObjectDoesNotExist:
-            return None
+        return cls.count_for_provider(provider, "sms_processed", duration_end, duration_start)
     
     @classmethod
     def count_refused_by_provider(cls,provider, duration_end=None,duration_start=None):
+        return cls.count_for_provider(provider, "sms_refused", duration_end, duration_start)
+
+    @classmethod
+    def count_for_provider(cls, provider, counter, duration_end=None, duration_start=None):
+        """ the messages of the provider, from the counters kept by
+        mctc.models.activity, over every day if no duration is given """
+        # imported here, mctc.models.activity imports mctc.models.general
+        from mctc.models.activity import ReporterDay
         if provider is None:
             return None
-        try:
-            if duration_start is None or duration_end is None:
-                return cls.objects.filter(provider=provider).count()
-            return cls.objects.filter(created_at__lte=duration_end, created_at__gte=duration_start).filter(sent_by=provider.user_id, was_handled=True).count()
-        except models.ObjectDoesNotExist:
-            return None
+        if duration_start is None or duration_end is None:
+            duration_start, duration_end = date.min, date.max
+        return ReporterDay.total(provider.user_id, duration_start, duration_end, counter)
     
     @classmethod
     def days_since_last_activity(cls,provider):
-        today = date.today()
-        logs = MessageLog.objects.order_by("created_at").filter(created_at__lte=today,sent_by=provider.user_id).reverse()
-        if not logs:
-            return ""
-        return (today - logs[0].created_at.date()).days
+        from mctc.models.activity import ReporterActivity
+        return ReporterActivity.of(provider.user_id).days_since_last_activity()
         
\ No newline at end of file
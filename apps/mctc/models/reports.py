@@ -1,10 +1,12 @@
 from django.db import models
-from django.db.models import ObjectDoesNotExist
+from django.db.models import ObjectDoesNotExist, Count, Q
 from django.contrib.auth.models import User
 from django.utils.translation import ugettext_lazy as _
 
 from mctc.models.general import Case, Provider, Facility
-from mctc.models.logs import MessageLog
+from reporters.models import Reporter
+from mctc.models.status import CaseStatus
+from mctc.models.activity import ReporterActivity, ReporterDay
 from measles.models import ReportMeasles
 
 from datetime import datetime, date, timedelta
@@ -13,28 +15,24 @@ class Report:
     def get_alert_recipients(self):
         """ Each report will send an alert, how it will choose when to send an alert
         is up to the model, however. """
+        # imported here, mctc.caches imports this module
+        from mctc.caches import alert_recipients
+
         # this is the reporter, the provider or the CHW depending what you call it
         provider = self.provider
-        facility = provider.clinic
-        assert facility, "This provider does not have a clinic."
-
-        recipients = []
-
-        # find all the people assigned to alerts from this facility
-        for user in facility.following_clinics.all():
-            # only send if they want
-            if user.alerts:
-                if user not in recipients:
-                    recipients.append(user)
-        
-        
-        # find all the users monitoring this user
-        for user in provider.following_users.all():
-            if user.alerts:
-                if user not in recipients:
-                    recipients.append(user)
+        # the follow lists hold Reporter and Location ids; a provider's
+        # reporter shares the id of its user
+        reporter_id = provider.user_id
+        case = getattr(self, "case", None)
+        if case is not None:
+            location_id = case.location_id
+        else:
+            locations = Reporter.objects.filter(id=reporter_id).values_list("location", flat=True)
+            assert locations, "This provider has no reporter."
+            location_id = locations[0]
 
-        return recipients
+        # the people following this location or this reporter, who want alerts
+        return alert_recipients.recipients(location_id=location_id, reporter_id=reporter_id)
 
 class Observation(models.Model):
     uid = models.CharField(max_length=15)
@@ -54,9 +52,83 @@ class ReportCHWStatus(Report, models.Model):
         verbose_name = "CHW Perfomance Report"
         app_label = "mctc"
     @classmethod
+    def chw_counts(cls, providers, duration_start, duration_end, muac_duration_start):
+        """ the numbers of the CHW report for all of providers, with one
+        grouped query per number whatever the number of providers.
+        returns {provider id: {...}} """
+        # imported here, muac and mrdt import this module
+        from muac.models import ReportMalnutrition
+        from mrdt.models import ReportMalaria
+
+        # a provider reports as the Reporter with the id of its user,
+        # like MessageLog.count_by_provider does
+        reporters = [p.user_id for p in providers]
+        today = date.today()
+
+        def count_by(queryset, field):
+            # order_by() drops the default ordering, which would end up
+            # in the GROUP BY
+            return dict([(row[field], row["count"]) for row in
+                         queryset.order_by().values(field).annotate(count=Count("id"))])
+
+        # cases and messages are counted on write, see mctc.models.activity
+        activity    = ReporterActivity.for_reporters(reporters)
+        new_cases   = ReporterDay.totals(reporters, today - timedelta(days=30), today)
+        messages    = ReporterDay.totals(reporters, duration_start, duration_end)
+        malaria     = count_by(ReportMalaria.objects.filter(reporter__in=reporters,
+                                entered_at__lte=duration_end, entered_at__gte=duration_start),
+                               "reporter")
+        muac        = count_by(ReportMalnutrition.objects.filter(reporter__in=reporters,
+                                entered_at__lte=duration_end, entered_at__gte=muac_duration_start),
+                               "reporter")
+
+        counts = {}
+        for provider in providers:
+            id = provider.user_id
+            days = messages.get(id, {})
+            counts[provider.id] = {
+                "num_cases":            activity[id].cases,
+                "num_new_cases":        new_cases.get(id, {}).get("cases", 0),
+                "num_malaria_reports":  malaria.get(id, 0),
+                "num_muac":             muac.get(id, 0),
+                "sms_sent":             days.get("sms_sent", 0),
+                "sms_processed":        days.get("sms_processed", 0),
+                "sms_refused":          days.get("sms_refused", 0),
+                "days_since_last_activity": activity[id].days_since_last_activity(),
+            }
+        return counts
+
+    @classmethod
     def get_providers_by_clinic(cls, duration_start, duration_end, muac_duration_start, clinic_id=None):
-        
-    
+        return cls.get_providers_by_clinics(duration_start, duration_end,
+                                            muac_duration_start, [clinic_id])[clinic_id]
+
+    @classmethod
+    def get_providers_by_clinics(cls, duration_start, duration_end, muac_duration_start, clinic_ids):
+        """ the CHW report of each clinic, as {clinic id: (rows, fields)},
+        computed with the same number of queries for one or all clinics """
+        # clinic ids may come from the url, as strings
+        ids = [int(id) for id in clinic_ids if id is not None]
+        in_clinics = Q(clinic__in=ids)
+        if None in clinic_ids:
+            in_clinics = in_clinics | Q(clinic__isnull=True)
+        providers = list(Provider.objects.select_related("user").order_by("user")\
+                            .filter(in_clinics, role=1))
+        counts = cls.chw_counts(providers, duration_start, duration_end, muac_duration_start)
+
+        by_clinic = {}
+        for provider in providers:
+            by_clinic.setdefault(provider.clinic_id, []).append(provider)
+
+        reports = {}
+        for clinic_id in clinic_ids:
+            key = clinic_id is not None and int(clinic_id) or None
+            reports[clinic_id] = cls.chw_table(by_clinic.get(key, []), counts,
+                                               duration_start, duration_end)
+        return reports
+
+    @classmethod
+    def chw_table(cls, providers, counts, duration_start, duration_end):
         ps      = []
         fields  = []
         counter = 0
@@ -66,86 +138,102 @@ class ReportCHWStatus(Report, models.Model):
         clinic_sent = 0
         clinic_processed = 0
         clinic_refused = 0
-        
-        if clinic_id is not None:
-            providers = Provider.list_by_clinic(clinic_id)
-            for provider in providers:
-                p = {}
-                counter = counter + 1
-                p['counter'] = "%d"%counter
-                p['provider'] = provider
-                p['num_cases'] = Case.count_by_provider(provider)
-                p['num_new_cases'] = Case.count_for_last_30_days(provider)
-                p_muac = ReportMalaria.count_by_provider(provider, duration_end, duration_start)
-                p['num_malaria_reports'] = p_muac
-                clinic_mrdt = clinic_mrdt + p_muac 
-                num_cases = Case.count_by_provider(provider)
-                clinic_cases = clinic_cases + num_cases
-                num_muac = ReportMalnutrition.count_by_provider(provider, duration_end, muac_duration_start)                
-                clinic_muac = clinic_muac + num_muac
-                if num_cases == 0:
-                    muac_percentage = 0
-                else:
-                    muac_percentage  = round(float(float(num_muac)/float(num_cases))*100, 0)
-                p['num_muac_reports'] = "%d %d%% (%s/%s)"%(num_muac, muac_percentage, num_muac, num_cases)
-                sms_sent = MessageLog.count_by_provider(provider, duration_end, duration_start)
-                clinic_sent = clinic_sent + sms_sent
-                p['sms_sent'] = sms_sent
-                sms_processed = MessageLog.count_processed_by_provider(provider, duration_end, duration_start)
-                clinic_processed = clinic_processed + sms_processed
-                p['sms_processed'] = sms_processed
-                sms_refused = MessageLog.count_refused_by_provider(provider, duration_end, duration_start)
-                clinic_refused = clinic_refused + sms_refused
-                p['sms_refused'] = sms_refused
-                if p['sms_sent'] != 0:
-                    p['sms_rate'] = int(float(float(p['sms_processed'])/float(p['sms_sent'])*100))
-                else:
-                    p['sms_rate'] = 0
-                #p['sms_rate'] = "%s%%"%p['sms_rate']
-                last_activity = MessageLog.days_since_last_activity(provider)
-                if last_activity == "" or ((duration_end - duration_start).days < last_activity):
-                    p['days_since_last_activity'] = "No Activity"
-                else:
-                    p['days_since_last_activity'] = "%s days ago"%last_activity
-                                    
-                ps.append(p)
-            
-            #ps = sorted(ps)
-            # Summary    
+
+        for provider in providers:
+            c = counts[provider.id]
             p = {}
-            p['counter'] = ""
-            p['provider'] = "Summary"
-            p['num_cases'] = clinic_cases
-            p['num_malaria_reports'] = clinic_mrdt
-            num_cases = clinic_cases
-            num_muac = clinic_muac
+            counter = counter + 1
+            p['counter'] = "%d"%counter
+            p['provider'] = provider
+            p['num_cases'] = c['num_cases']
+            p['num_new_cases'] = c['num_new_cases']
+            p['num_malaria_reports'] = c['num_malaria_reports']
+            clinic_mrdt = clinic_mrdt + c['num_malaria_reports']
+            num_cases = c['num_cases']
+            clinic_cases = clinic_cases + num_cases
+            num_muac = c['num_muac']
+            clinic_muac = clinic_muac + num_muac
             if num_cases == 0:
                 muac_percentage = 0
             else:
                 muac_percentage  = round(float(float(num_muac)/float(num_cases))*100, 0)
-            p['num_muac_reports'] = "%d %% (%s/%s)"%(muac_percentage, num_muac, num_cases)
-            p['sms_sent'] = clinic_sent
-            p['sms_processed'] = clinic_processed
-            p['sms_refused'] = clinic_refused
+            p['num_muac_reports'] = "%d %d%% (%s/%s)"%(num_muac, muac_percentage, num_muac, num_cases)
+            p['sms_sent'] = c['sms_sent']
+            clinic_sent = clinic_sent + c['sms_sent']
+            p['sms_processed'] = c['sms_processed']
+            clinic_processed = clinic_processed + c['sms_processed']
+            p['sms_refused'] = c['sms_refused']
+            clinic_refused = clinic_refused + c['sms_refused']
             if p['sms_sent'] != 0:
                 p['sms_rate'] = int(float(float(p['sms_processed'])/float(p['sms_sent'])*100))
             else:
                 p['sms_rate'] = 0
-            #p['sms_rate'] = "%s%%"%p['sms_rate']
-            p['days_since_last_activity'] = "" 
-                                
+            last_activity = c['days_since_last_activity']
+            if last_activity == "" or ((duration_end - duration_start).days < last_activity):
+                p['days_since_last_activity'] = "No Activity"
+            else:
+                p['days_since_last_activity'] = "%s days ago"%last_activity
+
             ps.append(p)
-                    # caseid +|Y lastname firstname | sex | dob/age | guardian | provider  | date
-            fields.append({"name": '#', "column": None, "bit": "{{ object.counter }}" })
-            fields.append({"name": 'PROVIDER', "column": None, "bit": "{{ object.provider }}" })
-            fields.append({"name": 'TOTAL CASES', "column": None, "bit": "{{ object.num_cases}}" })
-            fields.append({"name": '# NEW CASES', "column": None, "bit": "{{ object.num_new_cases}}" })
-            fields.append({"name": 'MRDT', "column": None, "bit": "{{ object.num_malaria_reports }}" })
-            fields.append({"name": 'MUAC', "column": None, "bit": "{{ object.num_muac_reports }}" })
-            fields.append({"name": 'RATE', "column": None, "bit": "{{ object.sms_rate }}% ({{ object.sms_processed }}/{{ object.sms_sent }})" })
-            fields.append({"name": 'LAST ACTVITY', "column": None, "bit": "{{ object.days_since_last_activity }}" })
-            return ps, fields 
-        
+
+        # Summary
+        p = {}
+        p['counter'] = ""
+        p['provider'] = "Summary"
+        p['num_cases'] = clinic_cases
+        p['num_malaria_reports'] = clinic_mrdt
+        num_cases = clinic_cases
+        num_muac = clinic_muac
+        if num_cases == 0:
+            muac_percentage = 0
+        else:
+            muac_percentage  = round(float(float(num_muac)/float(num_cases))*100, 0)
+        p['num_muac_reports'] = "%d %% (%s/%s)"%(muac_percentage, num_muac, num_cases)
+        p['sms_sent'] = clinic_sent
+        p['sms_processed'] = clinic_processed
+        p['sms_refused'] = clinic_refused
+        if p['sms_sent'] != 0:
+            p['sms_rate'] = int(float(float(p['sms_processed'])/float(p['sms_sent'])*100))
+        else:
+            p['sms_rate'] = 0
+        p['days_since_last_activity'] = ""
+
+        ps.append(p)
+                # caseid +|Y lastname firstname | sex | dob/age | guardian | provider  | date
+        fields.append({"name": '#', "column": None, "bit": "{{ object.counter }}" })
+        fields.append({"name": 'PROVIDER', "column": None, "bit": "{{ object.provider }}" })
+        fields.append({"name": 'TOTAL CASES', "column": None, "bit": "{{ object.num_cases}}" })
+        fields.append({"name": '# NEW CASES', "column": None, "bit": "{{ object.num_new_cases}}" })
+        fields.append({"name": 'MRDT', "column": None, "bit": "{{ object.num_malaria_reports }}" })
+        fields.append({"name": 'MUAC', "column": None, "bit": "{{ object.num_muac_reports }}" })
+        fields.append({"name": 'RATE', "column": None, "bit": "{{ object.sms_rate }}% ({{ object.sms_processed }}/{{ object.sms_sent }})" })
+        fields.append({"name": 'LAST ACTVITY', "column": None, "bit": "{{ object.days_since_last_activity }}" })
+        return ps, fields
+
+    @classmethod
+    def measles_coverage(cls, providers):
+        """ total, eligible and vaccinated cases of each of providers, with
+        three queries whatever the number of cases.
+        returns {provider id: (cases, eligible, vaccinated)} """
+        # a provider reports as the Reporter with the id of its user
+        reporters = [p.user_id for p in providers]
+        dob_from, dob_to = Case.measles_window()
+
+        def count_by_reporter(queryset):
+            return dict([(row["reporter"], row["count"]) for row in
+                         queryset.order_by().values("reporter").annotate(count=Count("id"))])
+
+        cases       = count_by_reporter(Case.objects.filter(reporter__in=reporters))
+        eligible    = count_by_reporter(Case.objects.filter(reporter__in=reporters,
+                                        dob__gte=dob_from, dob__lte=dob_to))
+        vaccinated  = ReportMeasles.count_vaccinated(reporters, dob_from, dob_to)
+
+        coverage = {}
+        for provider in providers:
+            id = provider.user_id
+            coverage[provider.id] = (cases.get(id, 0), eligible.get(id, 0), vaccinated.get(id, 0))
+        return coverage
+
     @classmethod
     def measles_summary(cls, duration_start, duration_end, muac_duration_start, clinic_id=None):            
         ps      = []
@@ -155,28 +243,19 @@ class ReportCHWStatus(Report, models.Model):
         vaccinated_cases = 0
         clinic_cases = 0
         if clinic_id is not None:
-            providers = Provider.list_by_clinic(clinic_id)
+            providers = list(Provider.list_by_clinic(clinic_id).select_related("user"))
+            coverage = cls.measles_coverage(providers)
             for provider in providers:
                 p = {}
                 counter = counter + 1
                 p['counter'] = "%d"%counter
                 p['provider'] = provider
-                p['num_cases'] = Case.count_by_provider(provider)
-                cases = Case.list_e_4_measles(provider)
-                p['eligible_cases'] = cases.count()                
+                p['num_cases'], p['eligible_cases'], p['vaccinated_cases'] = coverage[provider.id]
                 eligible_cases += p['eligible_cases'] 
                 clinic_cases = clinic_cases + p['num_cases']
-                #slow count
-                slowcount = 0
-                for case in cases:
-                    if ReportMeasles.is_vaccinated(case):
-                        slowcount += 1 
-                mcases = ReportMeasles.get_vaccinated(provider)
-                #p['vaccinated_cases'] = mcases.count()                
-                p['vaccinated_cases'] = slowcount
                 p['not_vaccinated_cases'] = p['eligible_cases'] - p['vaccinated_cases']
                 vaccinated_cases += p['vaccinated_cases']
-                p['sms_sent'] = int(round(float(float(p['vaccinated_cases'])/float(p['eligible_cases']))*100, 0)) 
+                p['sms_sent'] = percentage(p['vaccinated_cases'], p['eligible_cases'])
                                     
                 ps.append(p)
             
@@ -189,8 +268,7 @@ class ReportCHWStatus(Report, models.Model):
             p['eligible_cases'] = eligible_cases
             p['vaccinated_cases'] = vaccinated_cases     
             p['not_vaccinated_cases'] = eligible_cases - vaccinated_cases  
-            sms_sent = int(round(float(float(vaccinated_cases)/float(eligible_cases))*100, 0))
-            p['sms_sent'] = sms_sent
+            p['sms_sent'] = percentage(vaccinated_cases, eligible_cases)
             ps.append(p)
                     # caseid +|Y lastname firstname | sex | dob/age | guardian | provider  | date
             fields.append({"name": '#', "column": None, "bit": "{{ object.counter }}" })
@@ -205,37 +283,29 @@ class ReportCHWStatus(Report, models.Model):
     @classmethod
     def measles_mini_summary(cls):            
         ps      = []
-        fields  = []
         tcounter = 0
         teligible_cases=0
         tvaccinated_cases = 0
         tclinic_cases = 0
+        # the providers of every clinic, counted in one go
+        providers = list(Provider.objects.order_by("user").filter(role=1, clinic__isnull=False))
+        coverage = cls.measles_coverage(providers)
+        by_clinic = {}
+        for provider in providers:
+            by_clinic.setdefault(provider.clinic_id, []).append(provider)
+
         clinics = Facility.objects.all()
         for clinic in clinics:
-            providers = Provider.list_by_clinic(clinic)
-            p = {}
             eligible_cases=0
             vaccinated_cases = 0
             clinic_cases = 0
             counter = 0
-            p['clinic'] = clinic
-            p['num_cases'] = 0
-            p['eligible_cases'] = 0
-            p['vaccinated_cases'] = 0
-            for provider in providers:                
+            for provider in by_clinic.get(clinic.id, []):
                 counter = counter + 1
-                #p['counter'] = "%d"%counter                
-                cases = Case.list_e_4_measles(provider)                 
-                eligible_cases += cases.count() 
-                clinic_cases = clinic_cases + Case.count_by_provider(provider)
-                mcases = ReportMeasles.get_vaccinated(provider)
-                #slow count
-                slowcount = 0
-                for case in cases:
-                    if ReportMeasles.is_vaccinated(case):
-                        slowcount += 1     
-                #vaccinated_cases += mcases.count() 
-                vaccinated_cases += slowcount
+                num_cases, eligible, vaccinated = coverage[provider.id]
+                eligible_cases += eligible
+                clinic_cases = clinic_cases + num_cases
+                vaccinated_cases += vaccinated
             
             # Summary    
             p = {}
@@ -250,7 +320,6 @@ class ReportCHWStatus(Report, models.Model):
             teligible_cases += eligible_cases
             tvaccinated_cases += vaccinated_cases
             tclinic_cases +=clinic_cases
-                    # caseid +|Y lastname firstname | sex | dob/age | guardian | provider  | date
         p = {}
         p['clinic'] = "Total:"
         p['counter'] = ""
@@ -260,6 +329,11 @@ class ReportCHWStatus(Report, models.Model):
         ps.append(p)
         return ps       
         
+def percentage(part, total):
+    if not total:
+        return 0
+    return int(round(float(float(part)/float(total))*100, 0))
+
 class ReportAllPatients(Report, models.Model):
     class Meta:
         verbose_name = "CHW Perfomance Report"
@@ -270,53 +344,24 @@ class ReportAllPatients(Report, models.Model):
         fields  = []
         counter = 0
         if provider_id is not None:
-            cases   = Case.objects.order_by("last_name").filter(provider=provider_id)
+            provider = Provider.objects.get(id=provider_id)
+            cases   = list(Case.objects.order_by("last_name").filter(reporter=provider.user_id))
+            # the latest reports of every case, see CaseStatus
+            statuses = CaseStatus.for_cases(cases)
             
             for case in cases:
+                status  = statuses[case.id]
                 q   = {}
                 q['case']   = case
                 counter = counter + 1
                 q['counter'] = "%d"%counter
-                try:
-                    muacc   = ReportMalnutrition.objects.filter(case=case).latest()
-                    #q['malnut'] = u"%(diag)s on %(date)s" % {'diag': muacc.diagnosis_msg(), 'date': muacc.entered_at.strftime("%Y-%m-%d")}
-                    q['malnut_muac'] = "%s (%smm)"%(muacc.get_status_display(), muacc.muac)
-                    q['malnut_symptoms'] = muacc.symptoms_keys()
-                    q['malnut_days_since_last_update'] = muacc.days_since_last_activity()
-                except ObjectDoesNotExist:
-                    q['malnut_muac'] = ""
-                    q['malnut_symptoms'] = ""
-                    q['malnut_days_since_last_update'] = ""
-                try:
-                    orsc   = ReportDiarrhea.objects.filter(case=case).latest()
-                    q['diarrhea'] = u"%(diag)s on %(date)s" % {'diag': orsc.diagnosis_msg(), 'date': orsc.entered_at.strftime("%Y-%m-%d")}
-                except ObjectDoesNotExist:
-                    q['diarrhea'] = None
-                    
-                try:
-                    twoweeksago = date.today() - timedelta(14)
-                    mrdtc   = ReportMalaria.objects.filter(case=case, entered_at__gte=twoweeksago).latest()
-                    mrdtcd  = mrdtc.get_dictionary()
-                    #q['malaria'] = u"result:%(res)s bednet:%(bed)s obs:%(obs)s on %(date)s" % {'res': mrdtcd['result_text'], 'bed': mrdtcd['bednet_text'], 'obs': mrdtcd['observed'], 'date': mrdtc.entered_at.strftime("%Y-%m-%d")}
-                    q['malaria_result'] = mrdtc.results_for_malaria_result()
-                    q['malaria_bednet'] = mrdtc.results_for_malaria_bednet()
-                except ObjectDoesNotExist:
-                    q['malaria_result'] = ""
-                    q['malaria_bednet'] = ""
-                    
-                num_of_malaria_cases = ReportMalaria.num_reports_by_case(case)                
-                if num_of_malaria_cases is not None and num_of_malaria_cases > 1:
-                     q['malaria_result'] = q['malaria_result'] + "(%sX)"%num_of_malaria_cases
-                     last_mrdt = ReportMalaria.days_since_last_mrdt(case)
-                     if last_mrdt is not "" and last_mrdt < 15:
-                         q['malaria_result'] = q['malaria_result'] + " %s days ago"%last_mrdt
-                    
-                try:
-                    dc      = ReportDiagnosis.objects.filter(case=case).latest('entered_at')
-                    dcd     = dc.get_dictionary()
-                    q['diagnosis'] = u"diag:%(diag)s labs:%(lab)s on %(date)s" % {'diag': dcd['diagnosis'], 'lab': dcd['labs_text'], 'date': dc.entered_at.strftime("%Y-%m-%d")}
-                except ObjectDoesNotExist:
-                    q['diagnosis'] = None
+                q['malnut_muac'] = status.muac_text()
+                q['malnut_symptoms'] = status.muac_symptoms
+                q['malnut_days_since_last_update'] = status.muac_days()
+                q['diarrhea'] = status.diarrhea or None
+                q['malaria_result'] = status.malaria_text()
+                q['malaria_bednet'] = status.bednet_text()
+                q['diagnosis'] = status.diagnosis or None
                 
                 qs.append(q)
             # caseid +|Y lastname firstname | sex | dob/age | guardian | provider  | date
@@ -335,50 +380,51 @@ class ReportAllPatients(Report, models.Model):
 
     @classmethod
     def malnut_trend_by_provider(cls, provider_id=None):    
-        qs      = []
+        """ the muac trend of the cases that were ever malnourished, as a
+        generator: one ordered scan of the muac reports, one case at a
+        time, so memory and queries do not grow with the number of cases """
+        # imported here, muac imports this module
+        from muac.models import ReportMalnutrition
+
         fields  = []
-        counter = 0
+        reports = ReportMalnutrition.objects.select_related("case")\
+                    .order_by("case__last_name", "case", "entered_at")
         if provider_id is not None:
-            cases   = Case.objects.order_by("last_name").filter(provider=provider_id)
-        else:
-            cases   = Case.objects.order_by("last_name")
-        if cases:
-            for case in cases:
-                q   = {}
-                q['case']   = case
-                
-                
-                try:
-                    muacc   = ReportMalnutrition.objects.filter(case=case).order_by("entered_at")
-                    trend = ""
-                    scase = False
-                    for m in muacc:
-                        mrpt = m.get_dictionary()
-                        mrpt["entered_at"] = m.entered_at.strftime("%d.%m.%y")
-                        if trend != "":
-                            trend += ", "
-                        trend += "%(diagnosis)s %(muac)s(%(entered_at)s)" % mrpt
-                        if m.status in [1,2,3]:
-                            scase = True
-                    #q['malnut'] = u"%(diag)s on %(date)s" % {'diag': muacc.diagnosis_msg(), 'date': muacc.entered_at.strftime("%Y-%m-%d")}
-                    q['trend'] = trend
-                except ObjectDoesNotExist:
-                    q['trend'] = ""
-                if scase:
-                    counter = counter + 1
-                    q['counter'] = "%d"%counter
-                    qs.append(q)
-            # caseid +|Y lastname firstname | sex | dob/age | guardian | provider  | date
-            fields.append({"name": '#', "column": None, "bit": "{{ object.counter }}" })
-            fields.append({"name": 'PID#', "column": None, "bit": "{{ object.case.ref_id }}" })
-            fields.append({"name": 'NAME', "column": None, "bit": "{{ object.case.short_name }}" })
-            fields.append({"name": 'SEX', "column": None, "bit": "{{ object.case.gender }}" })
-            fields.append({"name": 'AGE', "column": None, "bit": "{{ object.case.short_dob }} - {{ object.case.age }}" })            
-            fields.append({"name": 'CMAM Trend', "column": None, "bit": "{{ object.trend }}" })
-            fields.append({"name": 'CHW', "column": None, "bit": "{{ object.provider }} {{ object.provider.mobile }}" })
-            fields.append({"name": 'Village', "column": None, "bit": "{{ object.case.zone }}" })
-            
-            return qs, fields
+            provider = Provider.objects.get(id=provider_id)
+            reports = reports.filter(case__reporter=provider.user_id)
+
+        def rows():
+            counter = 0
+            case    = None
+            trend   = []
+            scase   = False
+            for m in reports.iterator():
+                if case is not None and m.case_id != case.id:
+                    if scase:
+                        counter = counter + 1
+                        yield {'case': case, 'counter': "%d"%counter, 'trend': ", ".join(trend)}
+                    trend   = []
+                    scase   = False
+                case = m.case
+                trend.append("%s %d mm(%s)" % (m.get_status_display(), m.muac,
+                                               m.entered_at.strftime("%d.%m.%y")))
+                if m.status in [1,2,3]:
+                    scase = True
+            if scase:
+                counter = counter + 1
+                yield {'case': case, 'counter': "%d"%counter, 'trend': ", ".join(trend)}
+
+        # caseid +|Y lastname firstname | sex | dob/age | guardian | provider  | date
+        fields.append({"name": '#', "column": None, "bit": "{{ object.counter }}" })
+        fields.append({"name": 'PID#', "column": None, "bit": "{{ object.case.ref_id }}" })
+        fields.append({"name": 'NAME', "column": None, "bit": "{{ object.case.short_name }}" })
+        fields.append({"name": 'SEX', "column": None, "bit": "{{ object.case.gender }}" })
+        fields.append({"name": 'AGE', "column": None, "bit": "{{ object.case.short_dob }} - {{ object.case.age }}" })            
+        fields.append({"name": 'CMAM Trend', "column": None, "bit": "{{ object.trend }}" })
+        fields.append({"name": 'CHW', "column": None, "bit": "{{ object.provider }} {{ object.provider.mobile }}" })
+        fields.append({"name": 'Village', "column": None, "bit": "{{ object.case.zone }}" })
+        
+        return rows(), fields
 
     @classmethod
     def measles_by_provider(cls, provider_id=None):    
@@ -387,57 +433,24 @@ class ReportAllPatients(Report, models.Model):
         counter = 0
         if provider_id is not None:
             provider = Provider.objects.get(id=provider_id)
-            cases   = Case.list_e_4_measles(provider)
+            cases   = list(Case.list_e_4_measles(provider))
+            statuses = CaseStatus.for_cases(cases)
             
             for case in cases:
+                status  = statuses[case.id]
                 q   = {}
                 q['case']   = case
                 counter = counter + 1
                 q['counter'] = "%d"%counter
-                try:
-                    muacc   = ReportMalnutrition.objects.filter(case=case).latest()
-                    #q['malnut'] = u"%(diag)s on %(date)s" % {'diag': muacc.diagnosis_msg(), 'date': muacc.entered_at.strftime("%Y-%m-%d")}
-                    q['malnut_muac'] = "%s (%smm)"%(muacc.get_status_display(), muacc.muac)
-                    q['malnut_symptoms'] = muacc.symptoms()
-                    q['malnut_days_since_last_update'] = muacc.days_since_last_activity()
-                except ObjectDoesNotExist:
-                    q['malnut_muac'] = ""
-                    q['malnut_symptoms'] = ""
-                    q['malnut_days_since_last_update'] = ""
-                try:
-                    orsc   = ReportDiarrhea.objects.filter(case=case).latest()
-                    q['diarrhea'] = u"%(diag)s on %(date)s" % {'diag': orsc.diagnosis_msg(), 'date': orsc.entered_at.strftime("%Y-%m-%d")}
-                except ObjectDoesNotExist:
-                    q['diarrhea'] = None
-                    
-                try:
-                    twoweeksago = date.today() - timedelta(14)
-                    mrdtc   = ReportMalaria.objects.filter(case=case, entered_at__gte=twoweeksago).latest()
-                    mrdtcd  = mrdtc.get_dictionary()
-                    #q['malaria'] = u"result:%(res)s bednet:%(bed)s obs:%(obs)s on %(date)s" % {'res': mrdtcd['result_text'], 'bed': mrdtcd['bednet_text'], 'obs': mrdtcd['observed'], 'date': mrdtc.entered_at.strftime("%Y-%m-%d")}
-                    q['malaria_result'] = mrdtc.results_for_malaria_result()
-                    q['malaria_bednet'] = mrdtc.results_for_malaria_bednet()
-                except ObjectDoesNotExist:
-                    q['malaria_result'] = ""
-                    q['malaria_bednet'] = ""
-                    
-                num_of_malaria_cases = ReportMalaria.num_reports_by_case(case)                
-                if num_of_malaria_cases is not None and num_of_malaria_cases > 1:
-                     q['malaria_result'] = q['malaria_result'] + "(%sX)"%num_of_malaria_cases
-                     last_mrdt = ReportMalaria.days_since_last_mrdt(case)
-                     if last_mrdt is not "" and last_mrdt < 15:
-                         q['malaria_result'] = q['malaria_result'] + " %s days ago"%last_mrdt
-                    
-                try:
-                    dc      = ReportDiagnosis.objects.filter(case=case).latest('entered_at')
-                    dcd     = dc.get_dictionary()
-                    q['diagnosis'] = u"diag:%(diag)s labs:%(lab)s on %(date)s" % {'diag': dcd['diagnosis'], 'lab': dcd['labs_text'], 'date': dc.entered_at.strftime("%Y-%m-%d")}
-                except ObjectDoesNotExist:
-                    q['diagnosis'] = None
+                q['malnut_muac'] = status.muac_text()
+                q['malnut_symptoms'] = status.muac_symptoms_text
+                q['malnut_days_since_last_update'] = status.muac_days()
+                q['diarrhea'] = status.diarrhea or None
+                q['malaria_result'] = status.malaria_text()
+                q['malaria_bednet'] = status.bednet_text()
+                q['diagnosis'] = status.diagnosis or None
 
-                
-                q['vaccinated'] = ReportMeasles.is_vaccinated(case)
-                if q['vaccinated']:
+                if status.vaccinated:
                     q['sent'] = u"Yes"
                     q['vaccinated'] = u"Yes" 
                 else:
@@ -458,53 +471,62 @@ class ReportAllPatients(Report, models.Model):
 
     @classmethod
     def malaria_by_provider(cls, provider_id=None):    
-        qs      = []
+        """ one row per case tested for malaria, with its latest result and
+        bednet, the number of tests and the days since the last one. a
+        generator over one ordered scan of the mrdt reports """
+        # imported here, mrdt imports this module
+        from mrdt.models import ReportMalaria
+
         fields  = []
-        counter = 0
-        if provider_id is None:
-            #cases   = Case.objects.order_by("last_name").filter(provider=provider_id)
-            malrpts = ReportMalaria.objects.order_by("case").order_by("result")
-            
-            for case in malrpts:
-                q   = {}
-                
-                q['case']   = case.case
-                q['provider']   = case.provider
-                counter = counter + 1
-                q['counter'] = "%d"%counter
-                    
-                try:
-                    twoweeksago = date.today() - timedelta(14)
-                    mrdtc   = ReportMalaria.objects.filter(case=case.case).latest()
-                    mrdtcd  = mrdtc.get_dictionary()
-                    #q['malaria'] = u"result:%(res)s bednet:%(bed)s obs:%(obs)s on %(date)s" % {'res': mrdtcd['result_text'], 'bed': mrdtcd['bednet_text'], 'obs': mrdtcd['observed'], 'date': mrdtc.entered_at.strftime("%Y-%m-%d")}
-                    q['malaria_result'] = mrdtc.results_for_malaria_result()
-                    q['malaria_bednet'] = mrdtc.results_for_malaria_bednet()
-                except ObjectDoesNotExist:
-                    q['malaria_result'] = ""
-                    q['malaria_bednet'] = ""
-                    
-                num_of_malaria_cases = ReportMalaria.num_reports_by_case(case)                
-                if num_of_malaria_cases is not None and num_of_malaria_cases > 1:
-                     q['malaria_result'] = q['malaria_result'] + "(%sX)"%num_of_malaria_cases
-                     last_mrdt = ReportMalaria.days_since_last_mrdt(case)
-                     if last_mrdt is not "" and last_mrdt < 15:
-                         q['malaria_result'] = q['malaria_result'] + " %s days ago"%last_mrdt
-                                
-                qs.append(q)
-            # caseid +|Y lastname firstname | sex | dob/age | guardian | provider  | date
-            fields.append({"name": '#', "column": None, "bit": "{{ object.counter }}" })
-            fields.append({"name": 'PID#', "column": None, "bit": "{{ object.case.ref_id }}" })
-            fields.append({"name": 'NAME', "column": None, "bit": "{{ object.case.short_name }}" })
-            fields.append({"name": 'SEX', "column": None, "bit": "{{ object.case.gender }}" })
-            fields.append({"name": 'AGE', "column": None, "bit": "{{ object.case.short_dob }} - {{ object.case.age }}" })            
-            fields.append({"name": 'MRDT', "column": None, "bit": "{{ object.malaria_result }}" })
-            fields.append({"name": 'BEDNET', "column": None, "bit": "{{ object.malaria_bednet }}" })
-            fields.append({"name": 'LAST UPDATE', "column": None, "bit": "{{ object.case.date_registered }}" })
-            fields.append({"name": 'CHW', "column": None, "bit": "{{ object.provider }} {{ object.provider.mobile }}" })
-            fields.append({"name": 'Village', "column": None, "bit": "{{ object.case.zone }}" })
-            
-            return qs, fields
+        reports = ReportMalaria.objects.select_related("case")\
+                    .order_by("case__last_name", "case", "entered_at")
+        if provider_id is not None:
+            provider = Provider.objects.get(id=provider_id)
+            reports = reports.filter(case__reporter=provider.user_id)
+
+        def row(counter, latest, count, providers):
+            q   = {}
+            q['case']   = latest.case
+            # the Provider whose user shares the reporter's id
+            q['provider']   = providers.get(latest.reporter_id, None)
+            q['counter'] = "%d"%counter
+            q['malaria_result'] = latest.results_for_malaria_result()
+            q['malaria_bednet'] = latest.results_for_malaria_bednet()
+            if count > 1:
+                q['malaria_result'] = q['malaria_result'] + "(%sX)"%count
+                last_mrdt = (date.today() - latest.entered_at.date()).days
+                if last_mrdt < 15:
+                    q['malaria_result'] = q['malaria_result'] + " %s days ago"%last_mrdt
+            return q
+
+        def rows():
+            providers = dict([(p.user_id, p) for p in Provider.objects.all()])
+            counter = 0
+            latest  = None
+            count   = 0
+            for report in reports.iterator():
+                if latest is not None and report.case_id != latest.case_id:
+                    counter = counter + 1
+                    yield row(counter, latest, count, providers)
+                    count = 0
+                latest  = report
+                count   = count + 1
+            if latest is not None:
+                yield row(counter + 1, latest, count, providers)
+
+        # caseid +|Y lastname firstname | sex | dob/age | guardian | provider  | date
+        fields.append({"name": '#', "column": None, "bit": "{{ object.counter }}" })
+        fields.append({"name": 'PID#', "column": None, "bit": "{{ object.case.ref_id }}" })
+        fields.append({"name": 'NAME', "column": None, "bit": "{{ object.case.short_name }}" })
+        fields.append({"name": 'SEX', "column": None, "bit": "{{ object.case.gender }}" })
+        fields.append({"name": 'AGE', "column": None, "bit": "{{ object.case.short_dob }} - {{ object.case.age }}" })            
+        fields.append({"name": 'MRDT', "column": None, "bit": "{{ object.malaria_result }}" })
+        fields.append({"name": 'BEDNET', "column": None, "bit": "{{ object.malaria_bednet }}" })
+        fields.append({"name": 'LAST UPDATE', "column": None, "bit": "{{ object.case.date_registered }}" })
+        fields.append({"name": 'CHW', "column": None, "bit": "{{ object.provider }} {{ object.provider.mobile }}" })
+        fields.append({"name": 'Village', "column": None, "bit": "{{ object.case.zone }}" })
+        
+        return rows(), fields
     
     @classmethod
     def malnut_by_provider(cls):    
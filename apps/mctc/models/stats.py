@@ -0,0 +1,145 @@
+from django.db import models
+from django.db.models import Count, Sum
+from django.db.models.signals import post_save
+
+from datetime import datetime, timedelta
+
+from mctc.models.general import Provider, Case
+from mctc.models.logs import EventLog
+from mctc.models.activity import bump
+
+# metrics counted from the message log, see message_stats()
+SMS_SENT        = "sms_sent"
+SMS_PROCESSED   = "sms_processed"
+SMS_REFUSED     = "sms_refused"
+# messages starting with each of these
+SMS_PREFIXES    = {"new": "sms_new", "mrdt": "sms_mrdt", "muac": "sms_muac", "@": "sms_user"}
+
+CHW_REGISTERED  = "chw_registered"
+CHW_ACTIVE      = "chw_active"
+# one per EventLog message, e.g. event_patient_created
+EVENT           = "event_%s"
+# mrdt_<result>_<bednet>, e.g. mrdt_pos_net
+MRDT            = "mrdt_%s_%s"
+# muac_<status>, e.g. muac_1
+MUAC            = "muac_%s"
+
+class DailyStat(models.Model):
+    """ One number of the monitoring report for one day, kept up to date
+        as messages, events, cases and reports are written, so the
+        report reads a month with one query. Rebuild the history with
+        ./rapidsms rebuild_daily_stats """
+
+    day         = models.DateField(db_index=True)
+    metric      = models.CharField(max_length=30)
+    value       = models.IntegerField(default=0)
+
+    class Meta:
+        app_label = "mctc"
+        unique_together = (("day", "metric"),)
+        ordering = ("day", "metric")
+
+    def __unicode__(self):
+        return u"%s %s: %s" % (self.day, self.metric, self.value)
+
+    @classmethod
+    def add(cls, counts):
+        """ add counts ({(day, metric): n}) to the stats """
+        for (day, metric), n in counts.items():
+            bump(cls, {"day": day, "metric": metric}, {"value": n})
+
+    @classmethod
+    def put(cls, day, values):
+        """ set the metrics of values ({metric: value}) for day """
+        for metric, value in values.items():
+            bump(cls, {"day": day, "metric": metric}, {}, value=value)
+
+    @classmethod
+    def month(cls, first, last):
+        """ ({day: {metric: value}} from first to last, {metric: total
+        before first}) """
+        days = {}
+        for stat in cls.objects.filter(day__gte=first, day__lte=last):
+            days.setdefault(stat.day, {})[stat.metric] = stat.value
+        before = dict([(row["metric"], row["total"]) for row in
+                       cls.objects.filter(day__lt=first).order_by().values("metric")\
+                           .annotate(total=Sum("value"))])
+        return days, before
+
+def message_stats(rows):
+    """ counts of MessageLog rows (dicts), see mctc.logwriter """
+    counts = {}
+    def count(day, metric):
+        counts[(day, metric)] = counts.get((day, metric), 0) + 1
+    for row in rows:
+        day = row["created_at"].date()
+        count(day, SMS_SENT)
+        count(day, row["was_handled"] and SMS_PROCESSED or SMS_REFUSED)
+        text = (row["text"] or "").lower()
+        for prefix, metric in SMS_PREFIXES.items():
+            if text.startswith(prefix):
+                count(day, metric)
+    return counts
+
+def day_range(day):
+    morning = datetime.combine(day, datetime.min.time())
+    return morning, morning + timedelta(days=1)
+
+def malaria_stats(model, day):
+    morning, evening = day_range(day)
+    values = {}
+    for result in ("pos", "neg"):
+        for bednet in ("net", "nonet"):
+            values[MRDT % (result, bednet)] = 0
+    for row in model.objects.filter(entered_at__gte=morning, entered_at__lt=evening)\
+            .order_by().values("result", "bednet").annotate(count=Count("id")):
+        values[MRDT % (row["result"] and "pos" or "neg",
+                       row["bednet"] and "net" or "nonet")] = row["count"]
+    return values
+
+def malnutrition_stats(model, day):
+    morning, evening = day_range(day)
+    values = dict([(MUAC % status, 0) for status, name in model.STATUS_CHOICES])
+    for row in model.objects.filter(entered_at__gte=morning, entered_at__lt=evening)\
+            .order_by().values("status").annotate(count=Count("id")):
+        if row["status"] is not None:
+            values[MUAC % row["status"]] = row["count"]
+    return values
+
+# reports counted by recount_reports(), by model name
+REPORT_STATS = {
+    "ReportMalaria":        malaria_stats,
+    "ReportMalnutrition":   malnutrition_stats,
+}
+
+def recount_reports(model, day):
+    """ recount the reports of model filed on day. file_report() replaces
+    the report of the day, so these are counted again rather than bumped """
+    stats = REPORT_STATS.get(model._meta.object_name, None)
+    if stats is not None:
+        DailyStat.put(day, stats(model, day))
+
+def Provider_created_handler(sender, **kwargs):
+    instance = kwargs['instance']
+    if kwargs.get('created', False) and instance.role == Provider.CHW_ROLE:
+        DailyStat.add({(instance.user.date_joined.date(), CHW_REGISTERED): 1})
+
+def Case_created_handler(sender, **kwargs):
+    instance = kwargs['instance']
+    if not kwargs.get('created', False):
+        return
+    # a CHW is active on the days they created a case
+    morning, evening = day_range(instance.created_at.date())
+    if not Case.objects.filter(reporter=instance.reporter_id, created_at__gte=morning,
+                               created_at__lt=evening).exclude(id=instance.id).count():
+        DailyStat.add({(morning.date(), CHW_ACTIVE): 1})
+
+def EventLog_created_handler(sender, **kwargs):
+    instance = kwargs['instance']
+    if kwargs.get('created', False):
+        DailyStat.add({(instance.created_at.date(), EVENT % instance.message): 1})
+
+# this module is imported as mctc.models and apps.mctc.models, count once
+post_save.connect(Provider_created_handler, sender=Provider, dispatch_uid="dailystat.provider")
+post_save.connect(Case_created_handler, sender=Case, dispatch_uid="dailystat.case")
+post_save.connect(EventLog_created_handler, sender=EventLog, dispatch_uid="dailystat.eventlog")
@@ -0,0 +1,90 @@
+from django.db import models
+
+from datetime import date, timedelta
+
+from mctc.models.general import Case
+
+class CaseStatus(models.Model):
+    """ The latest of each kind of report of a case, kept up to date when
+        a report is filed (see mctc.reportwriter), so the patient listings
+        read one row per case instead of querying every report table.
+        Rebuild it with ./rapidsms rebuild_case_status """
+
+    case        = models.OneToOneField(Case, primary_key=True, related_name="current_status")
+    # muac
+    muac_status = models.CharField(max_length=50, blank=True)
+    muac_symptoms = models.CharField(max_length=255, blank=True)
+    muac_symptoms_text = models.CharField(max_length=255, blank=True)
+    muac_at     = models.DateTimeField(null=True, blank=True)
+    # mrdt
+    mrdt_result = models.CharField(max_length=1, blank=True)
+    mrdt_bednet = models.CharField(max_length=1, blank=True)
+    mrdt_count  = models.PositiveIntegerField(default=0)
+    mrdt_at     = models.DateTimeField(null=True, blank=True)
+    # ors
+    diarrhea    = models.CharField(max_length=255, blank=True)
+    diarrhea_at = models.DateTimeField(null=True, blank=True)
+    # diagnosis
+    diagnosis   = models.TextField(blank=True)
+    diagnosis_at = models.DateTimeField(null=True, blank=True)
+    # measles
+    vaccinated  = models.BooleanField(default=False)
+    measles_at  = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        app_label = "mctc"
+        verbose_name = "Case Status"
+        verbose_name_plural = "Case Status"
+
+    def __unicode__(self):
+        return u"%s" % self.case_id
+
+    @classmethod
+    def record(cls, report):
+        """ copy what the listings show of report, which must have a
+        snapshot(status) method, into its case's row """
+        try:
+            status = cls.objects.get(case=report.case_id)
+        except cls.DoesNotExist:
+            status = cls(case_id=report.case_id)
+        report.snapshot(status)
+        status.save()
+        return status
+
+    @classmethod
+    def for_cases(cls, cases):
+        """ {case id: CaseStatus} of cases, in one query. cases with no
+        report yet get an empty (unsaved) one """
+        ids = [case.id for case in cases]
+        found = cls.objects.in_bulk(ids)
+        return dict([(id, found.get(id) or cls(case_id=id)) for id in ids])
+
+    def muac_text(self):
+        if not self.muac_at:
+            return ""
+        return self.muac_status
+
+    def muac_days(self):
+        if not self.muac_at:
+            return ""
+        return (date.today() - self.muac_at.date()).days
+
+    def malaria_text(self):
+        """ result of an mrdt of the last two weeks, with the number of
+        tests when there were more than one """
+        if not self.mrdt_at:
+            return ""
+        days = (date.today() - self.mrdt_at.date()).days
+        result = ""
+        if self.mrdt_at.date() >= date.today() - timedelta(14):
+            result = self.mrdt_result
+        if self.mrdt_count > 1:
+            result = result + "(%sX)" % self.mrdt_count
+            if days < 15:
+                result = result + " %s days ago" % days
+        return result
+
+    def bednet_text(self):
+        if not self.mrdt_at or self.mrdt_at.date() < date.today() - timedelta(14):
+            return ""
+        return self.mrdt_bednet
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+''' On-disk cache of the generated PDF and CSV reports
+
+    Building a report (last_30_days, measles_summary, patients_by_chw,
+    malaria, malnut, trend, ...) reads most of the database, and the same
+    report is often downloaded again before anything changed. The
+    responses are kept in a directory, keyed by the view, its arguments,
+    the request parameters, the day and the version of the data.
+
+    The data version is a VersionStamp bumped by the save and delete
+    signals of the models the reports read (and by the MessageLog writer,
+    whose raw inserts send no signal). Any change makes every cached
+    report stale; stale files are never served and get evicted, oldest
+    first, once the directory is over its size limit.
+
+    settings (the [django] section of rapidsms.ini):
+            report_cache_size=52428800      * bytes, 0 disables the cache
+
+    usage:
+            @login_required
+            @cached_report
+            def malaria(request, object_id=None, per_page="0", rformat="pdf"):
+                ...
+'''
+
+import os
+import tempfile
+import thread
+import threading
+from datetime import date
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.http import HttpResponse
+from django.utils import simplejson
+
+from mctc.caches import VersionStamp
+from mctc.models.general import Case
+from mctc.models.logs import MessageLog
+from mctc.models.status import CaseStatus
+from measles.models import ReportMeasles
+from mrdt.models import ReportMalaria
+from muac.models import ReportMalnutrition
+
+CACHE_DIR   = os.path.join(tempfile.gettempdir(), "rapidsms-reports")
+CACHE_SIZE  = 50 * 1024 * 1024
+
+# headers of the response kept with the file
+HEADERS     = ("Content-Type", "Content-Disposition")
+# bytes read from a file at once when sending it
+CHUNK_SIZE  = 64 * 1024
+
+def read_chunks(data):
+    ''' the content of the open file data, a chunk at a time, then closes
+        it '''
+    try:
+        while True:
+            chunk = data.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        data.close()
+
+def streaming_response(chunks, headers):
+    ''' a response sending chunks as they come, with headers ({name:
+        value}, Content-Type included). see libreport.csvreport '''
+    headers = dict(headers)
+    response = HttpResponse(chunks, content_type=headers.pop("Content-Type"))
+    for name, value in headers.items():
+        response[name] = value
+    response.streaming = True
+    return response
+
+class ReportCache(object):
+
+    def __init__(self, directory=CACHE_DIR, size=None):
+        self.lock       = threading.Lock()
+        self.directory  = directory
+        self.size       = size
+        self.version    = VersionStamp("reports")
+
+    def max_size(self):
+        if self.size is None:
+            return int(getattr(settings, "REPORT_CACHE_SIZE", CACHE_SIZE))
+        return self.size
+
+    def bump(self):
+        ''' the data changed, every cached report is stale '''
+        self.version.bump()
+
+    def key(self, name, request, args, kwargs):
+        params = [name, repr(args), sorted(kwargs.items()), request.path,
+                  sorted(request.GET.items()), sorted(request.POST.items()),
+                  date.today().isoformat(), self.version.shared()]
+        return sha1(repr(params)).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        ''' the cached response, streamed from its file, or None '''
+        try:
+            meta = open(self.path(key) + ".meta")
+            try:
+                headers = simplejson.loads(meta.read())
+            finally:
+                meta.close()
+            data = open(self.path(key), "rb")
+        except (IOError, ValueError):
+            return None
+        # touched, so it is evicted last
+        try:
+            os.utime(self.path(key), None)
+        except OSError:
+            pass
+        return streaming_response(read_chunks(data), headers)
+
+    def put(self, key, response):
+        for chunk in self.save(key, response):
+            pass
+
+    def save(self, key, response):
+        ''' the chunks of the response's content, written to the cache as
+            they are read. nothing is kept unless all of them are read,
+            e.g. if the client went away during a streamed response '''
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # created by another process meanwhile
+                pass
+        headers = dict([(name, response[name]) for name in HEADERS if response.has_header(name)])
+        # written aside then renamed, the other processes never read
+        # half a file. the headers come last, get() needs both
+        path = self.path(key)
+        temp = "%s.%d.%d.tmp" % (path, os.getpid(), thread.get_ident())
+        out = open(temp, "wb")
+        done = False
+        try:
+            for chunk in response:
+                out.write(chunk)
+                yield chunk
+            done = True
+        finally:
+            out.close()
+            if done:
+                os.rename(temp, path)
+            else:
+                os.remove(temp)
+        temp = "%s.meta.%d.%d.tmp" % (path, os.getpid(), thread.get_ident())
+        out = open(temp, "wb")
+        try:
+            out.write(simplejson.dumps(headers))
+        finally:
+            out.close()
+        os.rename(temp, path + ".meta")
+        self.evict()
+
+    def evict(self):
+        ''' remove the least recently used reports until the directory
+            fits in the size limit '''
+        self.lock.acquire()
+        try:
+            files = []
+            total = 0
+            for name in os.listdir(self.directory):
+                if name.endswith(".meta") or name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = os.stat(self.path(name))
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, name))
+                total += stat.st_size
+            files.sort()
+            limit = self.max_size()
+            while files and total > limit:
+                mtime, size, name = files.pop(0)
+                for path in (self.path(name), self.path(name) + ".meta"):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                total -= size
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                os.remove(self.path(name))
+
+report_cache = ReportCache()
+
+def cached_report(view):
+    ''' serve the view's PDF or CSV from the cache when the data did not
+        change since it was built '''
+    name = "%s.%s" % (view.__module__, view.__name__)
+    def wrapper(request, *args, **kwargs):
+        if not report_cache.max_size():
+            return view(request, *args, **kwargs)
+        key = report_cache.key(name, request, args, kwargs)
+        response = report_cache.get(key)
+        if response is None:
+            response = view(request, *args, **kwargs)
+            if response.status_code == 200 and response.has_header("Content-Disposition"):
+                if getattr(response, "streaming", False):
+                    # cached as it is sent
+                    headers = dict(response.items())
+                    response = streaming_response(report_cache.save(key, response), headers)
+                else:
+                    report_cache.put(key, response)
+        return response
+    wrapper.__name__    = view.__name__
+    wrapper.__doc__     = view.__doc__
+    wrapper.__module__  = view.__module__
+    return wrapper
+
+def data_changed_handler(sender, **kwargs):
+    report_cache.bump()
+
+for model in (Case, CaseStatus, ReportMalaria, ReportMalnutrition, ReportMeasles, MessageLog):
+    post_save.connect(data_changed_handler, sender=model, dispatch_uid="reportcache.%s" % model.__name__)
+    post_delete.connect(data_changed_handler, sender=model, dispatch_uid="reportcache.%s.delete" % model.__name__)
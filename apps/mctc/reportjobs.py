@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+''' Background building of the long reports
+
+    The reports covering every clinic or provider (last_30_days,
+    measles_summary, patients_by_chw without an id) take longer than the
+    web server lets a request run on a large deployment. These views are
+    now submitted as a ReportJob and built on a small pool of threads of
+    the web server; the browser is sent to the job's page, which shows
+    the progress and links to the file once it is built.
+
+    A request identical to one already queued or running (same view,
+    parameters, day and data version, see mctc.reportcache) joins that
+    job instead of starting another. A finished report is served from the
+    report cache like any other.
+
+    Each job records the process building it. The jobs a process left
+    queued or running when it died are taken over by the next process of
+    the same host that starts its workers, or that is asked for the same
+    report.
+
+    usage:
+            @login_required
+            @background_report
+            @cached_report
+            def last_30_days(request, object_id=None, ...):
+                for i, clinic in enumerate(clinics):
+                    report_jobs.progress(i, len(clinics))
+                    ...
+'''
+
+import errno
+import os
+import re
+import socket
+import tempfile
+import threading
+import traceback
+import Queue
+from datetime import datetime, timedelta
+
+from django.db import connection
+from django.http import HttpResponseRedirect, QueryDict
+from django.utils import simplejson
+
+from mctc.models.jobs import ReportJob
+from mctc.reportcache import report_cache, read_chunks
+
+JOBS_DIR    = os.path.join(tempfile.gettempdir(), "rapidsms-report-jobs")
+# a job queued or running for longer belongs to a server that died
+STALE       = timedelta(hours=1)
+# finished jobs and their files are removed after
+KEEP        = timedelta(days=1)
+
+class JobRequest(object):
+    ''' what the report views read of the request that submitted a job '''
+
+    def __init__(self, path, get, post, user):
+        self.path   = path
+        self.method = post and "POST" or "GET"
+        self.GET    = QueryDict("", mutable=True)
+        self.POST   = QueryDict("", mutable=True)
+        for query, values in ((self.GET, get), (self.POST, post)):
+            for name, value in values.items():
+                query.setlist(name, value)
+        self.user   = user
+        self.META   = {}
+
+class ReportJobs(object):
+
+    def __init__(self, workers=2, directory=JOBS_DIR):
+        self.workers    = workers
+        self.directory  = directory
+        self.lock       = threading.Lock()
+        self.queue      = Queue.Queue()
+        self.threads    = []
+        # view name -> view, see background_report
+        self.views      = {}
+        self.current    = threading.local()
+        self.recovered  = False
+
+    def register(self, name, view):
+        self.views[name] = view
+
+    def start(self):
+        ''' start the workers, on the first job, and take over the jobs
+            of the processes that died '''
+        self.lock.acquire()
+        try:
+            if not self.recovered:
+                self.recovered = True
+                self.recover()
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work, name="report-%d" % len(self.threads))
+                thread.setDaemon(True)
+                thread.start()
+                self.threads.append(thread)
+        finally:
+            self.lock.release()
+
+    def submit(self, request, name, args, kwargs, key):
+        ''' the job building the view for request, an identical one
+            already in flight if any '''
+        self.start()
+        self.lock.acquire()
+        try:
+            self.purge()
+            running = ReportJob.objects.filter(key=key, created_at__gte=datetime.now() - STALE,
+                        status__in=(ReportJob.STATUS_QUEUED, ReportJob.STATUS_RUNNING))[:1]
+            if running and not self.alive(running[0].owner):
+                self.recover()
+                running = ReportJob.objects.filter(id=running[0].id)
+            if running:
+                return running[0]
+            job = ReportJob(key=key, view=name, path=request.path, owner=self.owner())
+            job.params = simplejson.dumps({"args": list(args), "kwargs": kwargs,
+                                           "GET": dict(request.GET.lists()),
+                                           "POST": dict(request.POST.lists())})
+            if request.user.is_authenticated():
+                job.requested_by = request.user
+            job.save()
+        finally:
+            self.lock.release()
+        self.queue.put(job.id)
+        return job
+
+    def owner(self):
+        return "%s:%d" % (socket.gethostname(), os.getpid())
+
+    def alive(self, owner):
+        ''' whether the process owner (host:pid) may still build its
+            jobs. processes of other hosts cannot be told, their jobs go
+            stale instead '''
+        host, sep, pid = owner.rpartition(":")
+        if not sep or not pid.isdigit():
+            return False
+        if host != socket.gethostname():
+            return True
+        try:
+            os.kill(int(pid), 0)
+        except OSError, e:
+            return e.errno == errno.EPERM
+        return True
+
+    def recover(self):
+        ''' queue again in this process the jobs left queued or running
+            by a dead one. returns their ids '''
+        recovered = []
+        for job in ReportJob.objects.filter(status__in=(ReportJob.STATUS_QUEUED,
+                                                       ReportJob.STATUS_RUNNING)):
+            if job.owner == self.owner() or self.alive(job.owner):
+                continue
+            # another process may be taking it over too, the first
+            # UPDATE wins
+            if ReportJob.objects.filter(id=job.id, owner=job.owner, status=job.status)\
+                    .update(owner=self.owner(), status=ReportJob.STATUS_QUEUED, done=0):
+                recovered.append(job.id)
+                self.queue.put(job.id)
+        return recovered
+
+    def work(self):
+        while True:
+            job_id = self.queue.get()
+            try:
+                self.run(job_id)
+            finally:
+                # django keeps one connection per thread
+                connection.close()
+
+    def run(self, job_id):
+        job = ReportJob.objects.get(id=job_id)
+        job.status = ReportJob.STATUS_RUNNING
+        job.save()
+        self.current.job = job
+        try:
+            try:
+                params  = simplejson.loads(job.params)
+                request = JobRequest(job.path, params["GET"], params["POST"], job.requested_by)
+                kwargs  = dict([(str(k), v) for k, v in params["kwargs"].items()])
+                response = self.views[job.view](request, *params["args"], **kwargs)
+                self.write(job, response)
+                job.content_type    = response["Content-Type"]
+                match = re.search(r"filename=([^;]+)", response.get("Content-Disposition", ""))
+                job.filename        = match and match.group(1) or "report"
+                job.status          = ReportJob.STATUS_DONE
+            except Exception:
+                job.error   = traceback.format_exc()
+                job.status  = ReportJob.STATUS_ERROR
+        finally:
+            self.current.job = None
+            # done and total are kept by progress()
+            ReportJob.objects.filter(id=job.id).update(status=job.status, error=job.error,
+                content_type=job.content_type, filename=job.filename, finished_at=datetime.now())
+
+    def running_job(self):
+        ''' the job this thread is building, or None '''
+        return getattr(self.current, "job", None)
+
+    def progress(self, done, total):
+        ''' the report being built is done out of total parts. does
+            nothing outside of a job '''
+        job = self.running_job()
+        if job is not None:
+            ReportJob.objects.filter(id=job.id).update(done=done, total=total)
+
+    def path(self, job):
+        return os.path.join(self.directory, "%s" % job.id)
+
+    def write(self, job, response):
+        ''' the response's content, a chunk at a time for the streamed
+            ones '''
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                pass
+        out = open(self.path(job), "wb")
+        try:
+            for chunk in response:
+                out.write(chunk)
+        finally:
+            out.close()
+
+    def read(self, job):
+        data = open(self.path(job), "rb")
+        try:
+            return data.read()
+        finally:
+            data.close()
+
+    def chunks(self, job):
+        ''' the job's file, a chunk at a time '''
+        return read_chunks(open(self.path(job), "rb"))
+
+    def purge(self):
+        ''' forget the jobs finished long ago, and their files '''
+        for job in ReportJob.objects.filter(created_at__lt=datetime.now() - KEEP,
+                        status__in=(ReportJob.STATUS_DONE, ReportJob.STATUS_ERROR)):
+            try:
+                os.remove(self.path(job))
+            except OSError:
+                pass
+            job.delete()
+
+report_jobs = ReportJobs()
+
+def background_report(view):
+    ''' build the view as a ReportJob when it covers everything (no
+        object_id), and send the browser to the job's page '''
+    name = "%s.%s" % (view.__module__, view.__name__)
+    report_jobs.register(name, view)
+    def wrapper(request, *args, **kwargs):
+        # a single clinic or provider is quick enough
+        if kwargs.get("object_id", None) is not None or args:
+            return view(request, *args, **kwargs)
+        key = report_cache.key(name, request, args, kwargs)
+        response = report_cache.get(key)
+        if response is not None:
+            return response
+        job = report_jobs.submit(request, name, args, kwargs, key)
+        return HttpResponseRedirect(job.get_absolute_url())
+    wrapper.__name__    = view.__name__
+    wrapper.__doc__     = view.__doc__
+    wrapper.__module__  = view.__module__
+    return wrapper
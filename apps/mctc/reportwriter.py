@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+
+''' One-transaction write path for the clinical reports (muac, mrdt, ...)
+
+    A case has at most one report of each kind per day: a new SMS for
+    the same case on the same day replaces the earlier report. The apps
+    used to do this with a latest() query and a DELETE, then saved the
+    report, added each observation with its own INSERT and saved again.
+
+    file_report() updates today's row in place (or inserts one), and
+    replaces its many-to-many and related rows with one DELETE and one
+    executemany each, all in one transaction. The number of statements
+    does not depend on the number of observations. The case's CaseStatus
+    row and the day's DailyStat counts are brought up to date in the same
+    transaction.
+
+    usage:
+            report = ReportMalaria(case=case, reporter=reporter, result=result)
+            file_report(report, links={"observed": observed})
+
+            report = ReportDiagnosis(case=case, reporter=reporter, text=text)
+            file_report(report, links={"diagnosis": diags},
+                        related=[(LabDiagnosis, "diagnosis", lab_results)])
+'''
+
+from datetime import datetime
+
+from django.db import connection, transaction
+
+from mctc.models.status import CaseStatus
+from mctc.models.stats import recount_reports
+
+def today_report(model, case):
+    ''' id of the case's report of the day, or None '''
+    midnight = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    ids = model.objects.filter(case=case, entered_at__gte=midnight)\
+                .order_by("-entered_at").values_list("id", flat=True)[:1]
+    if ids:
+        return ids[0]
+    return None
+
+@transaction.commit_on_success
+def file_report(report, links={}, related=()):
+    ''' save report as its case's report of the day.
+
+        links:      {m2m field name: [objects]}
+        related:    [(model, name of its FK to the report, [unsaved objects])]
+
+        returns True if an earlier report of the day was replaced '''
+    model   = report.__class__
+    cursor  = connection.cursor()
+
+    report.id           = today_report(model, report.case)
+    report.entered_at   = datetime.now()
+    replaced            = report.id is not None
+    if replaced:
+        report.save(force_update=True)
+    else:
+        report.save(force_insert=True)
+
+    for name, objects in links.items():
+        field = model._meta.get_field(name)
+        if replaced:
+            delete_rows(cursor, field.m2m_db_table(), field.m2m_column_name(), report.id)
+        insert_rows(cursor, field.m2m_db_table(),
+                    (field.m2m_column_name(), field.m2m_reverse_name()),
+                    [(report.id, obj.id) for obj in objects])
+
+    for rel_model, fk_name, objects in related:
+        fk = rel_model._meta.get_field(fk_name)
+        if replaced:
+            delete_rows(cursor, rel_model._meta.db_table, fk.column, report.id)
+        fields = [f for f in rel_model._meta.local_fields
+                  if f is not rel_model._meta.pk and f is not fk]
+        insert_rows(cursor, rel_model._meta.db_table,
+                    [fk.column] + [f.column for f in fields],
+                    [[report.id] + [f.get_db_prep_save(f.pre_save(obj, True)) for f in fields]
+                     for obj in objects])
+
+    CaseStatus.record(report)
+    recount_reports(model, report.entered_at.date())
+    return replaced
+
+def delete_rows(cursor, table, column, value):
+    qn = connection.ops.quote_name
+    cursor.execute("DELETE FROM %s WHERE %s = %%s" % (qn(table), qn(column)), [value])
+
+def insert_rows(cursor, table, columns, rows):
+    if not rows:
+        return
+    qn  = connection.ops.quote_name
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+        qn(table),
+        ", ".join([qn(c) for c in columns]),
+        ", ".join(["%s"] * len(columns)))
+    cursor.executemany(sql, rows)
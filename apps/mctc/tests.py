@@ -1,16 +1,48 @@
 # -*- coding: utf-8 -*-
 from rapidsms.tests.scripted import TestScript
 from django.core.management import call_command
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.db import transaction
 
 from app import App
 
 from models.logs import MessageLog, EventLog
 from models.general import Provider, User, Facility
-from models.general import Case, CaseNote
-from models.reports import ReportMalnutrition, ReportMalaria, Observation, Diagnosis
+from models.general import Case, CaseNote, Sequence
+from models.reports import Observation, ReportCHWStatus, ReportAllPatients
+from measles.models import ReportMeasles
+from muac.models import ReportMalnutrition
+from mrdt.models import ReportMalaria
+from diagnosis.models import Diagnosis, DiagnosisCategory, Lab, LabDiagnosis, ReportDiagnosis
+from caches import IdentityCache, identities, normalize_mobile, observations, diagnoses, cases, alert_recipients
+from caches import VersionStamp
+from logwriter import messagelog, MessageLogWriter
+from broadcaster import Broadcaster
+from models.broadcasts import Broadcast
+from models.stats import DailyStat, message_stats
+from models.status import CaseStatus
+import reportcache
+from reportcache import ReportCache, cached_report
+from reportjobs import ReportJobs, JobRequest
+from reportwriter import file_report
+from models.jobs import ReportJob
+from models.activity import ReporterActivity, ReporterDay, count_messages
+from libdispatch.profile import count_queries, queries
+from management.commands import rebuild_activity
+from reporters.models import Reporter
+from locations.models import Location, LocationType
+from libreport.columns import compile_fields
+from libreport.csvreport import csv_response
+from libreport import pdfreport
+from libreport.pdfreport import PDFReport, memory_hooks, PAGE_BREAK, render_section
+from django.template import Template, Context
+from django.contrib.auth.models import AnonymousUser
+from django.http import HttpResponse
+from django.conf import settings
+from StringIO import StringIO
 
 from datetime import datetime, date, timedelta
+import os, socket, tempfile
 
 def age_in_months (*ymd):
     return int((datetime.now().date() - date(*ymd)).days / 30.4375)    
@@ -81,6 +113,7 @@ class TestApp (TestScript):
     """
 
     def test_00_MessageLog_2 (self):
+        messagelog.flush(force=True)
         msgs = MessageLog.objects.count()
         self.assertEqual(7, msgs, "message log count is %d" % msgs)
         msgs = MessageLog.objects.filter(was_handled=True).count()
@@ -147,6 +180,26 @@ class TestApp (TestScript):
         self.assertEqual(case.guardian, "Sally", "case 34 guardian")
         self.assertEqual(case.provider, user.provider, "case 34 provider")
 
+    def test_02_CaseResolver(self):
+        # ref_ids are the luhn of the pre-allocated ids
+        ids = [c.id for c in Case.objects.filter(ref_id__in=(26, 34, 42)).order_by("id")]
+        self.assertEqual([Case()._luhn(i) for i in ids], [26, 34, 42])
+
+        case = cases.find("+42")
+        self.assertEqual(case.ref_id, 42)
+        hits = cases.stats()["hits"]
+        self.assertEqual(cases.find("42").id, case.id)
+        self.assertEqual(cases.stats()["hits"], hits + 1)
+        self.assertEqual(cases.find("+999"), None)
+        self.assertEqual(cases.find("abc"), None)
+
+        # saving the case drops it from the cache
+        case.guardian = "Sally Ann"
+        case.save()
+        self.assertEqual(cases.find(42).guardian, "Sally Ann")
+        case.guardian = "Sally"
+        case.save()
+
     test_02_ListCases = """
         0000000 > list
         0000000 < 0000000 is not a registered number.
@@ -445,10 +498,11 @@ class TestAlerts(TestCase):
 
     def testCreateReport(self):
         provider = Provider.objects.get(id=2)
-        clinic = provider.clinic
 
-        report = ReportMalaria()
+        report = ReportCHWStatus()
         report.provider = provider
+        # reported about a case of location 1
+        report.case = Case(location_id=1)
         recipients = report.get_alert_recipients()
         assert len(recipients) == 3, [ r.id for r in recipients ]
 
@@ -467,14 +521,798 @@ class TestAlerts(TestCase):
         assert len(recipients) == 3
 
         four = Provider.objects.get(id=4)
-        four.following_users.remove(provider)
+        # the reporter of provider 2
+        four.following_users.remove(provider.user_id)
         four.save()
 
         recipients = report.get_alert_recipients()
         assert len(recipients) == 2
 
-        one.following_clinics.remove(clinic)
+        one.following_clinics.remove(1)
         one.save()
 
         recipients = report.get_alert_recipients()        
         assert len(recipients) == 1, [ r.id for r in recipients ]        
+
+class TestIdentityCache(TestCase):
+    fixtures = ["users.json", "alerts.json"]
+
+    def setUp(self):
+        identities.clear()
+
+    def testLookup(self):
+        provider = identities.provider("12345678")
+        self.assertEqual(provider.id, 1)
+        self.assertEqual(identities.provider("12345678").id, 1)
+        self.assertEqual(identities.provider("00000000"), None)
+        self.assertEqual(identities.provider("00000000"), None)
+
+        stats = identities.stats()
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["misses"], 2)
+
+    def testUnknown(self):
+        cache = IdentityCache()
+        cache.max_unknown = 2
+        for mobile in ("00000001", "00000002", "00000003"):
+            self.assertEqual(cache.provider(mobile), None)
+        self.assertEqual(cache.provider("12345678").id, 1)
+        # the oldest unknown number was forgotten, not the provider
+        self.assertEqual(cache.stats()["size"], 3)
+        cache.provider("00000003")
+        cache.provider("00000001")
+        self.assertEqual((cache.stats()["hits"], cache.stats()["misses"]), (1, 5))
+
+    def testNormalize(self):
+        self.assertEqual(normalize_mobile("233201234567"), "+233201234567")
+        self.assertEqual(normalize_mobile("254733202270"), "+254733202270")
+        self.assertEqual(normalize_mobile("0733202270"), "0733202270")
+
+    def testInvalidate(self):
+        self.assertEqual(identities.provider("00000000"), None)
+
+        # a provider takes over an unknown number
+        one = Provider.objects.get(id=1)
+        one.mobile = "00000000"
+        one.save()
+        self.assertEqual(identities.provider("00000000").id, 1)
+        self.assertEqual(identities.provider("12345678"), None)
+
+        one.active = False
+        one.save()
+        self.assertEqual(identities.provider("00000000"), None)
+
+class FakeConnection:
+    reporter = None
+
+class FakeMessage:
+    def __init__(self, peer, text, was_handled=False):
+        self.peer = peer
+        self.text = text
+        self.was_handled = was_handled
+        self.persistant_connection = FakeConnection()
+
+class TestAlertIndex(TestCase):
+    fixtures = ["users.json", "alerts.json"]
+
+    def setUp(self):
+        alert_recipients.clear()
+
+    def ids(self):
+        return [p.id for p in alert_recipients.recipients(location_id=1, reporter_id=2)]
+
+    def testRecipients(self):
+        # 1 and 3 follow the clinic, 3 and 4 the reporter
+        self.assertEqual(self.ids(), [1, 3, 4])
+
+        one = Provider.objects.get(id=1)
+        one.alerts = False
+        one.save()
+        self.assertEqual(self.ids(), [3, 4])
+
+        four = Provider.objects.get(id=4)
+        four.following_users.remove(2)
+        self.assertEqual(self.ids(), [3])
+
+        four.following_clinics.add(1)
+        self.assertEqual(self.ids(), [3, 4])
+
+class TestIdAllocator(TransactionTestCase):
+
+    def testRollback(self):
+        reporter = Reporter.objects.create(alias="jdoe", first_name="Jane", last_name="Doe")
+        clinic = Location.objects.create(name="Sauri Clinic", code="sauri",
+                                         type=LocationType.objects.create(name="Clinic"))
+        def case():
+            return Case(first_name="Molly", last_name="Smith", gender="F", dob=date(2008, 6, 7),
+                        reporter=reporter, location=clinic)
+
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            case().save()
+            transaction.rollback()
+        finally:
+            transaction.leave_transaction_management()
+        # the id taken was not committed with the case
+        self.assertEqual(Case.objects.count(), 0)
+        self.assertEqual(Sequence.objects.count(), 0)
+        self.assertEqual(ReporterActivity.objects.count(), 0)
+
+        saved = case()
+        saved.save()
+        self.assertEqual(list(Case.objects.values_list("id", flat=True)), [saved.id])
+        self.assertEqual(saved.ref_id, saved._luhn(saved.id))
+
+class ClinicData:
+    """ the providers of users.json and alerts.json (1, 2 and 4 at
+        facility 1, 3 at facility 2) with their reporters, and helpers
+        to give them cases and reports """
+    fixtures = ["users.json", "alerts.json"]
+
+    def setUp(self):
+        # a provider reports as the Reporter with the id of its user
+        for provider in Provider.objects.all():
+            Reporter.objects.create(id=provider.user_id, alias="chw%d" % provider.user_id,
+                                    first_name="Chw", last_name="%d" % provider.user_id)
+        self.location = Location.objects.create(name="Sauri Clinic", code="sauri",
+                                                type=LocationType.objects.create(name="Clinic"))
+        self.now = datetime.now()
+
+    def case(self, reporter_id, months=12, days_ago=0):
+        case = Case(first_name="Kid", last_name="%d" % reporter_id, gender="M",
+                    dob=date.today() - timedelta(days=int(30.4375 * months)),
+                    reporter_id=reporter_id, location=self.location)
+        case.save()
+        if days_ago:
+            case.created_at = self.now - timedelta(days=days_ago)
+            Case.objects.filter(id=case.id).update(created_at=case.created_at)
+        return case
+
+    def report(self, model, case, days_ago=0, **fields):
+        report = model(case=case, reporter_id=case.reporter_id, **fields)
+        report.save()
+        report.entered_at = self.now - timedelta(days=days_ago, seconds=report.id)
+        model.objects.filter(id=report.id).update(entered_at=report.entered_at)
+        return report
+
+class TestCHWCounts(ClinicData, TestCase):
+
+    def setUp(self):
+        ClinicData.setUp(self)
+        for reporter_id, n in ((1, 3), (2, 1), (3, 2)):
+            for i in range(n):
+                case = self.case(reporter_id, days_ago=i * 20)
+                self.report(ReportMalaria, case, days_ago=i * 5, result=True, bednet=False)
+                self.report(ReportMalnutrition, case, days_ago=i * 25, muac=120)
+        for reporter_id, handled, days_ago in ((1, True, 0), (1, False, 1), (1, True, 40),
+                                               (3, False, 2), (None, True, 0)):
+            log = MessageLog(mobile="123", sent_by_id=reporter_id, text="muac", was_handled=handled)
+            log.save()
+            MessageLog.objects.filter(id=log.id).update(created_at=self.now - timedelta(days=days_ago))
+        # counted from the history, like after installing the counters
+        rebuild_activity.Command().rebuild()
+
+        self.start  = self.now - timedelta(days=30)
+        self.muac_start = self.now - timedelta(days=60)
+
+    def per_row(self, provider):
+        """ the numbers as counted for one provider at a time """
+        today = date.today()
+        id = provider.user_id
+        messages = MessageLog.objects.filter(sent_by=id, created_at__gte=self.start,
+                                             created_at__lte=self.now)
+        last = MessageLog.objects.filter(sent_by=id).order_by("-created_at")[:1]
+        days = ""
+        if last:
+            days = (today - last[0].created_at.date()).days
+        return {
+            "num_cases":            Case.objects.filter(reporter=id).count(),
+            "num_new_cases":        Case.objects.filter(reporter=id,
+                                        created_at__gte=today - timedelta(days=30)).count(),
+            "num_malaria_reports":  ReportMalaria.objects.filter(reporter=id,
+                                        entered_at__gte=self.start, entered_at__lte=self.now).count(),
+            "num_muac":             ReportMalnutrition.objects.filter(reporter=id,
+                                        entered_at__gte=self.muac_start, entered_at__lte=self.now).count(),
+            "sms_sent":             messages.count(),
+            "sms_processed":        messages.filter(was_handled=True).count(),
+            "sms_refused":          messages.filter(was_handled=False).count(),
+            "days_since_last_activity": days,
+        }
+
+    def testCounts(self):
+        providers = list(Provider.objects.all())
+        counts = ReportCHWStatus.chw_counts(providers, self.start, self.now, self.muac_start)
+        for provider in providers:
+            self.assertEqual(counts[provider.id], self.per_row(provider), provider.id)
+        self.assertEqual(counts[1]["num_cases"], 3)
+        self.assertEqual(counts[1]["num_new_cases"], 2)
+        self.assertEqual(counts[1]["sms_refused"], 1)
+
+    def testByClinics(self):
+        reports = ReportCHWStatus.get_providers_by_clinics(self.start, self.now, self.muac_start,
+                                                           [1, "2", 3])
+        for clinic_id in (1, "2", 3):
+            rows, fields = reports[clinic_id]
+            providers = Provider.list_by_clinic(clinic_id)
+            self.assertEqual([row["provider"] for row in rows[:-1]], list(providers))
+            expected = [self.per_row(provider) for provider in providers]
+            self.assertEqual([row["num_cases"] for row in rows[:-1]],
+                             [e["num_cases"] for e in expected])
+            self.assertEqual([row["sms_sent"] for row in rows[:-1]],
+                             [e["sms_sent"] for e in expected])
+            # the summary row
+            self.assertEqual(rows[-1]["provider"], "Summary")
+            self.assertEqual(rows[-1]["num_cases"], sum([e["num_cases"] for e in expected]))
+            self.assertEqual(rows[-1]["num_malaria_reports"],
+                             sum([e["num_malaria_reports"] for e in expected]))
+        # one clinic alone gives the same table
+        self.assertEqual(ReportCHWStatus.get_providers_by_clinic(self.start, self.now,
+                                                                 self.muac_start, 1)[0],
+                         reports[1][0])
+
+class TestMeaslesCoverage(ClinicData, TestCase):
+
+    def setUp(self):
+        ClinicData.setUp(self)
+        # the latest report of each case decides
+        for reporter_id, months, taken in ((1, 12, (False, True)), (1, 12, (True, False)),
+                                           (1, 24, ()), (1, 70, (True,)), (1, 3, (True,)),
+                                           (3, 30, (True, True)), (3, 10, (False,))):
+            case = self.case(reporter_id, months=months)
+            for i, value in enumerate(taken):
+                self.report(ReportMeasles, case, days_ago=len(taken) - i, taken=value)
+
+    def per_row(self, provider):
+        """ (cases, eligible, vaccinated) counted one case at a time """
+        dob_from, dob_to = Case.measles_window()
+        cases = Case.objects.filter(reporter=provider.user_id)
+        eligible = cases.filter(dob__gte=dob_from, dob__lte=dob_to)
+        vaccinated = len([case for case in eligible if ReportMeasles.is_vaccinated(case)])
+        return cases.count(), eligible.count(), vaccinated
+
+    def testCountVaccinated(self):
+        dob_from, dob_to = Case.measles_window()
+        counts = ReportMeasles.count_vaccinated([1, 2, 3, 4], dob_from, dob_to)
+        self.assertEqual(counts, {1: 1, 3: 1})
+        self.assertEqual(ReportMeasles.count_vaccinated([], dob_from, dob_to), {})
+
+    def testCoverage(self):
+        providers = list(Provider.objects.all())
+        coverage = ReportCHWStatus.measles_coverage(providers)
+        for provider in providers:
+            self.assertEqual(coverage[provider.id], self.per_row(provider), provider.id)
+        self.assertEqual(coverage[1], (5, 3, 1))
+
+class TestCaseStatus(ClinicData, TestCase):
+    fixtures = ClinicData.fixtures + ["observations.json"]
+
+    def setUp(self):
+        ClinicData.setUp(self)
+        self.cases = [self.case(1), self.case(1), self.case(2)]
+        one, two, three = self.cases
+        # filed over the last weeks, the status following each one
+        for model, case, days_ago, fields in (
+                (ReportMalnutrition, one, 10, {"muac": 130, "status": 4}),
+                (ReportMalaria, one, 20, {"result": False, "bednet": False}),
+                (ReportMalaria, one, 3, {"result": True, "bednet": False}),
+                (ReportMeasles, one, 5, {"taken": False}),
+                (ReportMalaria, two, 20, {"result": True, "bednet": True}),
+                (ReportMeasles, two, 6, {"taken": True}),
+                (ReportMeasles, two, 2, {"taken": False})):
+            CaseStatus.record(self.report(model, case, days_ago, **fields))
+
+        # and today's
+        observed = [Observation.objects.get(uid="edema")]
+        muac = ReportMalnutrition(case=one, reporter_id=1, muac=105)
+        muac.diagnose(observed)
+        file_report(muac, links={"observed": observed})
+        file_report(ReportMalaria(case=one, reporter_id=1, result=True, bednet=True),
+                    links={"observed": []})
+        measles = ReportMeasles(case=one, reporter_id=1, taken=True)
+        measles.save()
+        CaseStatus.record(measles)
+
+    def per_row(self, case):
+        """ what the listings used to read from the latest reports """
+        today = date.today()
+        row = {"muac": "", "symptoms": "", "muac_days": "", "malaria": "", "bednet": ""}
+        muac = ReportMalnutrition.objects.filter(case=case)[:1]
+        if muac:
+            row["muac"] = "%s (%smm)" % (muac[0].get_status_display(), muac[0].muac)
+            row["symptoms"] = muac[0].symptoms_keys()
+            row["muac_days"] = (today - muac[0].entered_at.date()).days
+        mrdt = ReportMalaria.objects.filter(case=case)
+        if mrdt and mrdt[0].entered_at.date() >= today - timedelta(14):
+            row["malaria"] = mrdt[0].results_for_malaria_result()
+            row["bednet"] = mrdt[0].results_for_malaria_bednet()
+        if mrdt.count() > 1:
+            row["malaria"] += "(%sX)" % mrdt.count()
+            days = (today - mrdt[0].entered_at.date()).days
+            if days < 15:
+                row["malaria"] += " %s days ago" % days
+        row["vaccinated"] = ReportMeasles.is_vaccinated(case)
+        return row
+
+    def testSameAsReports(self):
+        count_queries()
+        before = queries()
+        statuses = CaseStatus.for_cases(self.cases)
+        self.assertEqual(queries() - before, 1)
+
+        for case in self.cases:
+            status = statuses[case.id]
+            self.assertEqual({"muac": status.muac_text(), "symptoms": status.muac_symptoms,
+                              "muac_days": status.muac_days(), "malaria": status.malaria_text(),
+                              "bednet": status.bednet_text(), "vaccinated": status.vaccinated},
+                             self.per_row(case), case.id)
+
+        one, two, three = self.cases
+        self.assertEqual(statuses[one.id].malaria_text(), "+(3X) 0 days ago")
+        self.assertEqual(statuses[one.id].muac_symptoms, "E")
+        self.assertEqual(statuses[two.id].malaria_text(), "")
+        self.assertEqual(statuses[two.id].vaccinated, False)
+        # no report yet
+        self.assertEqual(statuses[three.id].muac_text(), "")
+        self.assertEqual(statuses[three.id].pk, three.id)
+
+class TestMalariaListing(ClinicData, TestCase):
+
+    def testRows(self):
+        one, two = self.case(1), self.case(3)
+        for case, days_ago, bednet in ((one, 20, False), (one, 3, True), (two, 1, False)):
+            self.report(ReportMalaria, case, days_ago, result=True, bednet=bednet)
+
+        rows, fields = ReportAllPatients.malaria_by_provider()
+        rows = list(rows)
+        self.assertEqual([(row["counter"], row["case"].id) for row in rows],
+                         [("1", one.id), ("2", two.id)])
+        self.assertEqual([row["provider"] for row in rows],
+                         [Provider.objects.get(user=1), Provider.objects.get(user=3)])
+        self.assertEqual([row["malaria_result"] for row in rows], ["+(2X) 3 days ago", "-"])
+        self.assertEqual([row["malaria_bednet"] for row in rows], ["Y", "N"])
+        # the CHW column shows the provider's number
+        chw = compile_fields([f for f in fields if f["name"] == "CHW"])
+        self.assertEqual(chw(rows[0]), [u"12345678 12345678"])
+
+        # the cases of one provider
+        rows, fields = ReportAllPatients.malaria_by_provider(Provider.objects.get(user=3).id)
+        self.assertEqual([row["case"].id for row in rows], [two.id])
+
+class TestReportWriter(TestCase):
+    fixtures = ("observations.json",)
+
+    def setUp(self):
+        self.reporter = Reporter.objects.create(alias="jdoe", first_name="Jane", last_name="Doe")
+        clinic = Location.objects.create(name="Sauri Clinic", code="sauri",
+                                         type=LocationType.objects.create(name="Clinic"))
+        self.case = Case(first_name="Molly", last_name="Smith", gender="F", dob=date(2008, 6, 7),
+                         reporter=self.reporter, location=clinic)
+        self.case.save()
+
+    def diagnose(self, diags, labs):
+        report = ReportDiagnosis(case=self.case, reporter=self.reporter, text="diagnosis")
+        results = [LabDiagnosis(lab=lab, result=True, amount=amount) for lab, amount in labs]
+        replaced = file_report(report, links={"diagnosis": diags},
+                               related=[(LabDiagnosis, "diagnosis", results)])
+        return report, replaced
+
+    def testReplace(self):
+        category = DiagnosisCategory.objects.create(name="Infectious")
+        diags = [Diagnosis.objects.create(name=name, code=code, category=category, mvp_code=name)
+                 for name, code in (("Cholera", "001"), ("Malaria", "084.9"))]
+        smear = Lab.objects.create(name="Blood Smear", code="BS")
+        stool = Lab.objects.create(name="Stool", code="ST")
+
+        first, replaced = self.diagnose(diags, [(smear, 3), (stool, None)])
+        self.assertFalse(replaced)
+        # the same case again today replaces the report and its rows
+        second, replaced = self.diagnose(diags[1:], [(stool, 5)])
+        self.assertTrue(replaced)
+        self.assertEqual(second.id, first.id)
+        self.assertEqual(ReportDiagnosis.objects.filter(case=self.case).count(), 1)
+        self.assertEqual([d.id for d in second.diagnosis.all()], [diags[1].id])
+        self.assertEqual([(ld.lab_id, ld.amount) for ld in LabDiagnosis.objects.all()],
+                         [(stool.id, 5)])
+        self.assertEqual(self.case.current_status.diagnosis_at, second.entered_at)
+
+    def testStatements(self):
+        count_queries()
+        observed = list(Observation.objects.all())
+        def statements(observed):
+            report = ReportMalnutrition(case=self.case, reporter=self.reporter, muac=105)
+            report.diagnose(observed)
+            before = queries()
+            file_report(report, links={"observed": observed})
+            return queries() - before
+
+        statements([])
+        # replacing, with one observation or all of them
+        one = statements(observed[:1])
+        self.assertEqual(statements(observed), one)
+        self.assertEqual(ReportMalnutrition.objects.get(case=self.case).observed.count(),
+                         len(observed))
+
+class TestMessageLogWriter(TestCase):
+
+    def setUp(self):
+        fd, self.spool = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.spool)
+
+    def testMerge(self):
+        writer = MessageLogWriter(spool=self.spool)
+        message = FakeMessage("7654321", "muac +26 105")
+        # first app did not handle it, the next one did
+        writer.write(message)
+        message.was_handled = True
+        writer.write(message)
+        writer.write(FakeMessage("7654321", "*yawn*"))
+        self.assertEqual(MessageLog.objects.count(), 0)
+
+        self.assertEqual(writer.flush(force=True), 2)
+        self.assertEqual(MessageLog.objects.count(), 2)
+        self.assertEqual(MessageLog.objects.filter(was_handled=True).count(), 1)
+        self.assertEqual(open(self.spool).read(), "")
+
+    def testHeld(self):
+        writer = MessageLogWriter(spool=self.spool)
+        writer.settle = 0
+        message = FakeMessage("7654321", "muac +26 105")
+        # a handler still runs on the pool
+        message.jobs = 1
+        writer.write(message)
+        self.assertEqual(writer.flush(), 0)
+        # done, no app wrote it again
+        message.jobs = 0
+        message.was_handled = True
+        self.assertEqual(writer.flush(), 1)
+        self.assertEqual(MessageLog.objects.filter(was_handled=True).count(), 1)
+
+    def testRecover(self):
+        # router dies before flushing
+        crashed = MessageLogWriter(spool=self.spool)
+        crashed.write(FakeMessage("7654321", "muac +26 105", True))
+        crashed.write(FakeMessage("7654321", "*yawn*"))
+        self.assertEqual(MessageLog.objects.count(), 0)
+
+        writer = MessageLogWriter(spool=self.spool)
+        writer.recover()
+        self.assertEqual(MessageLog.objects.count(), 2)
+        self.assertEqual(MessageLog.objects.filter(was_handled=True).count(), 1)
+
+class TestCodeTables(TestCase):
+    fixtures = ("observations.json", "diagnoses_categories.json", "diagnoses.json")
+
+    def testResolve(self):
+        found, unknown = diagnoses.resolve(["001", "XYZ"])
+        self.assertEqual([d.code for d in found], ["001"])
+        self.assertEqual(unknown, ["XYZ"])
+        self.assertEqual(observations.get("CG").letter, "cg")
+
+    def testReload(self):
+        observations.codes()
+        reloads = observations.reloads
+        observations.codes()
+        self.assertEqual(observations.reloads, reloads)
+
+        # admin edits the table
+        obs = Observation.objects.get(letter="cg")
+        obs.name = "Cough (renamed)"
+        obs.save()
+        self.assertEqual(observations.get("cg").name, "Cough (renamed)")
+        self.assertEqual(observations.reloads, reloads + 1)
+
+class FakeBackend:
+    def __init__(self, slug):
+        self.slug = slug
+
+    def message(self, identity, text):
+        return (self.slug, identity, text)
+
+class FakeRouter:
+    def __init__(self, *slugs):
+        self.backends = [FakeBackend(slug) for slug in slugs]
+        self.sent = []
+
+    def call_at(self, interval, func):
+        pass
+
+    def outgoing(self, message):
+        self.sent.append(message)
+
+class TestBroadcaster(TestCase):
+
+    def testRate(self):
+        router = FakeRouter("gsm", "http")
+        sender = Broadcaster(rate=120, interval=1)
+        sender.attach(router)
+        broadcast = sender.queue("msummary", ["one", "two"],
+                                 [("gsm", "111"), ("gsm", "222"), ("http", "333")])
+        self.assertEqual(broadcast.total, 6)
+
+        # two messages a tick on each backend, texts in order
+        sender.tick()
+        self.assertEqual(router.sent, [("gsm", "111", "one"), ("gsm", "222", "one"),
+                                       ("http", "333", "one"), ("http", "333", "two")])
+        self.assertEqual(Broadcast.objects.get(id=broadcast.id).sent, 4)
+
+        sender.tick()
+        broadcast = Broadcast.objects.get(id=broadcast.id)
+        self.assertEqual(broadcast.sent, 6)
+        self.assertEqual(broadcast.status, Broadcast.STATUS_DONE)
+
+class TestDailyStat(TestCase):
+
+    def testMessages(self):
+        day = datetime(2009, 6, 1, 10, 30)
+        rows = [{"text": "MUAC +26 105", "was_handled": True, "created_at": day},
+                {"text": "muac 26", "was_handled": False, "created_at": day},
+                {"text": "@jdoe call me", "was_handled": True, "created_at": day + timedelta(days=1)}]
+        DailyStat.add(message_stats(rows))
+        DailyStat.add(message_stats(rows[:1]))
+
+        days, before = DailyStat.month(date(2009, 6, 1), date(2009, 6, 30))
+        self.assertEqual(before, {})
+        self.assertEqual(days[date(2009, 6, 1)],
+                         {"sms_sent": 3, "sms_processed": 2, "sms_refused": 1, "sms_muac": 3})
+        self.assertEqual(days[date(2009, 6, 2)],
+                         {"sms_sent": 1, "sms_processed": 1, "sms_user": 1})
+
+        days, before = DailyStat.month(date(2009, 6, 2), date(2009, 6, 30))
+        self.assertEqual(before["sms_sent"], 3)
+
+class TestReporterActivity(TestCase):
+
+    def testMessages(self):
+        reporter = Reporter.objects.create(alias="jdoe", first_name="Jane", last_name="Doe")
+        day = datetime(2009, 6, 1, 10, 30)
+        rows = [{"sent_by": reporter.id, "was_handled": True, "created_at": day},
+                {"sent_by": reporter.id, "was_handled": False, "created_at": day},
+                {"sent_by": None, "was_handled": False, "created_at": day},
+                {"sent_by": reporter.id, "was_handled": True, "created_at": day + timedelta(days=1)}]
+        count_messages(rows)
+        count_messages(rows[:1])
+
+        totals = ReporterDay.totals([reporter.id], date(2009, 6, 1), date(2009, 6, 1))
+        self.assertEqual(totals[reporter.id],
+                         {"cases": 0, "sms_sent": 3, "sms_processed": 2, "sms_refused": 1})
+        self.assertEqual(ReporterDay.total(reporter.id, day, day + timedelta(days=1), "sms_sent"), 4)
+        self.assertEqual(ReporterActivity.of(reporter.id).last_activity, day + timedelta(days=1))
+
+class TestColumns(TestCase):
+
+    def testSameAsTemplate(self):
+        case = Case(ref_id=26, first_name="Molly", last_name="O'Neil <jr>", gender="F",
+                    dob=date(2008, 6, 7))
+        fields = [{"name": "#", "bit": "{{ object.ref_id }}"},
+                  {"name": "Name", "bit": "{{ object.last_name }} {{object.first_name}}"},
+                  {"name": "Missing", "bit": "{{ object.nothing.here }}%"},
+                  {"name": "Filtered", "bit": "{{ object.first_name|upper }}"},
+                  {"name": "Tag", "bit": "{% if object.gender %}{{ object.gender }}{% endif %}"}]
+        expected = [Template(f["bit"]).render(Context({"object": case})) for f in fields]
+        self.assertEqual(compile_fields(fields)(case), expected)
+        self.assertEqual(expected[1], u"O&#39;Neil &lt;jr&gt; Molly")
+
+class TestPDFReport(TestCase):
+
+    def testIsolated(self):
+        fields = [{"name": "#", "bit": "{{ object }}"}]
+        held = []
+        hook = lambda report, bytes: held.append(bytes)
+        memory_hooks.append(hook)
+        try:
+            one = PDFReport()
+            one.setTableData([1, 2], fields, "one")
+        finally:
+            memory_hooks.remove(hook)
+        # a second report starts empty
+        two = PDFReport()
+        self.assertEqual(two.data, [])
+        self.assertEqual(two.headers, [""])
+        self.assertEqual(len(one.data), 1)
+        self.assert_(one.held() > 0)
+        self.assertEqual(held, [one.held()])
+
+    def testSections(self):
+        fields = [{"name": "#", "bit": "{{ object }}"}]
+        report = PDFReport()
+        report.setPageBreak()
+        report.setTableData([1, 2], fields, "one")
+        report.setPageBreak()
+        report.setTableData([], fields, "empty")
+        report.setPageBreak()
+        report.setTableData([3], fields, "two")
+        self.assertEqual(report.data[0], PAGE_BREAK)
+        # one section per table between the page breaks
+        self.assertEqual([[rows for rows, footer, size in section] for section in report.sections()],
+                         [[[["#"], ["1"], ["2"]]], [[["#"], ["3"]]]])
+
+    def testSectionHeaders(self):
+        if pdfreport.multiprocessing is None:
+            return
+        fields = [{"name": "#", "bit": "{{ object }}"}]
+        report = PDFReport()
+        report.setPageBreak()
+        report.setTableData(range(100), fields, "Sauri Clinic")
+        report.setPageBreak()
+        report.setTableData(range(10), fields, "Gongo Clinic")
+        parts = report.split()
+        # the pages of each section have their own headings
+        self.assertEqual([headings for tables, headings in parts],
+                         [["Sauri Clinic"] * 2, ["Gongo Clinic"]])
+        workers = getattr(settings, "PDF_WORKERS", None)
+        settings.PDF_WORKERS = 2
+        try:
+            response = report.render()
+        finally:
+            settings.PDF_WORKERS = workers
+        merged = pdfreport.PdfFileReader(StringIO("".join(response)))
+        counts = []
+        for i, (tables, headings) in enumerate(parts):
+            state = report.state()
+            state.update({"data": tables, "titlepage": i == 0,
+                          "headers": i == 0 and [""] + headings or headings})
+            counts.append(pdfreport.PdfFileReader(StringIO(render_section(state))).getNumPages())
+        self.assertEqual(merged.getNumPages(), sum(counts))
+        # after the title page, and on the first page of the second section
+        self.assert_("Sauri Clinic" in merged.getPage(1).extractText())
+        self.assert_("Gongo Clinic" in merged.getPage(counts[0]).extractText())
+
+class TestReportCache(TestCase):
+
+    def setUp(self):
+        self.cache = ReportCache(directory=tempfile.mkdtemp(), size=10)
+
+    def tearDown(self):
+        self.cache.clear()
+        os.rmdir(self.cache.directory)
+
+    def response(self, content):
+        response = HttpResponse(content, mimetype="text/csv")
+        response["Content-Disposition"] = "attachment; filename=report.csv"
+        return response
+
+    def testGetPut(self):
+        self.assertEqual(self.cache.get("one"), None)
+        self.cache.put("one", self.response("1234"))
+        response = self.cache.get("one")
+        self.assertEqual(response.content, "1234")
+        self.assertEqual(response["Content-Type"], "text/csv")
+        self.assertEqual(response["Content-Disposition"], "attachment; filename=report.csv")
+
+    def testEvict(self):
+        self.cache.put("one", self.response("1234"))
+        os.utime(self.cache.path("one"), (0, 0))
+        self.cache.put("two", self.response("5678"))
+        # over 10 bytes, the least recently used goes
+        self.cache.put("three", self.response("9012"))
+        self.assertEqual(self.cache.get("one"), None)
+        self.assertEqual(self.cache.get("two").content, "5678")
+        self.assertEqual(self.cache.get("three").content, "9012")
+
+    def testStreamed(self):
+        cache = ReportCache(directory=self.cache.directory, size=1000)
+        rows = [["id", "name"], [1, u"Molly"]]
+        chunks = cache.save("one", csv_response(rows, "report.csv"))
+        self.assertEqual(chunks.next(), "id,name\r\n1,Molly\r\n")
+        # the client went away before the end, nothing is kept
+        chunks.close()
+        self.assertEqual(cache.get("one"), None)
+        self.assertEqual(os.listdir(cache.directory), [])
+
+        cache.put("one", csv_response(rows, "report.csv"))
+        self.assertEqual(cache.get("one").content, "id,name\r\n1,Molly\r\n")
+
+    def testCachedReport(self):
+        calls = []
+        def report(request):
+            calls.append(request)
+            return csv_response([["id"], [len(calls)]], "report.csv")
+        view = cached_report(report)
+        cache = reportcache.report_cache
+        directory, size = cache.directory, cache.size
+        cache.directory, cache.size = self.cache.directory, 1000
+        try:
+            request = JobRequest("/reports/test/", {}, {}, AnonymousUser())
+            self.assertEqual("".join(view(request)), "id\r\n1\r\n")
+            # the second time from the cache
+            response = view(request)
+            self.assertEqual("".join(response), "id\r\n1\r\n")
+            self.assertEqual(response["Content-Disposition"], "attachment; filename=report.csv")
+            self.assertEqual(len(calls), 1)
+        finally:
+            cache.directory, cache.size = directory, size
+
+    def testVersion(self):
+        # two processes that bumped as many times, within the same mtime
+        web, router = VersionStamp("test"), VersionStamp("test")
+        web.bump()
+        seen = web.shared()
+        router.bump()
+        os.utime(router.path, (seen[0], seen[0]))
+        self.assertNotEqual(router.shared(), seen)
+        self.assertEqual([name for name in os.listdir(os.path.dirname(web.path))
+                          if name.startswith("rapidsms-test.version.")], [])
+        os.remove(web.path)
+
+class TestReportJobs(TestCase):
+
+    def setUp(self):
+        # no worker threads, the test runs the jobs
+        self.jobs = ReportJobs(workers=0, directory=tempfile.mkdtemp())
+        def view(request, per_page="0"):
+            self.jobs.progress(1, 2)
+            response = HttpResponse("report %s" % per_page, mimetype="text/csv")
+            response["Content-Disposition"] = "attachment; filename=report.csv"
+            return response
+        self.jobs.register("report", view)
+        self.request = JobRequest("/report/", {}, {}, AnonymousUser())
+
+    def tearDown(self):
+        for name in os.listdir(self.jobs.directory):
+            os.remove(os.path.join(self.jobs.directory, name))
+        os.rmdir(self.jobs.directory)
+
+    def testDedup(self):
+        one = self.jobs.submit(self.request, "report", (), {"per_page": "1"}, "key")
+        two = self.jobs.submit(self.request, "report", (), {"per_page": "1"}, "key")
+        self.assertEqual(one.id, two.id)
+
+        self.jobs.run(one.id)
+        job = ReportJob.objects.get(id=one.id)
+        self.assertEqual(job.status, ReportJob.STATUS_DONE)
+        self.assertEqual((job.done, job.total), (1, 2))
+        self.assertEqual(job.filename, "report.csv")
+        self.assertEqual(self.jobs.read(job), "report 1")
+
+        # done, the next request starts over
+        three = self.jobs.submit(self.request, "report", (), {"per_page": "1"}, "key")
+        self.assertNotEqual(three.id, one.id)
+
+    def testPurge(self):
+        old = datetime.now() - timedelta(days=2)
+        ids = []
+        for status in (ReportJob.STATUS_DONE, ReportJob.STATUS_RUNNING):
+            job = ReportJob(key="old", view="report", path="/report/", status=status,
+                            owner=self.jobs.owner())
+            job.save()
+            ReportJob.objects.filter(id=job.id).update(created_at=old)
+            ids.append(job.id)
+        self.jobs.purge()
+        # a job still running is kept, however old
+        self.assertEqual(list(ReportJob.objects.values_list("id", flat=True)), ids[1:])
+
+    def testRecover(self):
+        # a web server process that exited
+        child = os.fork()
+        if not child:
+            os._exit(0)
+        os.waitpid(child, 0)
+        dead = "%s:%d" % (socket.gethostname(), child)
+
+        def job(owner, status):
+            job = ReportJob(key=owner, view="report", path="/report/", owner=owner, status=status,
+                            params='{"args": [], "kwargs": {}, "GET": {}, "POST": {}}')
+            job.save()
+            return job.id
+        queued  = job(dead, ReportJob.STATUS_QUEUED)
+        running = job(dead, ReportJob.STATUS_RUNNING)
+        job(self.jobs.owner(), ReportJob.STATUS_RUNNING)
+        job("elsewhere:1", ReportJob.STATUS_RUNNING)
+
+        self.assertEqual(sorted(self.jobs.recover()), [queued, running])
+        self.assertEqual(self.jobs.recover(), [])
+        for id in (queued, running):
+            self.assertEqual(ReportJob.objects.get(id=id).owner, self.jobs.owner())
+            self.assertEqual(self.jobs.queue.get_nowait(), id)
+            self.jobs.run(id)
+            self.assertEqual(ReportJob.objects.get(id=id).status, ReportJob.STATUS_DONE)
+
+        # asked for again, a dead process's job is taken over
+        orphan = job(dead, ReportJob.STATUS_RUNNING)
+        ReportJob.objects.filter(id=orphan).update(key="key")
+        self.assertEqual(self.jobs.submit(self.request, "report", (), {}, "key").id, orphan)
+        self.assertEqual(ReportJob.objects.get(id=orphan).owner, self.jobs.owner())
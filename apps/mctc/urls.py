@@ -17,6 +17,10 @@ urlpatterns = patterns('',
     url(r'^mctc/?$', views.index),
     url(r'^mctc/reports?$', views.reports),
     (r'^report/(?P<report_name>[a-z\-\_]+)/(?P<object_id>\d*)$', "mctc.views.report_view"),
+    #reports built in the background
+    (r'^reports/jobs/(?P<job_id>\d+)/$', "mctc.views.report_job"),
+    (r'^reports/jobs/(?P<job_id>\d+)/status$', "mctc.views.report_job_status"),
+    (r'^reports/jobs/(?P<job_id>\d+)/download$', "mctc.views.report_job_download"),
     #last_30_days
     (r'^last_30_days/$', "mctc.views.last_30_days"),
     (r'^last_30_days/(?P<object_id>\d*)$', "mctc.views.last_30_days"),
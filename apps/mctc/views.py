@@ -4,7 +4,7 @@
 from rapidsms.webui.utils import render_to_response
 from models.general import Provider
 from django.db.models import ObjectDoesNotExist, Q
-from django.contrib.auth.models import User, Group
+from django.contrib.auth.models import Group
 from datetime import datetime, timedelta
 from mctc.forms.general import MessageForm
 from pygsm.gsmmodem import GsmModem
@@ -12,25 +12,29 @@ from pygsm.gsmmodem import GsmModem
 
 from mctc.forms.login import LoginForm
 from mctc.shortcuts import as_html, login_required
-from mctc.models.logs import log, MessageLog, EventLog
+from mctc.reportcache import cached_report
+from mctc.reportjobs import background_report, report_jobs
+from mctc.models.jobs import ReportJob
+from mctc.models.logs import log
 from mctc.models.general import Case, Zone, Provider, Facility
 from mctc.models.reports import ReportCHWStatus, ReportAllPatients
+from mctc.models import stats as stat
+from mctc.models.stats import DailyStat
 from muac.models import ReportMalnutrition
-from mrdt.models import ReportMalaria
 from libreport.pdfreport import PDFReport
+from libreport.csvreport import csv_response, table_rows
 from django.utils.translation import ugettext_lazy as _
 
 
-from django.template import Template, Context
 from django.template.loader import get_template
 from django.core.paginator import Paginator, InvalidPage
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, Http404
+from django.shortcuts import get_object_or_404
+from django.utils import simplejson
 
 from tempfile import mkstemp
 from datetime import datetime, timedelta, date
 import os
-import csv
-import StringIO
 
 app = {}
 app['name'] = "RapidResponse:Health"
@@ -167,6 +171,8 @@ def reports(request):
     return render_to_response(request, template_name, context)
 
 @login_required
+@background_report
+@cached_report
 def last_30_days(request, object_id=None, per_page="0", rformat="pdf", d="30"):
     pdfrpt = PDFReport()
     d = int(d)
@@ -182,10 +188,14 @@ def last_30_days(request, object_id=None, per_page="0", rformat="pdf", d="30"):
     pdfrpt.setTitle("RapidResponse MVP Kenya: CHW 30 Day Performance Report, from %s to %s"%(duration_start, duration_end))
     
     if object_id is None:
-        clinics = Provider.objects.values('clinic').filter(role=1).distinct()
-        for clinic in clinics:
-            queryset, fields = ReportCHWStatus.get_providers_by_clinic(duration_start, duration_end, muac_duration_start, clinic["clinic"])
-            c = Facility.objects.filter(id=clinic["clinic"])[0]
+        clinics = [c["clinic"] for c in Provider.objects.values('clinic').filter(role=1).distinct()]
+        # all the clinics in one go, see ReportCHWStatus.get_providers_by_clinics
+        reports = ReportCHWStatus.get_providers_by_clinics(duration_start, duration_end, muac_duration_start, clinics)
+        facilities = Facility.objects.in_bulk(clinics)
+        for i, clinic in enumerate(clinics):
+            report_jobs.progress(i, len(clinics))
+            queryset, fields = reports[clinic]
+            c = facilities[clinic]
             pdfrpt.setTableData(queryset, fields, c.name)
             if (int(per_page) == 1) is True:
                 pdfrpt.setPageBreak()
@@ -206,6 +216,8 @@ def last_30_days(request, object_id=None, per_page="0", rformat="pdf", d="30"):
     return pdfrpt.render()
 
 @login_required
+@background_report
+@cached_report
 def measles_summary(request, object_id=None, per_page="0", rformat="pdf", d="30"):
     pdfrpt = PDFReport()
     d = int(d)
@@ -221,8 +233,9 @@ def measles_summary(request, object_id=None, per_page="0", rformat="pdf", d="30"
     #pdfrpt.setTitle("RapidResponse MVP Kenya: CHW 30 Day Performance Report, from %s to %s"%(duration_start, duration_end))
     pdfrpt.setTitle("Measles Campaign Summary")
     if object_id is None:
-        clinics = Provider.objects.values('clinic').filter(role=1).distinct()
-        for clinic in clinics:
+        clinics = list(Provider.objects.values('clinic').filter(role=1).distinct())
+        for i, clinic in enumerate(clinics):
+            report_jobs.progress(i, len(clinics))
             queryset, fields = ReportCHWStatus.measles_summary(duration_start, duration_end, muac_duration_start, clinic["clinic"])
             c = Facility.objects.filter(id=clinic["clinic"])[0]
             pdfrpt.setTableData(queryset, fields, c.name)
@@ -245,6 +258,8 @@ def measles_summary(request, object_id=None, per_page="0", rformat="pdf", d="30"
     return pdfrpt.render()
 
 @login_required
+@background_report
+@cached_report
 def patients_by_chw(request, object_id=None, per_page="0", rformat="pdf"):
     pdfrpt = PDFReport()
     pdfrpt.setLandscape(False)
@@ -256,7 +271,9 @@ def patients_by_chw(request, object_id=None, per_page="0", rformat="pdf"):
             per_page = "1"
         else:
             providers = Case.objects.order_by("zone").values('provider', 'zone__name').distinct()
-        for provider in providers:
+        providers = list(providers)
+        for i, provider in enumerate(providers):
+            report_jobs.progress(i, len(providers))
             queryset, fields = ReportAllPatients.by_provider(provider['provider'])
             if queryset:
                 c = Provider.objects.get(id=provider["provider"])
@@ -281,23 +298,38 @@ def patients_by_chw(request, object_id=None, per_page="0", rformat="pdf"):
     
     return pdfrpt.render()
 
-def handle_csv(request, queryset, fields, file_name):
-    output = StringIO.StringIO()
-    csvio = csv.writer(output)
-    header = False
-    for row in queryset:
-        ctx = Context({"object": row })
-        if not header:
-            csvio.writerow([f["name"] for f in fields])
-            header = True
-        values = [ Template(h["bit"]).render(ctx) for h in fields ]
-        csvio.writerow(values)
-
-    response = HttpResponse(mimetype='text/csv')
-    response['Content-Disposition'] = "attachment; filename=%s" % file_name
-    response.write(output.getvalue())
+@login_required
+def report_job(request, job_id):
+    """ progress of a report built in the background, see mctc.reportjobs """
+    job = get_object_or_404(ReportJob, id=job_id)
+    return render_to_response(request, "mctc/report_job.html", {"job": job})
+
+@login_required
+def report_job_status(request, job_id):
+    job = get_object_or_404(ReportJob, id=job_id)
+    status = {
+        "status": job.status,
+        "done": job.done,
+        "total": job.total,
+        "percent": job.percent(),
+        "download": job.status == ReportJob.STATUS_DONE and "%sdownload" % job.get_absolute_url() or None,
+    }
+    return HttpResponse(simplejson.dumps(status), mimetype="application/json")
+
+@login_required
+def report_job_download(request, job_id):
+    job = get_object_or_404(ReportJob, id=job_id, status=ReportJob.STATUS_DONE)
+    try:
+        content = report_jobs.chunks(job)
+    except IOError:
+        raise Http404
+    response = HttpResponse(content, mimetype=job.content_type)
+    response['Content-Disposition'] = "attachment; filename=%s" % job.filename
     return response
 
+def handle_csv(request, queryset, fields, file_name):
+    # streamed while the queryset is read, see libreport.csvreport
+    return csv_response(table_rows(queryset, fields), file_name)
 
 @login_required
 def report_view(request, report_name, object_id=None):
@@ -328,8 +360,6 @@ def report_view(request, report_name, object_id=None):
     return eval("handle_%s" % format)(request, queryset, fields, filename)
 
 def measles_mini_summary_csv(request, file_name):
-    output = StringIO.StringIO()
-    csvio = csv.writer(output)
     header = False
     summary =  ReportCHWStatus.measles_mini_summary()
     rows = []
@@ -340,7 +370,10 @@ def measles_mini_summary_csv(request, file_name):
     row.append("%")
     rows.append(row)
     for info in summary:
-        info["percentage"] = round(float(float(info["vaccinated_cases"])/float(info["eligible_cases"]))*100, 2); 
+        if info["eligible_cases"] != 0:
+            info["percentage"] = round(float(float(info["vaccinated_cases"])/float(info["eligible_cases"]))*100, 2)
+        else:
+            info["percentage"] = 0
         
         row = []
         row.append(u"%(clinic)s"%info)
@@ -348,17 +381,9 @@ def measles_mini_summary_csv(request, file_name):
         row.append(u"%(eligible_cases)s"%info)
         row.append(u"%(percentage)s%%"%info)
         rows.append(row)
-    # Write rows on CSV
-    for row in rows:
-        csvio.writerow([cell for cell in row])    
-    response = HttpResponse(mimetype='text/csv')
-    response['Content-Disposition'] = "attachment; filename=%s" % file_name
-    response.write(output.getvalue())
-    return response
+    return csv_response(rows, file_name)
 
 def report_monitoring_csv(request, object_id, file_name):
-    output = StringIO.StringIO()
-    csvio = csv.writer(output)
     header = False
     
     # parse parameter
@@ -369,7 +394,7 @@ def report_monitoring_csv(request, object_id, file_name):
     days= range(-1, eom.day + 1)
     days.remove(0)
     gdays   = days # store that good list
-    csvio.writerow([d.__str__().replace("-1", month.strftime("%B")) for d in days])
+    heading = [d.__str__().replace("-1", month.strftime("%B")) for d in days]
     
     # Initialize Rows
     sms_num     = ["# SMS Sent"]
@@ -411,108 +436,91 @@ def report_monitoring_csv(request, object_id, file_name):
     blank       = []
 
     # List all rows    
-    rows    = [blank, sms_num, sms_process, sms_refused, blank, chw_tot, chw_reg, chw_reg_err, blank,
+    rows    = [heading, blank, sms_num, sms_process, sms_refused, blank, chw_tot, chw_reg, chw_reg_err, blank,
     chw_on, blank, patient_reg, patient_reg_err, blank, malaria_tot, malaria_err, blank, 
     malaria_pos, bednet_y_pos, bednet_n_pos, malaria_neg, bednet_y_neg, bednet_n_neg, blank,
     malnut_tot, malnut_err, blank, samp_tot, sam_tot, mam_tot, blank, samp_new, sam_new, mam_new, blank, user_msg]
     
+    # the whole month in one read, see DailyStat
+    stats, before = DailyStat.month(month.date(), eom.date())
+    totals = dict(before)
+    def cumulative(day, metric):
+        totals[metric] = totals.get(metric, 0) + day.get(metric, 0)
+        return totals[metric]
+
     # Loop on days
     for d in gdays:
         if d == -1: continue
-        ref_date    = datetime(month.year, month.month, d)
-        morning     = day_start(ref_date)
-        evening     = day_end(ref_date)
+        day         = stats.get(date(month.year, month.month, d), {})
+        def get(metric):
+            return day.get(metric, 0)
         
         # Number of SMS Sent
-        sms_num.append(MessageLog.objects.filter(created_at__gte=morning, created_at__lte=evening).count())
+        sms_num.append(get(stat.SMS_SENT))
         
         # Number of SMS Processed
-        sms_process.append(MessageLog.objects.filter(created_at__gte=morning, created_at__lte=evening, was_handled=True).count())
+        sms_process.append(get(stat.SMS_PROCESSED))
         
         # Number of SMS Refused
-        sms_refused.append(MessageLog.objects.filter(created_at__gte=morning, created_at__lte=evening, was_handled=False).count())
+        sms_refused.append(get(stat.SMS_REFUSED))
         
         # Total # of CHW in System
-        chw_tot.append(Provider.objects.filter(role=Provider.CHW_ROLE,user__in=User.objects.filter(date_joined__lte=ref_date)).count())
+        chw_tot.append(cumulative(day, stat.CHW_REGISTERED))
         
         # New Registered CHW
-        chw_reg.append(Provider.objects.filter(role=Provider.CHW_ROLE,user__in=User.objects.filter(date_joined__gte=morning, date_joined__lte=evening)).count())
+        chw_reg.append(get(stat.CHW_REGISTERED))
         
         # Failed CHW Registration
-        chw_reg_err.append(EventLog.objects.filter(created_at__gte=morning, created_at__lte=evening, message="provider_registered").count() - EventLog.objects.filter(created_at__gte=morning, created_at__lte=evening, message="confirmed_join").count())
+        chw_reg_err.append(get(stat.EVENT % "provider_registered") - get(stat.EVENT % "confirmed_join"))
         
         # Active CHWs
-        a = Case.objects.filter(created_at__gte=morning, created_at__lte=evening)
-        a.query.group_by = ['mctc_case.provider_id']
-        chw_on.append(a.__len__())
+        chw_on.append(get(stat.CHW_ACTIVE))
         
         # New Patient Registered
-        patient_reg.append(EventLog.objects.filter(created_at__gte=morning, created_at__lte=evening, message="patient_created").count())
+        patient_reg.append(get(stat.EVENT % "patient_created"))
         
         # Failed Patient Registration
-        patient_reg_err.append(MessageLog.objects.filter(created_at__gte=morning, created_at__lte=evening, text__startswith="new").count() - patient_reg[-1])
+        patient_reg_err.append(get(stat.SMS_PREFIXES["new"]) - patient_reg[-1])
         
         # Total Malaria Reports
-        malaria_tot.append(EventLog.objects.filter(created_at__gte=morning, created_at__lte=evening, message="mrdt_taken").count())
+        malaria_tot.append(get(stat.EVENT % "mrdt_taken"))
         
         # Failed Malaria Reports
-        malaria_err.append(MessageLog.objects.filter(created_at__gte=morning, created_at__lte=evening, text__startswith="mrdt").count() - malaria_tot[-1])
-        
-        # Malaria Test Positive
-        malaria_pos.append(ReportMalaria.objects.filter(entered_at__gte=morning, entered_at__lte=evening, result=True).count())
-        
-        # Malaria Positive with Bednets
-        bednet_y_pos.append(ReportMalaria.objects.filter(entered_at__gte=morning, entered_at__lte=evening, result=True, bednet=True).count())
+        malaria_err.append(get(stat.SMS_PREFIXES["mrdt"]) - malaria_tot[-1])
         
-        # Malaria Positive without Bednets
-        bednet_n_pos.append(ReportMalaria.objects.filter(entered_at__gte=morning, entered_at__lte=evening, result=True, bednet=False).count())
+        # Malaria Positive with and without Bednets
+        bednet_y_pos.append(get(stat.MRDT % ("pos", "net")))
+        bednet_n_pos.append(get(stat.MRDT % ("pos", "nonet")))
+        malaria_pos.append(bednet_y_pos[-1] + bednet_n_pos[-1])
         
-        # Malaria Test Negative
-        malaria_neg.append(ReportMalaria.objects.filter(entered_at__gte=morning, entered_at__lte=evening, result=False).count())
-        
-        # Malaria Negative with Bednets
-        bednet_y_neg.append(ReportMalaria.objects.filter(entered_at__gte=morning, entered_at__lte=evening, result=False, bednet=True).count())
-        
-        # Malaria Negative without Bednets
-        bednet_n_neg.append(ReportMalaria.objects.filter(entered_at__gte=morning, entered_at__lte=evening, result=False, bednet=False).count())
+        # Malaria Negative with and without Bednets
+        bednet_y_neg.append(get(stat.MRDT % ("neg", "net")))
+        bednet_n_neg.append(get(stat.MRDT % ("neg", "nonet")))
+        malaria_neg.append(bednet_y_neg[-1] + bednet_n_neg[-1])
         
         # Total Malnutrition Reports
-        malnut_tot.append(EventLog.objects.filter(created_at__gte=morning, created_at__lte=evening, message="muac_taken").count())
+        malnut_tot.append(get(stat.EVENT % "muac_taken"))
         
         # Failed Malnutrition Reports
-        malnut_err.append(MessageLog.objects.filter(created_at__gte=morning, created_at__lte=evening, text__startswith="muac").count() - malnut_tot[-1])
-        
-        # Total SAM+
-        samp_tot.append(ReportMalnutrition.objects.filter(entered_at__lte=evening, status=ReportMalnutrition.SEVERE_COMP_STATUS).count())
+        malnut_err.append(get(stat.SMS_PREFIXES["muac"]) - malnut_tot[-1])
         
-        # Total SAM
-        sam_tot.append(ReportMalnutrition.objects.filter(entered_at__lte=evening, status=ReportMalnutrition.SEVERE_STATUS).count())
+        # Total SAM+, SAM and MAM
+        samp_tot.append(cumulative(day, stat.MUAC % ReportMalnutrition.SEVERE_COMP_STATUS))
+        sam_tot.append(cumulative(day, stat.MUAC % ReportMalnutrition.SEVERE_STATUS))
+        mam_tot.append(cumulative(day, stat.MUAC % ReportMalnutrition.MODERATE_STATUS))
         
-        # Total MAM
-        mam_tot.append(ReportMalnutrition.objects.filter(entered_at__lte=evening, status=ReportMalnutrition.MODERATE_STATUS).count())
-        
-        # New SAM+
-        samp_new.append(ReportMalnutrition.objects.filter(entered_at__gte=morning, entered_at__lte=evening, status=ReportMalnutrition.SEVERE_COMP_STATUS).count())
-        
-        # New SAM
-        sam_new.append(ReportMalnutrition.objects.filter(entered_at__gte=morning, entered_at__lte=evening, status=ReportMalnutrition.SEVERE_STATUS).count())
-        
-        # New MAM
-        mam_new.append(ReportMalnutrition.objects.filter(entered_at__gte=morning, entered_at__lte=evening, status=ReportMalnutrition.MODERATE_STATUS).count())
+        # New SAM+, SAM and MAM
+        samp_new.append(get(stat.MUAC % ReportMalnutrition.SEVERE_COMP_STATUS))
+        sam_new.append(get(stat.MUAC % ReportMalnutrition.SEVERE_STATUS))
+        mam_new.append(get(stat.MUAC % ReportMalnutrition.MODERATE_STATUS))
         
         # User Messaging
-        user_msg.append(MessageLog.objects.filter(created_at__gte=morning, created_at__lte=evening, text__startswith="@").count())
+        user_msg.append(get(stat.SMS_PREFIXES["@"]))
 
-    # Write rows on CSV
-    for row in rows:
-        csvio.writerow([cell for cell in row])
-    
-    response = HttpResponse(mimetype='text/csv')
-    response['Content-Disposition'] = "attachment; filename=%s" % file_name
-    response.write(output.getvalue())
-    return response
+    return csv_response(rows, file_name)
 
 @login_required
+@cached_report
 def measles(request, object_id=None, per_page="0", rformat="pdf"):
     pdfrpt = PDFReport()
     pdfrpt.setLandscape(False)
@@ -550,6 +558,7 @@ def measles(request, object_id=None, per_page="0", rformat="pdf"):
     return pdfrpt.render()
 
 @login_required
+@cached_report
 def malnut(request, object_id=None, per_page="0", rformat="pdf"):
     pdfrpt = PDFReport()
     pdfrpt.setLandscape(True)
@@ -589,6 +598,7 @@ def malnut(request, object_id=None, per_page="0", rformat="pdf"):
     return pdfrpt.render()
 
 @login_required
+@cached_report
 def malaria(request, object_id=None, per_page="0", rformat="pdf"):
     pdfrpt = PDFReport()
     pdfrpt.setLandscape(True)
@@ -623,6 +633,8 @@ def malaria(request, object_id=None, per_page="0", rformat="pdf"):
             pdfrpt.setTableData(queryset, fields, c.get_name_display())
     
     return pdfrpt.render()
+
+@cached_report
 def trend(request, object_id=None, per_page="0", rformat="pdf"):
     pdfrpt = PDFReport()
     pdfrpt.setLandscape(False)
@@ -6,14 +6,15 @@ import rapidsms
 from rapidsms.parsers.keyworder import Keyworder
 from django.utils.translation import ugettext_lazy as _
 
-from mctc.models.logs import MessageLog
-from mctc.models.general import Provider, Case
+from mctc.logwriter import messagelog
+from mctc.models.general import Provider
 from mctc.models.reports import ReportCHWStatus
-from reporters.models import Reporter
+from mctc.models.status import CaseStatus
+from mctc.caches import cases
+from mctc.broadcaster import broadcaster
+from reporters.models import PersistantConnection
 from models import ReportMeasles
 
-import time
-
 def registered (func):
     def wrapper (self, message, *args):
         if message.persistant_connection.reporter:
@@ -31,7 +32,8 @@ class App (rapidsms.app.App):
     keyword = Keyworder()
     def start (self):
         """Configure your app in the start phase."""
-        pass
+        messagelog.attach(self.router)
+        broadcaster.attach(self.router)
 
     def parse (self, message):
         message.was_handled = False
@@ -61,11 +63,7 @@ class App (rapidsms.app.App):
 
     def cleanup (self, message):
         if message.was_handled:
-            log = MessageLog(mobile=message.peer,
-                         sent_by=message.persistant_connection.reporter,
-                         text=message.text,
-                         was_handled=message.was_handled)
-            log.save()
+            messagelog.write(message)
 
     def outgoing (self, message):
         """Handle outgoing message notifications."""
@@ -73,13 +71,13 @@ class App (rapidsms.app.App):
 
     def stop (self):
         """Perform global app cleanup when the application is stopped."""
-        pass
+        messagelog.flush(force=True)
 
     def find_case (self, ref_id):
-        try:
-            return Case.objects.get(ref_id=int(ref_id))
-        except Case.DoesNotExist:
+        case = cases.find(ref_id)
+        if case is None:
             raise HandlerFailed(_("Case +%s not found.") % ref_id)
+        return case
 
     @keyword(r'measles ?(.*)')
     @registered
@@ -91,6 +89,7 @@ class App (rapidsms.app.App):
             result = result + "+%s "%case.ref_id
             report = ReportMeasles(case=case, reporter=reporter, taken=True)
             report.save()
+            CaseStatus.record(report)
         message.respond(_(result + " received measles shot."))
         if notcases:
             nresult = "" 
@@ -137,13 +136,16 @@ class App (rapidsms.app.App):
             tmp += item
         if tmp != header:
             result.append(tmp)
-        #message.forward(u"0733202270", u"Start Measles Summary...")    
-        time.sleep(10)
-        reporters = Reporter.objects.all()
-        for text in result:
-            for reporter in reporters:
-                mobile = reporter.connection().identity
-                message.forward(mobile, text)
-                time.sleep(10)
-        #message.forward(u"0733202270", u"...Measles Summary End")
-        return True
\ No newline at end of file
+        # the phone each reporter was last seen on, like Reporter.connection()
+        recipients = {}
+        for conn in PersistantConnection.objects.filter(reporter__isnull=False)\
+                .select_related("backend").order_by("-last_seen"):
+            recipients.setdefault(conn.reporter_id, (conn.backend.slug, conn.identity))
+
+        # sent in the background, a few messages at a time
+        broadcast = broadcaster.queue("msummary", result, recipients.values(),
+                                      requested_by=message.persistant_connection.reporter,
+                                      notify=message)
+        message.respond(_("Measles summary queued: %(total)s messages to %(reporters)s reporters.") % {
+            "total": broadcast.total, "reporters": len(recipients)})
+        return True
@@ -3,7 +3,7 @@
 
 # Records cases which have received measles shot
 
-from django.db import models
+from django.db import models, connection
 
 from datetime import datetime
 
@@ -27,6 +27,11 @@ class ReportMeasles(models.Model):
         if not self.id:
             self.entered_at = datetime.now()
         super(ReportMeasles, self).save(*args)
+
+    def snapshot(self, status):
+        """ fill the measles columns of the case's CaseStatus """
+        status.vaccinated   = self.taken
+        status.measles_at   = self.entered_at
         
     def location(self):
         return self.case.location
@@ -41,6 +46,38 @@ class ReportMeasles(models.Model):
         except models.ObjectDoesNotExist:
             return False
     
+    @classmethod
+    def count_vaccinated(cls, reporters, dob_from, dob_to):
+        """ number of vaccinated cases of each of reporters (ids), born
+        between dob_from and dob_to: {reporter id: count}.
+        a case is vaccinated when its latest report says so, like
+        is_vaccinated(), but in one query for all the cases """
+        if not reporters:
+            return {}
+        qn      = connection.ops.quote_name
+        case    = Case._meta
+        report  = cls._meta
+        sql = ("SELECT c.%(reporter)s, COUNT(DISTINCT c.%(id)s)"
+               " FROM %(case)s c INNER JOIN %(report)s r ON r.%(case_id)s = c.%(id)s"
+               " WHERE c.%(reporter)s IN (%(in)s) AND c.%(dob)s >= %%s AND c.%(dob)s <= %%s"
+               " AND r.%(taken)s = %%s AND r.%(entered_at)s ="
+               " (SELECT MAX(l.%(entered_at)s) FROM %(report)s l WHERE l.%(case_id)s = c.%(id)s)"
+               " GROUP BY c.%(reporter)s") % {
+            "case":         qn(case.db_table),
+            "report":       qn(report.db_table),
+            "id":           qn(case.pk.column),
+            "reporter":     qn(case.get_field("reporter").column),
+            "dob":          qn(case.get_field("dob").column),
+            "case_id":      qn(report.get_field("case").column),
+            "taken":        qn(report.get_field("taken").column),
+            "entered_at":   qn(report.get_field("entered_at").column),
+            "in":           ", ".join(["%s"] * len(reporters)),
+        }
+        cursor = connection.cursor()
+        cursor.execute(sql, list(reporters) + [connection.ops.value_to_db_date(dob_from),
+                                               connection.ops.value_to_db_date(dob_to), True])
+        return dict(cursor.fetchall())
+
     @classmethod
     def get_vaccinated(cls,provider):
         try:
@@ -1,18 +1,19 @@
 #!/usr/bin/env python
 # vim: ai ts=4 sts=4 et sw=4
 
-from django.db import models
 from django.utils.translation import ugettext as _
 
 import rapidsms
 from rapidsms.parsers.keyworder import Keyworder
+from libdispatch.pool import pool
 
-from mctc.models.logs import MessageLog, log
-from mctc.models.general import Provider, Case
-from mctc.models.reports import Observation
+from mctc.models.logs import log
+from mctc.logwriter import messagelog
+from mctc.caches import identities, observations, cases, alert_recipients
+from mctc.reportwriter import file_report
 from models import ReportMalaria
 
-import re, datetime
+import re
 
 def registered (func):
     def wrapper (self, message, *args):
@@ -29,21 +30,17 @@ class HandlerFailed (Exception):
 class App (rapidsms.app.App):
     MAX_MSG_LEN = 140
     keyword = Keyworder()
+
+    # handlers may run on the libdispatch worker pool
+    thread_safe = True
+
     def start (self):
         """Configure your app in the start phase."""
-        pass
+        messagelog.attach(self.router)
 
     def parse (self, message):
-        # allow authentication to occur when httptester is used
-        if message.peer[:3] == '254':
-            mobile = "+" + message.peer
-        else:
-            mobile = message.peer 
-        provider = Provider.by_mobile(mobile)
-        if provider:
-            message.sender = provider.user
-        else:
-            message.sender = None
+        # shared with the other clinical apps, see mctc.caches
+        message.sender = identities.user(message.peer)
         message.was_handled = False
 
     def handle (self, message):
@@ -56,6 +53,9 @@ class App (rapidsms.app.App):
                 message.respond(self.get_mrdt_format_reminder())
                 return True
             return False
+        return pool.handle(self, message, func, captures)
+
+    def call_handler (self, message, func, captures):
         try:
             handled = func(self, message, *captures)
         except HandlerFailed, e:
@@ -72,11 +72,7 @@ class App (rapidsms.app.App):
 
     def cleanup (self, message):
         if message.was_handled:
-            log = MessageLog(mobile=message.peer,
-                         sent_by=message.persistant_connection.reporter,
-                         text=message.text,
-                         was_handled=message.was_handled)
-            log.save()
+            messagelog.write(message)
 
     def outgoing (self, message):
         """Handle outgoing message notifications."""
@@ -84,16 +80,16 @@ class App (rapidsms.app.App):
 
     def stop (self):
         """Perform global app cleanup when the application is stopped."""
-        pass
+        messagelog.flush(force=True)
 
     def find_case (self, ref_id):
-        try:
-            return Case.objects.get(ref_id=int(ref_id))
-        except Case.DoesNotExist:
+        case = cases.find(ref_id)
+        if case is None:
             raise HandlerFailed(_("Case +%s not found.") % ref_id)
+        return case
         
     def get_observations(self, text):
-        choices  = dict( [ (o.letter, o) for o in Observation.objects.all() ] )
+        choices  = observations.codes()
         observed = []
         if text:
             text = re.sub(r'\W+', ' ', text).lower()
@@ -106,14 +102,6 @@ class App (rapidsms.app.App):
                     observed.append(obj)
         return observed, choices
     
-    def delete_similar(self, queryset):
-        try:
-            last_report = queryset.latest("entered_at")
-            if (datetime.datetime.now() - last_report.entered_at).days == 0:
-                # last report was today. so delete it before filing another.
-                last_report.delete()
-        except models.ObjectDoesNotExist:
-            pass
         
     @keyword(r'mtk (\d+).*')
     def give_treatmet_reminder(self, message, kg):
@@ -144,17 +132,14 @@ class App (rapidsms.app.App):
        
         case = self.find_case(ref_id)
         observed, choices = self.get_observations(observed)
-        self.delete_similar(case.reportmalaria_set)
         reporter = message.persistant_connection.reporter
 
         result = (result == "+" or result.lower() == "y")
         bednet = (bednet.lower() == "y")
 
         report = ReportMalaria(case=case, reporter=reporter, result=result, bednet=bednet)
-        report.save()
-        for obs in observed:
-            report.observed.add(obs)
-        report.save()
+        # replaces today's report for this case, if any
+        file_report(report, links={"observed": observed})
 
         # build up an information dictionary
         info = case.get_dictionary()
@@ -217,12 +202,10 @@ class App (rapidsms.app.App):
 
         message.respond(msg)
         message.respond(_(info["instructions"]))
-        """ @todo: enable alerts """
-        """
-        recipients = report.get_alert_recipients()
-        for recipient in recipients:
-            message.forward(recipient.mobile, alert)
-        """    
+        for recipient in alert_recipients.recipients(location_id=case.location_id,
+                                                     reporter_id=reporter.id):
+            if recipient.mobile != message.peer:
+                message.forward(recipient.mobile, alert)
 
         log(case, "mrdt_taken")       
         return True 
@@ -55,10 +55,17 @@ class ReportMalaria(models.Model):
     def provider_number(self):
         return self.provider.mobile
         
-    def save(self, *args):
+    def save(self, *args, **kwargs):
         if not self.id:
             self.entered_at = datetime.now()
-        super(ReportMalaria, self).save(*args)
+        super(ReportMalaria, self).save(*args, **kwargs)
+
+    def snapshot(self, status):
+        """ fill the mrdt columns of the case's CaseStatus """
+        status.mrdt_result  = self.results_for_malaria_result()
+        status.mrdt_bednet  = self.results_for_malaria_bednet()
+        status.mrdt_count   = ReportMalaria.objects.filter(case=self.case_id).count()
+        status.mrdt_at      = self.entered_at
         
     @classmethod
     def count_by_provider(cls,provider, duration_end=None,duration_start=None):
@@ -1,16 +1,19 @@
 #!/usr/bin/env python
 # vim: ai ts=4 sts=4 et sw=4
-from django.db import models
 from django.utils.translation import ugettext as _
 
 import rapidsms
 from rapidsms.parsers.keyworder import Keyworder
+from libdispatch.pool import pool
 
-from mctc.models.logs import MessageLog, log
-from mctc.models.general import Provider, Case
-from models import ReportMalnutrition, Observation
+from mctc.models.logs import log
+from mctc.logwriter import messagelog
+from mctc.models.general import Provider
+from mctc.caches import observations, cases, alert_recipients
+from mctc.reportwriter import file_report
+from models import ReportMalnutrition
 
-import re, datetime
+import re
 
 def registered (func):
     def wrapper (self, message, *args):
@@ -27,9 +30,13 @@ class HandlerFailed (Exception):
 class App (rapidsms.app.App):
     MAX_MSG_LEN = 140
     keyword = Keyworder()
+
+    # handlers may run on the libdispatch worker pool
+    thread_safe = True
+
     def start (self):
         """Configure your app in the start phase."""
-        pass
+        messagelog.attach(self.router)
 
     def parse (self, message):        
         message.was_handled = False
@@ -43,6 +50,9 @@ class App (rapidsms.app.App):
             #message.respond(_("Unknown or incorrectly formed command: %(msg)s... Please re-check your message") % {"msg":message.text[:10]})
             
             return False
+        return pool.handle(self, message, func, captures)
+
+    def call_handler (self, message, func, captures):
         try:
             handled = func(self, message, *captures)
         except HandlerFailed, e:
@@ -59,11 +69,7 @@ class App (rapidsms.app.App):
 
     def cleanup (self, message):
         if message.was_handled:
-            log = MessageLog(mobile=message.peer,
-                         sent_by=message.persistant_connection.reporter,
-                         text=message.text,
-                         was_handled=message.was_handled)
-            log.save()
+            messagelog.write(message)
 
     def outgoing (self, message):
         """Handle outgoing message notifications."""
@@ -71,16 +77,16 @@ class App (rapidsms.app.App):
 
     def stop (self):
         """Perform global app cleanup when the application is stopped."""
-        pass
+        messagelog.flush(force=True)
 
     def find_case (self, ref_id):
-        try:
-            return Case.objects.get(ref_id=int(ref_id))
-        except Case.DoesNotExist:
+        case = cases.find(ref_id)
+        if case is None:
             raise HandlerFailed(_("Case +%s not found.") % ref_id)
+        return case
         
     def get_observations(self, text):
-        choices  = dict( [ (o.letter, o) for o in Observation.objects.all() ] )
+        choices  = observations.codes()
         observed = []
         if text:
             text = re.sub(r'\W+', ' ', text).lower()
@@ -93,14 +99,6 @@ class App (rapidsms.app.App):
                     observed.append(obj)
         return observed, choices
     
-    def delete_similar(self, queryset):
-        try:
-            last_report = queryset.latest("entered_at")
-            if (datetime.datetime.now() - last_report.entered_at).days == 0:
-                # last report was today. so delete it before filing another.
-                last_report.delete()
-        except models.ObjectDoesNotExist:
-            pass
         
     @registered
     @keyword(r'muac \+(\d+) ([\d\.]+)( [\d\.]+)?( [\d\.]+)?( (?:[a-z]\s*)+)')
@@ -134,16 +132,13 @@ class App (rapidsms.app.App):
                 raise HandlerFailed("Can't understand height (cm): %s" % height)
 
         observed, choices = self.get_observations(complications)
-        self.delete_similar(case.reportmalnutrition_set)
 
         reporter = message.persistant_connection.reporter
         report = ReportMalnutrition(case=case, reporter=reporter, muac=muac,
                         weight=weight, height=height)
-        report.save()
-        for obs in observed:
-            report.observed.add(obs)
-        report.diagnose()
-        report.save()
+        report.diagnose(observed)
+        # replaces today's report for this case, if any
+        file_report(report, links={"observed": observed})
 
         #choice_term = dict(choices)
 
@@ -158,19 +153,13 @@ class App (rapidsms.app.App):
 
         message.respond("MUAC> " + msg)
         
-        """ @todo   enable alerts      """
-        """
         if report.status in (report.MODERATE_STATUS,
                            report.SEVERE_STATUS,
                            report.SEVERE_COMP_STATUS):
-            alert = _("@%(username)s reports %(msg)s") % {"username":provider.user.username, "msg":msg}
-            recipients = [provider]
-            for query in (Provider.objects.filter(alerts=True),
-                          Provider.objects.filter(clinic=provider.clinic)):
-                for recipient in query:
-                    if recipient in recipients: continue
-                    recipients.append(recipient)
-                    #message.forward(recipient.mobile, alert)
-        """
+            alert = _("@%(username)s reports %(msg)s") % {"username":reporter.alias, "msg":msg}
+            for recipient in alert_recipients.recipients(location_id=case.location_id,
+                                                         reporter_id=reporter.id):
+                if recipient.mobile != message.peer:
+                    message.forward(recipient.mobile, alert)
         log(case, "muac_taken")
         return True
@@ -74,9 +74,12 @@ class ReportMalnutrition(models.Model):
     def provider_number(self):
         return self.provider.mobile
             
-    def diagnose (self):
-        complications = [c for c in self.observed.all() if c.uid != "edema"]
-        edema = "edema" in [ c.uid for c in self.observed.all() ]
+    def diagnose (self, observed=None):
+        # observed can be passed in before the report is saved
+        if observed is None:
+            observed = list(self.observed.all())
+        complications = [c for c in observed if c.uid != "edema"]
+        edema = "edema" in [ c.uid for c in observed ]
         self.status = ReportMalnutrition.HEALTHY_STATUS
         if edema or self.muac < 110:
             if complications:
@@ -98,10 +101,18 @@ class ReportMalnutrition(models.Model):
    
         return msg
 
-    def save(self, *args):
+    def save(self, *args, **kwargs):
         if not self.id:
             self.entered_at = datetime.now()
-        super(ReportMalnutrition, self).save(*args)
+        super(ReportMalnutrition, self).save(*args, **kwargs)
+
+    def snapshot(self, status):
+        """ fill the muac columns of the case's CaseStatus """
+        observed = list(self.observed.all())
+        status.muac_status          = "%s (%smm)" % (self.get_status_display(), self.muac)
+        status.muac_symptoms        = ", ".join([k.letter.upper() for k in observed])
+        status.muac_symptoms_text   = ", ".join([k.name for k in observed])
+        status.muac_at              = self.entered_at
        
     @classmethod
     def count_by_provider(cls,provider, duration_end=None,duration_start=None):